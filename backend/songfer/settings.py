@@ -107,6 +107,7 @@ MIDDLEWARE = [
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'songs.middleware.SignedMediaMiddleware',  # Verifies signed media links before sessions/auth are touched
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -235,10 +236,21 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+# Emulate message priorities on Redis (one list per step, 0 is consumed first)
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+# Only reserve one task at a time so priorities are honoured between long downloads
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 
 # Define Celery Beat schedule
 from celery.schedules import crontab
 
+SONG_CACHE_ACCESS_FLUSH_SECONDS = 60  # How often buffered cache hits are written to the database
+SONG_CACHE_WARM_HOURS = config('SONG_CACHE_WARM_HOURS', default='2-5')  # Off-peak hours (crontab syntax, local time) when the cache warmer runs
+
 CELERY_BEAT_SCHEDULE = {
     'cleanup-cache-daily': {
         'task': 'songs.tasks.cleanup_cache',
@@ -247,6 +259,34 @@ CELERY_BEAT_SCHEDULE = {
             'expires': 3600,  # Expires after 1 hour
         },
     },
+    'flush-song-cache-accesses': {
+        'task': 'songs.tasks.flush_cache_accesses',
+        'schedule': SONG_CACHE_ACCESS_FLUSH_SECONDS,
+        'options': {
+            'expires': SONG_CACHE_ACCESS_FLUSH_SECONDS,
+        },
+    },
+    'rebalance-storage-tiers-hourly': {
+        'task': 'songs.tasks.rebalance_storage_tiers',
+        'schedule': crontab(minute=30),
+        'options': {
+            'expires': 1800,
+        },
+    },
+    'warm-song-cache-off-peak': {
+        'task': 'songs.tasks.warm_song_cache',
+        'schedule': crontab(hour=SONG_CACHE_WARM_HOURS, minute='*/15'),
+        'options': {
+            'expires': 900,
+        },
+    },
+    'reconcile-media-index-daily': {
+        'task': 'songs.tasks.reconcile_media_index',
+        'schedule': crontab(hour=3, minute=0),  # After cache cleanup has removed files
+        'options': {
+            'expires': 3600,
+        },
+    },
 }
 
 # Redis Cache
@@ -313,7 +353,7 @@ CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
     "http://127.0.0.1:3000",
 ]
-CORS_EXPOSE_HEADERS = ['X-Thumbnail-URL', 'X-Song-Title', 'X-Song-Artist']
+CORS_EXPOSE_HEADERS = ['X-Thumbnail-URL', 'X-Song-Title', 'X-Song-Artist', 'ETag', 'Last-Modified', 'Accept-Ranges', 'Content-Range']
 
 # Add these new settings to fix the credential issue
 CORS_ALLOW_CREDENTIALS = True  
@@ -333,6 +373,10 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'range',
+    'if-range',
+    'if-none-match',
+    'if-modified-since',
 ]
 
 # Swagger settings
@@ -375,6 +419,115 @@ RATELIMIT_ENABLE = True
 SUPPORTED_AUDIO_FORMATS = ['mp3', 'aac']
 DEFAULT_AUDIO_FORMAT = 'mp3'
 
+# Download jobs
+ASYNC_DOWNLOADS = config('ASYNC_DOWNLOADS', default=False, cast=bool)  # Queue every download instead of running it in the request
+DOWNLOAD_JOB_PRIORITIES = {
+    'premium': 0,  # Celery priority on Redis, lower runs first
+    'free': 6,
+}
+DOWNLOAD_JOB_POLL_SECONDS = 2  # Retry-After given to clients polling an unfinished job's status URL
+DOWNLOAD_JOB_EVENT_INTERVAL = 1  # Seconds between progress checks on the events stream
+DOWNLOAD_JOB_EVENT_TIMEOUT = 5  # The events stream is a short long-poll: it closes after this many seconds and clients reconnect
+
+# Playlist downloads
+PLAYLIST_TRACKS_PER_TASK = 10  # Tracks each Celery subtask pushes through the download pipeline
+PLAYLIST_MAX_PARALLEL_TASKS = config('PLAYLIST_MAX_PARALLEL_TASKS', default=4, cast=int)  # Subtasks of one playlist running at once across the workers
+UPSTREAM_RATE_LIMITS = {
+    'youtube': (30, 60),  # (calls, window in seconds) shared by every worker
+}
+# Negative cache: seconds a source that failed stays failed, by error class (see utils.classify_source_error)
+SOURCE_FAILURE_TTLS = {
+    'unavailable': 24 * 60 * 60,  # Private, removed or blocked videos, URLs the download API rejects
+    'not_found': 60 * 60,  # Spotify tracks whose lookup came back empty
+    'upstream_error': 5 * 60,  # Download API server errors for this URL
+}
+
+# Downloads are written under MEDIA_ROOT and renamed into place when finished
+MEDIA_STAGING_DIR = '.staging'
+MEDIA_STAGING_MAX_AGE_HOURS = 6  # Leftover staging dirs older than this are removed by cleanup_cache
+
+# ffmpeg executor, shared by every web and Celery process on the host
+FFMPEG_MAX_CONCURRENCY = config('FFMPEG_MAX_CONCURRENCY', default=os.cpu_count() or 2, cast=int)  # Concurrent ffmpeg processes per host
+FFMPEG_QUEUE_TIMEOUT = config('FFMPEG_QUEUE_TIMEOUT', default=120, cast=int)  # Seconds to wait for a free slot before giving up
+FFMPEG_TIMEOUT = config('FFMPEG_TIMEOUT', default=300, cast=int)  # Wall-clock seconds before a job is killed
+FFMPEG_CPU_SECONDS = config('FFMPEG_CPU_SECONDS', default=600, cast=int)  # RLIMIT_CPU for each ffmpeg process
+FFMPEG_NICE = config('FFMPEG_NICE', default=10, cast=int)  # Keep ffmpeg below web workers in the scheduler
+FFMPEG_SLOT_DIR = config('FFMPEG_SLOT_DIR', default=None)  # Host-local dir for slot lock files, defaults to the temp dir
+FFMPEG_STREAM_CHUNK_SIZE = 64 * 1024
+
+# File delivery
+# python: Django sends the bytes (zero-copy via wsgi.file_wrapper where the server supports it, e.g. gunicorn)
+# nginx: X-Accel-Redirect to MEDIA_ACCEL_REDIRECT_LOCATION, which must be an internal location aliasing MEDIA_ROOT
+# apache: X-Sendfile with the absolute path (mod_xsendfile)
+MEDIA_DELIVERY_BACKEND = config('MEDIA_DELIVERY_BACKEND', default='python')
+MEDIA_ACCEL_REDIRECT_LOCATION = config('MEDIA_ACCEL_REDIRECT_LOCATION', default='/protected-media/')
+PLAYLIST_ARCHIVE_DIR = 'archives'  # Prebuilt playlist ZIPs, under MEDIA_ROOT
+PLAYLIST_ARCHIVE_BUILD_DELAY = 30  # Seconds to wait after a playlist change before rebuilding its ZIP
+MEDIA_INDEX_RECONCILE_BATCH_SIZE = 500  # Rows per query/upsert when reconciling the media file index
+SIGNED_MEDIA_URL = '/signed-media/'
+SIGNED_MEDIA_URL_TTL = config('SIGNED_MEDIA_URL_TTL', default=6 * 60 * 60, cast=int)  # Seconds a signed file link stays valid
+SIGNED_MEDIA_URL_BUCKET = 300  # Expiry is rounded up to this, so links are stable (and cacheable) for a while
+
+# Hot/cold storage tiers for audio (see songs/storage.py). MEDIA_ROOT is the hot tier;
+# for an object store set MEDIA_COLD_STORAGE to e.g. django-storages' S3Storage with an endpoint_url (MinIO works)
+MEDIA_TIERING_ENABLED = config('MEDIA_TIERING_ENABLED', default=False, cast=bool)
+MEDIA_COLD_STORAGE = {
+    'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    'OPTIONS': {'location': config('MEDIA_COLD_ROOT', default=os.path.join(BASE_DIR, 'media_cold'))},
+}
+MEDIA_HOT_MAX_BYTES = config('MEDIA_HOT_MAX_BYTES', default=50 * 1024 ** 3, cast=int)  # Local disk used by audio before files are demoted
+MEDIA_HOT_FILL_TO = 0.9  # Demote down to (and promote up to) this fraction of MEDIA_HOT_MAX_BYTES
+MEDIA_PROMOTE_MIN_READS = 3  # Reads (halved each rebalance) that bring a cold file back to local disk
+MEDIA_TIER_ACCESS_FLUSH_SECONDS = 60  # How often process-local read counts are written to the database
+MEDIA_COLD_READ_CHUNK_SIZE = 256 * 1024  # Bytes per read from the cold tier
+MEDIA_COLD_READ_AHEAD_CHUNKS = 8  # Chunks fetched ahead of the client when streaming a cold file
+
+# cleanup_cache management command
+CACHE_CLEANUP_BATCH_SIZE = 500  # Rows or files per batch
+CACHE_CLEANUP_WORKERS = 4  # Threads removing files
+CACHE_CLEANUP_MAX_FILE_OPS = config('CACHE_CLEANUP_MAX_FILE_OPS', default=500, cast=int)  # Stats + removals per second, so cleanup doesn't saturate the disk
+
+# Song cache budget and eviction (see songs/cache_manager.py)
+SONG_CACHE_MAX_BYTES = config('SONG_CACHE_MAX_BYTES', default=20 * 1024 ** 3, cast=int)  # Total size of cached song files
+SONG_CACHE_POLICY = config('SONG_CACHE_POLICY', default='lru')  # 'lru', 'lfu' or 'tinylfu' (LRU eviction with frequency-based admission)
+SONG_CACHE_EVICT_TO = 0.9  # When over budget, evict down to this fraction of it
+SONG_CACHE_METADATA_TTL = 6 * 60 * 60  # Seconds a SongCache row's copy stays in the shared cache
+SONG_CACHE_SKETCH_WIDTH = 16384  # Counters per row of the tinylfu frequency sketch
+SONG_CACHE_SKETCH_SAMPLE = 100000  # Lookups per sketch generation; older counts are halved
+
+# Cache warming (see songs/cache_warmer.py); runs during SONG_CACHE_WARM_HOURS
+SONG_CACHE_WARM_WINDOW_HOURS = 24  # Download history searched for trending tracks
+SONG_CACHE_WARM_RECOMMENDATIONS = 5  # Top entries taken from each user's cached recommendations
+SONG_CACHE_WARM_MAX_TRACKS = 200  # Tracks queued per run
+SONG_CACHE_WARM_MAX_BYTES_PER_HOUR = config('SONG_CACHE_WARM_MAX_BYTES_PER_HOUR', default=2 * 1024 ** 3, cast=int)
+SONG_CACHE_WARM_MAX_CALLS_PER_HOUR = config('SONG_CACHE_WARM_MAX_CALLS_PER_HOUR', default=120, cast=int)  # Upstream (YouTube/Spotify) calls
+SONG_CACHE_WARM_PRIORITY = 9  # Celery priority of warming downloads, below every user download
+
+# Transcoded format variants (e.g. aac copies of cached mp3s)
+TRANSCODE_CACHE_DIR = 'transcodes'
+TRANSCODE_CACHE_MAX_BYTES = config('TRANSCODE_CACHE_MAX_BYTES', default=2 * 1024 ** 3, cast=int)  # Least recently used variants are removed above this
+TRANSCODE_STREAMING = config('TRANSCODE_STREAMING', default=True, cast=bool)  # Stream uncached transcodes to the client while ffmpeg runs
+
+# Cover art store (see songs/cover_art.py): processed JPEGs shared by every song with the same artwork
+COVER_ART_DIR = 'covers'
+COVER_ART_SIZES = {'large': 500, 'small': 64}  # Max edge in px; large is embedded in ID3 tags, small is for the UI
+COVER_ART_JPEG_QUALITY = 90
+COVER_ART_FAILURE_TTL = 3600  # Seconds before artwork that couldn't be fetched is tried again
+COVER_ART_FETCH_WAIT = 10  # Seconds to wait for another worker already fetching the same artwork
+
+# Download pipeline (fetch -> process -> persist)
+PIPELINE_FETCH_WORKERS = config('PIPELINE_FETCH_WORKERS', default=4, cast=int)  # Threads waiting on the network
+PIPELINE_PROCESS_WORKERS = config('PIPELINE_PROCESS_WORKERS', default=2, cast=int)  # ffmpeg / tagging / image workers
+PIPELINE_USE_PROCESSES = config('PIPELINE_USE_PROCESSES', default=False, cast=bool)  # Opt in to a long-lived process pool for the process stage (never inside Celery workers)
+PIPELINE_QUEUE_SIZE = 8  # Max items waiting between two stages
+PIPELINE_BATCH_SIZE = 10  # Max tracks per DB writer batch
+PIPELINE_BATCH_TIMEOUT = 2  # Seconds the writer waits to fill a batch
+DOWNLOAD_PROGRESS_FLUSH_INTERVAL = 1  # Min seconds between progress writes while a playlist downloads
+
+# Spotify -> YouTube matches
+SPOTIFY_MATCH_MIN_CONFIDENCE = 0.6  # Below this a remembered match is ignored and the track is searched again
+SPOTIFY_MATCH_MAX_AGE_DAYS = 90  # Re-search tracks whose match hasn't been verified for this long
+
 # Hugging Face Space URLs
 HUGGINGFACE_RECOMMENDATION_URL = "https://monilm-songporter.hf.space/recommendations/"
 HUGGINGFACE_ARTIST_INFO_URL = "https://monilm-songporter.hf.space/artist-info/"
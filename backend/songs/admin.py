@@ -1,8 +1,14 @@
 from django.contrib import admin
-from .models import Song, Playlist, Genre, UserMusicProfile,SongCache
+from .models import Song, Playlist, Genre, UserMusicProfile,SongCache, DownloadJob, SpotifyMatch, TranscodedVariant, MediaFileIndex, PlaylistArchive, StoredBlob
 
 admin.site.register(Song)
 admin.site.register(Playlist)
 admin.site.register(Genre)
 admin.site.register(UserMusicProfile)
 admin.site.register(SongCache)
+admin.site.register(DownloadJob)
+admin.site.register(SpotifyMatch)
+admin.site.register(TranscodedVariant)
+admin.site.register(MediaFileIndex)
+admin.site.register(PlaylistArchive)
+admin.site.register(StoredBlob)
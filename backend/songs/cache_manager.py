@@ -0,0 +1,558 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('lru', 'lfu', 'tinylfu')
+
+# Running total of SongCache.file_size, kept beside the database so inserts don't need SUM()
+BYTES_KEY = 'song_cache:bytes'
+STATS_KEY = 'song_cache:stats:{}'
+STAT_NAMES = ('lookups', 'hits', 'bytes_requested', 'bytes_hit', 'inserts', 'rejections', 'evictions', 'bytes_evicted',
+              'warmed', 'bytes_warmed', 'warmed_hits', 'downloads', 'cacheable')
+
+# Count-min sketch of recent lookups for TinyLFU admission
+SKETCH_DEPTH = 4
+SKETCH_OPS_KEY = 'song_cache:sketch:ops'
+SKETCH_KEY = 'song_cache:sketch:{}:{}:{}'
+
+
+# Copies of SongCache rows (plus the file's content hash), keyed by canonical source key
+META_KEY = 'song_cache:meta:{}'
+META_FIELDS = ('id', 'song_url', 'source_key', 'file_path', 'file_size', 'title', 'artist', 'created_at',
+               'accessed_at', 'expires_at', 'metadata', 'hit_count')
+
+# Keys every SongCache.metadata has, whichever download path wrote it ('id' is the YouTube id)
+METADATA_FIELDS = ('title', 'artist', 'album', 'thumbnail_url', 'source', 'spotify_id', 'id', 'year', 'genre',
+                   'album_artist')
+
+def _redis():
+    """The Redis connection behind the default cache, or None for other cache backends"""
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def _incr(key, delta=1, timeout=None):
+    """Atomically add delta to a counter in the shared cache, creating it if needed"""
+    if not delta:
+        return cache.get(key) or 0
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Expired between add() and incr()
+        cache.set(key, delta, timeout)
+        return delta
+
+
+def _record_stats(**counts):
+    for name, value in counts.items():
+        if value:
+            try:
+                _incr(STATS_KEY.format(name), value)
+            except Exception as e:
+                logger.debug(f"Could not update cache stat {name}: {e}")
+
+
+class FrequencySketch:
+    """
+    Approximate lookup counts per song URL, shared by every process through the
+    Django cache. Counts live in SKETCH_DEPTH rows of SONG_CACHE_SKETCH_WIDTH
+    counters (a count-min sketch). Every SONG_CACHE_SKETCH_SAMPLE lookups a new
+    generation starts and the previous one counts half, so old popularity fades.
+    """
+
+    def __init__(self, width=None, sample=None):
+        self.width = width or settings.SONG_CACHE_SKETCH_WIDTH
+        self.sample = sample or settings.SONG_CACHE_SKETCH_SAMPLE
+
+    def _buckets(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=4 * SKETCH_DEPTH).digest()
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'big') % self.width for i in range(SKETCH_DEPTH)]
+
+    def _generation(self):
+        return (cache.get(SKETCH_OPS_KEY) or 0) // self.sample
+
+    def record(self, key):
+        generation = _incr(SKETCH_OPS_KEY) // self.sample
+        for row, bucket in enumerate(self._buckets(key)):
+            # Two generations are ever read, so older counters can just expire
+            _incr(SKETCH_KEY.format(generation, row, bucket), timeout=7 * 24 * 3600)
+
+    def estimate(self, key):
+        generation = self._generation()
+        buckets = self._buckets(key)
+        keys = [SKETCH_KEY.format(gen, row, bucket) for gen in (generation, generation - 1) for row, bucket in enumerate(buckets)]
+        counts = cache.get_many(keys)
+        current = min(counts.get(k, 0) for k in keys[:SKETCH_DEPTH])
+        previous = min(counts.get(k, 0) for k in keys[SKETCH_DEPTH:])
+        return current + previous // 2
+
+
+def _policy():
+    policy = settings.SONG_CACHE_POLICY
+    if policy not in POLICIES:
+        from django.core.exceptions import ImproperlyConfigured
+        raise ImproperlyConfigured(f"Unknown SONG_CACHE_POLICY: {policy}")
+    return policy
+
+
+def sync_bytes():
+    """Recompute the running byte total from the database (after a cache flush)"""
+    from .models import SongCache
+
+    total = SongCache.objects.aggregate(total=Sum('file_size'))['total'] or 0
+    cache.set(BYTES_KEY, total, None)
+    return total
+
+
+def used_bytes():
+    total = cache.get(BYTES_KEY)
+    return sync_bytes() if total is None else total
+
+
+def _add_bytes(delta):
+    if cache.get(BYTES_KEY) is None:
+        # Counter lost: the database already includes this change
+        return sync_bytes()
+    return _incr(BYTES_KEY, delta)
+
+
+def release_bytes(freed):
+    """Account for entries deleted outside the cache manager"""
+    if freed:
+        _add_bytes(-freed)
+
+
+def record_lookup(url, entry):
+    """
+    Count a SongCache lookup for the stats and the admission sketch.
+
+    Args:
+        url: The song URL that was looked up
+        entry: The SongCache entry found, or None on a miss
+    """
+    try:
+        if _policy() == 'tinylfu':
+            FrequencySketch().record(url)
+        if entry is not None:
+            # Hits on entries the warmer prefetched (see cache_warmer) are counted separately too
+            warmed = 1 if (entry.metadata or {}).get('warmed_at') else 0
+            _record_stats(lookups=1, hits=1, bytes_requested=entry.file_size, bytes_hit=entry.file_size,
+                          warmed_hits=warmed)
+        else:
+            # A miss's bytes are counted when the downloaded file is inserted
+            _record_stats(lookups=1)
+    except Exception as e:
+        logger.debug(f"Could not record cache lookup: {e}")
+
+
+def _meta_key(url):
+    from .utils import canonical_key
+    return META_KEY.format(canonical_key(url) or url)
+
+
+def remember_entries(entries):
+    """
+    Put copies of SongCache entries in the shared cache so lookups can skip the
+    database. Each copy carries the file's content hash as content_hash.
+    """
+    from .utils import content_hash
+
+    values = {}
+    for entry in entries:
+        data = {field: getattr(entry, field) for field in META_FIELDS}
+        try:
+            data['content_hash'] = content_hash(os.path.join(settings.MEDIA_ROOT, entry.file_path))
+        except OSError:
+            data['content_hash'] = None
+        values[_meta_key(entry.song_url)] = data
+    if values:
+        try:
+            cache.set_many(values, settings.SONG_CACHE_METADATA_TTL)
+        except Exception as e:
+            logger.warning(f"Could not cache song cache metadata: {e}")
+
+
+def forget_entries(urls):
+    """Drop cached copies of entries that were deleted or replaced"""
+    keys = [_meta_key(url) for url in urls]
+    if keys:
+        try:
+            cache.delete_many(keys)
+        except Exception as e:
+            logger.warning(f"Could not drop song cache metadata: {e}")
+
+
+def cached_entries(urls):
+    """
+    Look up SongCache entries in the shared cache with one round trip (MGET on Redis).
+    Expired copies count as misses.
+
+    Returns:
+        Dict of url -> unsaved-looking SongCache instance loaded from the copy
+    """
+    from django.utils import timezone
+    from .models import SongCache
+
+    keys = {url: _meta_key(url) for url in urls}
+    try:
+        found = cache.get_many(list(keys.values()))
+    except Exception as e:
+        logger.warning(f"Could not read song cache metadata: {e}")
+        return {}
+
+    now = timezone.now()
+    entries = {}
+    for url, key in keys.items():
+        # Copies are keyed by canonical key, so other spellings of the URL find them too
+        data = found.get(key)
+        if not data or data['expires_at'] <= now:
+            continue
+        entry = SongCache.from_db('default', META_FIELDS, [data.get(field) for field in META_FIELDS])
+        entry.content_hash = data.get('content_hash')
+        entries[url] = entry
+    return entries
+
+
+class AccessBuffer:
+    """
+    Last-access times and hit counts for a set of keys, collected without database
+    writes: in a Redis sorted set and hash when the cache is django-redis, in a
+    process-local buffer otherwise. drain() takes everything collected so far.
+
+    Args:
+        name: Prefix of the Redis keys, e.g. 'song_cache'
+    """
+
+    def __init__(self, name):
+        self.access_key = f'songfer:{name}:accessed'  # Sorted set: key -> last access time
+        self.hits_key = f'songfer:{name}:hits'  # Hash: key -> hits since the last drain
+        self._accesses = {}
+        self._hits = Counter()
+        self._lock = threading.Lock()
+        self._drained_at = time.monotonic()
+
+    def add(self, keys, flush_seconds):
+        """
+        Record one access to each key.
+
+        Returns:
+            True if this is a process-local buffer older than flush_seconds; web
+            processes don't run beat tasks, so callers drain those themselves
+        """
+        keys = list(keys)
+        if not keys:
+            return False
+        now = time.time()
+        redis = _redis()
+        if redis is not None:
+            try:
+                pipe = redis.pipeline(transaction=False)
+                pipe.zadd(self.access_key, {key: now for key in keys})
+                for key in keys:
+                    pipe.hincrby(self.hits_key, key, 1)
+                pipe.execute()
+                return False
+            except Exception as e:
+                logger.warning(f"Could not buffer accesses in Redis: {e}")
+
+        with self._lock:
+            for key in keys:
+                self._accesses[key] = now
+                self._hits[key] += 1
+            return time.monotonic() - self._drained_at >= flush_seconds
+
+    def drain(self):
+        """Take everything buffered so far; returns (key -> last access time, key -> hits)"""
+        with self._lock:
+            accesses, hits = dict(self._accesses), dict(self._hits)
+            self._accesses.clear()
+            self._hits.clear()
+            self._drained_at = time.monotonic()
+
+        redis = _redis()
+        if redis is not None:
+            try:
+                pipe = redis.pipeline(transaction=True)
+                pipe.zrange(self.access_key, 0, -1, withscores=True)
+                pipe.hgetall(self.hits_key)
+                pipe.delete(self.access_key, self.hits_key)
+                buffered, buffered_hits, _ = pipe.execute()
+                for key, score in buffered:
+                    key = key.decode('utf-8')
+                    accesses[key] = max(score, accesses.get(key, 0))
+                for key, count in buffered_hits.items():
+                    key = key.decode('utf-8')
+                    hits[key] = hits.get(key, 0) + int(count)
+            except Exception as e:
+                logger.warning(f"Could not read buffered accesses from Redis: {e}")
+        return accesses, hits
+
+
+# Buffered SongCache lookups, flushed to the database in batches (see touch/flush_accesses)
+_song_accesses = AccessBuffer('song_cache')
+
+
+def touch(urls):
+    """
+    Record cache hits without writing to the database: last-access times are
+    buffered (see AccessBuffer) and flush_accesses writes them in batches, so a
+    popular track costs no row update per download.
+    """
+    if _song_accesses.add(urls, settings.SONG_CACHE_ACCESS_FLUSH_SECONDS):
+        flush_accesses()
+
+
+def flush_accesses(batch_size=500):
+    """
+    Write buffered last-access times and hit counts to SongCache, one UPDATE
+    per batch_size entries.
+
+    Returns:
+        Number of entries updated
+    """
+    from datetime import datetime, timezone as dt_timezone
+    from django.db.models import Case, F, IntegerField, Value, When
+    from .models import SongCache
+
+    accesses, hits = _song_accesses.drain()
+    if not accesses:
+        return 0
+
+    urls = list(accesses)
+    updated = 0
+    for i in range(0, len(urls), batch_size):
+        batch = urls[i:i + batch_size]
+        updated += SongCache.objects.filter(song_url__in=batch).update(
+            accessed_at=Case(*[
+                When(song_url=url, then=Value(datetime.fromtimestamp(accesses[url], tz=dt_timezone.utc)))
+                for url in batch
+            ]),
+            hit_count=F('hit_count') + Case(
+                *[When(song_url=url, then=Value(hits.get(url, 0))) for url in batch],
+                default=Value(0), output_field=IntegerField()
+            ),
+        )
+    logger.debug(f"Flushed {len(urls)} buffered cache accesses")
+    return updated
+
+
+def _victims(exclude=(), limit=100):
+    """Entries to evict next under the configured policy, best candidate first"""
+    from .models import SongCache
+
+    order = ('hit_count', 'accessed_at') if _policy() == 'lfu' else ('accessed_at',)
+    return list(SongCache.objects.exclude(song_url__in=list(exclude)).order_by(*order)[:limit])
+
+
+def _delete_entries(entries):
+    """Delete entries and their files (unless a Song still uses the file); returns bytes freed"""
+    from .models import Song, SongCache
+
+    if not entries:
+        return 0
+    paths = [entry.file_path for entry in entries if entry.file_path]
+    in_use = set(Song.objects.filter(file__in=paths).values_list('file', flat=True))
+    for entry in entries:
+        if entry.file_path and entry.file_path not in in_use:
+            try:
+                os.remove(os.path.join(settings.MEDIA_ROOT, entry.file_path))
+            except OSError:
+                pass
+    # By URL: entries from bulk_create may not have their primary key set
+    SongCache.objects.filter(song_url__in=[entry.song_url for entry in entries]).delete()
+    forget_entries(entry.song_url for entry in entries)
+    freed = sum(entry.file_size for entry in entries)
+    _add_bytes(-freed)
+    return freed
+
+
+def evict(target_bytes=None, exclude=()):
+    """
+    Evict entries in policy order until the cache holds at most target_bytes
+    (SONG_CACHE_EVICT_TO of the budget by default). Evicting below the budget
+    means one insert's eviction makes room for many later ones, so the cost per
+    insert stays constant on average.
+
+    Returns:
+        Number of entries evicted
+    """
+    if target_bytes is None:
+        target_bytes = int(settings.SONG_CACHE_MAX_BYTES * settings.SONG_CACHE_EVICT_TO)
+    used = used_bytes()
+    if used > target_bytes:
+        # Victims are picked by recency and hit count, so apply buffered lookups first
+        flush_accesses()
+    evicted = 0
+    while used > target_bytes:
+        batch = []
+        for entry in _victims(exclude):
+            batch.append(entry)
+            used -= entry.file_size
+            if used <= target_bytes:
+                break
+        if not batch:
+            break
+        freed = _delete_entries(batch)
+        evicted += len(batch)
+        _record_stats(evictions=len(batch), bytes_evicted=freed)
+        used = used_bytes()
+
+    if evicted:
+        logger.info(f"Evicted {evicted} cache entries ({_policy()}), {used} bytes in use")
+    return evicted
+
+
+def admit(entries, replaced_bytes=0):
+    """
+    Account for freshly inserted SongCache entries and keep the cache within
+    SONG_CACHE_MAX_BYTES. Under tinylfu a new entry only displaces the next
+    victim if its URL has been looked up more often; otherwise the new entry is
+    dropped instead.
+
+    Args:
+        entries: SongCache entries just created or updated
+        replaced_bytes: Total file_size the entries had before an update
+
+    Returns:
+        List of entries kept in the cache
+    """
+    entries = list(entries)
+    if not entries:
+        return entries
+    added = sum(entry.file_size for entry in entries)
+    used = _add_bytes(added - replaced_bytes)
+    _record_stats(inserts=len(entries), bytes_requested=added)
+    budget = settings.SONG_CACHE_MAX_BYTES
+    if used <= budget:
+        return entries
+
+    if _policy() == 'tinylfu':
+        sketch = FrequencySketch()
+        urls = {entry.song_url for entry in entries}
+        victims = _victims(exclude=urls, limit=1)
+        victim_frequency = sketch.estimate(victims[0].song_url) if victims else 0
+        rejected = [entry for entry in entries if victims and sketch.estimate(entry.song_url) <= victim_frequency]
+        if rejected:
+            _delete_entries(rejected)
+            _record_stats(rejections=len(rejected))
+            entries = [entry for entry in entries if entry not in rejected]
+            logger.info(f"Cache admission rejected {len(rejected)} entries less popular than the next victim")
+
+    evict(exclude={entry.song_url for entry in entries})
+    return entries
+
+
+def cache_metadata(metadata):
+    """
+    The metadata stored with a cache entry: every METADATA_FIELDS key (None when
+    unknown) plus any extra keys the caller passed
+    """
+    normalized = {field: metadata.get(field) for field in METADATA_FIELDS}
+    normalized.update((k, v) for k, v in metadata.items() if k not in normalized)
+    normalized['title'] = normalized['title'] or 'Unknown Title'
+    normalized['artist'] = normalized['artist'] or 'Unknown Artist'
+    return normalized
+
+
+def link_blob(rel_path, source_key):
+    """
+    Give a downloaded file (relative to MEDIA_ROOT) a name under cache/: a hard
+    link renamed into place, so the cache never sees a partial file. A name
+    already used by a different file gets the source key's hash appended.
+
+    Returns:
+        Tuple of (cache path relative to MEDIA_ROOT, file size)
+    """
+    from .utils import link_or_copy
+
+    src = os.path.join(settings.MEDIA_ROOT, rel_path)
+    size = os.path.getsize(src)
+    if os.path.dirname(os.path.normpath(rel_path)) == 'cache':
+        return rel_path, size
+
+    name = os.path.basename(rel_path)
+    cache_path = os.path.join('cache', name)
+    dest = os.path.join(settings.MEDIA_ROOT, cache_path)
+    if os.path.exists(dest) and not os.path.samefile(src, dest):
+        stem, ext = os.path.splitext(name)
+        digest = hashlib.blake2b(source_key.encode('utf-8'), digest_size=4).hexdigest()
+        cache_path = os.path.join('cache', f"{stem} {digest}{ext}")
+        dest = os.path.join(settings.MEDIA_ROOT, cache_path)
+        if os.path.exists(dest) and not os.path.samefile(src, dest):
+            # An older download of this same track
+            os.remove(dest)
+    link_or_copy(src, dest)
+    return cache_path, size
+
+
+def unlink_blobs(cache_paths):
+    """Remove cache/ files that no SongCache row or Song uses (after a failed ingest)"""
+    from .models import Song, SongCache
+
+    cache_paths = set(cache_paths)
+    in_use = set(SongCache.objects.filter(file_path__in=cache_paths).values_list('file_path', flat=True))
+    in_use |= set(Song.objects.filter(file__in=cache_paths).values_list('file', flat=True))
+    for cache_path in cache_paths - in_use:
+        try:
+            os.remove(os.path.join(settings.MEDIA_ROOT, cache_path))
+        except OSError:
+            pass
+
+
+def incr_counter(key, delta=1, timeout=None):
+    """
+    Atomically add delta to a counter in the shared cache, creating it with
+    timeout if needed.
+
+    Returns:
+        The counter's new value
+    """
+    return _incr(key, delta, timeout)
+
+
+def record_warmed(file_size):
+    """Count an entry prefetched by the cache warmer"""
+    _record_stats(warmed=1, bytes_warmed=file_size)
+
+
+def record_downloads(completed, cacheable):
+    """Count completed downloads and how many of them became cache entries"""
+    _record_stats(downloads=completed, cacheable=cacheable)
+
+
+def stats():
+    """
+    Cache effectiveness since the counters were last reset.
+
+    Returns:
+        Dict with the raw counters plus hit_ratio, byte_hit_ratio,
+        warmed_hit_ratio (the part of hit_ratio served by prefetched entries),
+        cacheable_ratio (completed downloads that became cache entries),
+        used_bytes, max_bytes and policy
+    """
+    values = cache.get_many([STATS_KEY.format(name) for name in STAT_NAMES])
+    result = {name: values.get(STATS_KEY.format(name), 0) for name in STAT_NAMES}
+    result['hit_ratio'] = round(result['hits'] / result['lookups'], 4) if result['lookups'] else 0.0
+    result['byte_hit_ratio'] = round(result['bytes_hit'] / result['bytes_requested'], 4) if result['bytes_requested'] else 0.0
+    result['warmed_hit_ratio'] = round(result['warmed_hits'] / result['lookups'], 4) if result['lookups'] else 0.0
+    result['cacheable_ratio'] = round(result['cacheable'] / result['downloads'], 4) if result['downloads'] else 0.0
+    result['used_bytes'] = used_bytes()
+    result['max_bytes'] = settings.SONG_CACHE_MAX_BYTES
+    result['policy'] = _policy()
+    return result
+
+
+def reset_stats():
+    cache.delete_many([STATS_KEY.format(name) for name in STAT_NAMES])
@@ -0,0 +1,241 @@
+import os
+import logging
+from collections import Counter
+from datetime import timedelta
+from celery.schedules import crontab
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+
+from .cache_manager import incr_counter, record_warmed, used_bytes
+
+logger = logging.getLogger(__name__)
+
+# Bytes downloaded and upstream calls made by the warmer, per clock hour
+BUDGET_KEY = 'song_cache:warm:{}:{}'
+# Set while a track is queued for warming, so overlapping runs don't queue it twice
+QUEUED_KEY = 'song_cache:warm:queued:{}'
+
+
+def is_off_peak(now=None):
+    """Whether now (local time) falls in SONG_CACHE_WARM_HOURS"""
+    now = timezone.localtime(now)
+    return now.hour in crontab(hour=settings.SONG_CACHE_WARM_HOURS).hour
+
+
+def _budget_key(kind, now=None):
+    return BUDGET_KEY.format(kind, timezone.localtime(now).strftime('%Y%m%d%H'))
+
+
+def remaining_budget(now=None):
+    """
+    What the warmer may still spend this hour.
+
+    Returns:
+        Tuple of (bytes, upstream calls) left
+    """
+    spent = cache.get_many([_budget_key('bytes', now), _budget_key('calls', now)])
+    return (
+        settings.SONG_CACHE_WARM_MAX_BYTES_PER_HOUR - spent.get(_budget_key('bytes', now), 0),
+        settings.SONG_CACHE_WARM_MAX_CALLS_PER_HOUR - spent.get(_budget_key('calls', now), 0),
+    )
+
+
+def _spend(kind, amount):
+    """Charge amount to this hour's budget; returns the hour's total"""
+    return incr_counter(_budget_key(kind), amount, timeout=2 * 3600)
+
+
+def _spotify_url(spotify_id):
+    return f"https://open.spotify.com/track/{spotify_id}"
+
+
+def trending_urls(since):
+    """
+    Tracks downloaded most since the given time, from download jobs and the
+    songs users saved. URL spellings of one track are counted together.
+
+    Returns:
+        Counter of canonical key -> downloads, and a dict of canonical key -> the
+        URL most often used for it
+    """
+    from .models import DownloadJob, Song
+    from .utils import canonical_key
+
+    spellings = Counter()
+    for queryset, field in ((DownloadJob.objects, 'url'), (Song.objects, 'song_url')):
+        rows = (
+            queryset.filter(created_at__gte=since)
+            .exclude(**{f'{field}__isnull': True}).exclude(**{field: ''})
+            .values(field).annotate(n=Count('id'))
+        )
+        for row in rows:
+            spellings[row[field]] += row['n']
+
+    counts = Counter()
+    urls = {}
+    for url, n in spellings.most_common():
+        key = canonical_key(url)
+        counts[key] += n
+        # most_common() is ordered, so the first spelling seen is the most used
+        urls.setdefault(key, url)
+    return counts, urls
+
+
+def recommended_urls(per_user):
+    """
+    The top per_user entries of every user's cached recommendations.
+
+    Returns:
+        Counter of canonical key -> users it is recommended to, and a dict of
+        canonical key -> Spotify URL
+    """
+    from .models import UserMusicProfile
+
+    counts = Counter()
+    urls = {}
+    profiles = UserMusicProfile.objects.exclude(cached_recommendations__isnull=True)
+    for recommendations in profiles.values_list('cached_recommendations', flat=True).iterator():
+        if not isinstance(recommendations, list):
+            continue
+        for rec in recommendations[:per_user]:
+            spotify_id = rec.get('spotify_id') if isinstance(rec, dict) else None
+            if spotify_id:
+                key = f"spotify:{spotify_id}"
+                counts[key] += 1
+                urls.setdefault(key, _spotify_url(spotify_id))
+    return counts, urls
+
+
+def candidates(limit=None, now=None):
+    """
+    Tracks worth prefetching, most wanted first: trending downloads over the
+    last SONG_CACHE_WARM_WINDOW_HOURS plus users' top recommendations, minus
+    what the cache already holds.
+
+    Returns:
+        List of song URLs
+    """
+    from .models import SongCache
+
+    now = now or timezone.now()
+    limit = limit or settings.SONG_CACHE_WARM_MAX_TRACKS
+    counts, urls = trending_urls(now - timedelta(hours=settings.SONG_CACHE_WARM_WINDOW_HOURS))
+    rec_counts, rec_urls = recommended_urls(settings.SONG_CACHE_WARM_RECOMMENDATIONS)
+    counts.update(rec_counts)
+    for key, url in rec_urls.items():
+        urls.setdefault(key, url)
+
+    ranked = [urls[key] for key, _ in counts.most_common() if key]
+    # Checked directly rather than with get_cached_songs, which would count as lookups
+    cached = set()
+    for i in range(0, len(ranked), 500):
+        cached.update(SongCache.objects.filter(
+            song_url__in=ranked[i:i + 500], expires_at__gt=now
+        ).values_list('song_url', flat=True))
+    return [url for url in ranked if url not in cached][:limit]
+
+
+def plan(now=None):
+    """
+    Pick the tracks to warm this run, within what is left of the hour's call
+    budget, and mark them queued.
+
+    Returns:
+        List of song URLs to hand to warm_track
+    """
+    from .utils import canonical_key
+
+    _, calls_left = remaining_budget(now)
+    if calls_left <= 0:
+        logger.info("Cache warming: upstream call budget for this hour is spent")
+        return []
+    queued = []
+    for url in candidates(limit=min(settings.SONG_CACHE_WARM_MAX_TRACKS, calls_left), now=now):
+        if cache.add(QUEUED_KEY.format(canonical_key(url)), 1, 3600):
+            queued.append(url)
+    return queued
+
+
+def _has_room(bytes_left):
+    """Warming only uses free space below the eviction target, so it never evicts demand-filled entries"""
+    target = settings.SONG_CACHE_MAX_BYTES * settings.SONG_CACHE_EVICT_TO
+    return bytes_left > 0 and used_bytes() < target
+
+
+def warm_track(url):
+    """
+    Download one track into the SongCache (no Song is created). Skipped when
+    outside off-peak hours, over this hour's budgets, or already cached.
+
+    Returns:
+        'warmed', 'cached', 'skipped', 'rejected' (not cached, e.g. by admission) or 'failed'
+    """
+    from .download_helper import download_track_file
+    from .models import Song, SongCache
+    from .utils import canonical_key
+
+    try:
+        if SongCache.objects.filter(song_url=url, expires_at__gt=timezone.now()).exists():
+            return 'cached'
+        bytes_left, calls_left = remaining_budget()
+        if not is_off_peak() or calls_left <= 0 or not _has_room(bytes_left):
+            return 'skipped'
+
+        # A Spotify track costs a metadata lookup as well as the YouTube download
+        calls = 2 if canonical_key(url).startswith('spotify:') else 1
+        if _spend('calls', calls) > settings.SONG_CACHE_WARM_MAX_CALLS_PER_HOUR:
+            return 'skipped'
+
+        payload = download_track_file(url)
+        if not payload:
+            return 'failed'
+
+        metadata = dict(payload['metadata'], warmed_at=timezone.localtime().isoformat())
+        entry = SongCache.ingest(url, payload['rel_path'], metadata)
+
+        # The pipeline published the file to media/songs; only the cache's link is wanted
+        media_path = os.path.join(settings.MEDIA_ROOT, payload['rel_path'])
+        file_size = os.path.getsize(media_path) if os.path.exists(media_path) else 0
+        if not Song.objects.filter(file=payload['rel_path']).exists():
+            try:
+                os.remove(media_path)
+            except OSError:
+                pass
+
+        _spend('bytes', file_size)
+        if entry is None:
+            return 'rejected'
+        record_warmed(entry.file_size)
+        logger.info(f"Cache warming: prefetched {url} ({entry.file_size} bytes)")
+        return 'warmed'
+    except Exception as e:
+        logger.warning(f"Cache warming failed for {url}: {e}")
+        return 'failed'
+    finally:
+        cache.delete(QUEUED_KEY.format(canonical_key(url)))
+
+
+def warm_report(day=None):
+    """
+    How the entries warmed on day (yesterday by default) have been used since.
+    Hit counts are as of the last flush_cache_accesses run; reading the report
+    doesn't flush the access buffer.
+
+    Returns:
+        Dict with date, warmed, used (entries hit at least once), hits and bytes
+    """
+    from django.db.models import Sum
+    from .models import SongCache
+
+    day = day or timezone.localdate() - timedelta(days=1)
+    entries = SongCache.objects.filter(metadata__warmed_at__startswith=day.isoformat())
+    totals = entries.aggregate(hits=Sum('hit_count'), bytes=Sum('file_size'))
+    return {
+        'date': day.isoformat(),
+        'warmed': entries.count(),
+        'used': entries.filter(hit_count__gt=0).count(),
+        'hits': totals['hits'] or 0,
+        'bytes': totals['bytes'] or 0,
+    }
@@ -0,0 +1,248 @@
+import os
+import re
+import time
+import shutil
+import hashlib
+import logging
+from io import BytesIO
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Set for a while after artwork couldn't be fetched, so each song tagged with it doesn't try again
+FAILED_KEY = 'cover_art:failed:{}'
+# Held by the worker fetching an artwork, so concurrent taggers wait for it instead of fetching too
+FETCHING_KEY = 'cover_art:fetching:{}'
+
+# YouTube serves the same video's thumbnail under several hosts and qualities
+YOUTUBE_THUMBNAIL_RE = re.compile(r'(?:img\.youtube\.com|i\.ytimg\.com)/vi(?:_webp)?/([\w-]{11})/')
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
+}
+
+
+def cover_key(thumbnail_url=None, youtube_id=None):
+    """
+    Store key of a track's artwork: youtube:<video id> for YouTube thumbnails
+    (whatever host or quality the URL names), otherwise the thumbnail URL itself,
+    so every song and user with the same Spotify album art shares one entry.
+
+    Returns:
+        The key, or None if there is nothing to fetch
+    """
+    if thumbnail_url:
+        match = YOUTUBE_THUMBNAIL_RE.search(thumbnail_url)
+        if match:
+            return f"youtube:{match.group(1)}"
+        return f"url:{thumbnail_url}"
+    if youtube_id:
+        return f"youtube:{youtube_id}"
+    return None
+
+
+def _key_hash(key):
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def cover_rel_path(key, size='large'):
+    """Path of one size of an artwork, relative to MEDIA_ROOT"""
+    digest = _key_hash(key)
+    return f"{settings.COVER_ART_DIR}/{digest[:2]}/{digest}-{size}.jpg"
+
+
+def cover_path(key, size='large'):
+    return os.path.join(settings.MEDIA_ROOT, *cover_rel_path(key, size).split('/'))
+
+
+def _source_urls(key, thumbnail_url):
+    """URLs to try for key, best first"""
+    if key.startswith('youtube:'):
+        video_id = key.split(':', 1)[1]
+        urls = [f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg",
+                f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"]
+        if thumbnail_url and thumbnail_url not in urls:
+            urls.append(thumbnail_url)
+        return urls
+    return [thumbnail_url]
+
+
+def _download(url):
+    """Image bytes from a /media/ path or a remote URL, or None"""
+    import requests
+
+    if url.startswith('/media/'):
+        path = os.path.join(settings.MEDIA_ROOT, url.replace('/media/', '', 1))
+        if not os.path.exists(path):
+            logger.warning(f"Thumbnail file not found: {path}")
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    try:
+        response = requests.get(url, timeout=10, headers=HEADERS)
+        # YouTube answers a missing maxres thumbnail with a tiny grey placeholder
+        min_bytes = 1000 if YOUTUBE_THUMBNAIL_RE.search(url) else 1
+        if response.status_code == 200 and len(response.content) >= min_bytes:
+            return response.content
+        logger.info(f"No usable thumbnail at {url} (HTTP {response.status_code}, {len(response.content)} bytes)")
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Failed to download thumbnail from {url}: {e}")
+    return None
+
+
+def _ffmpeg_to_jpeg(image_data):
+    """
+    Transcode an image Pillow can't decode to JPEG with ffmpeg, through pipes.
+
+    Returns:
+        JPEG bytes, or None
+    """
+    from . import ffmpeg
+
+    try:
+        result = ffmpeg.run(['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', '-frames:v', '1',
+                             '-f', 'image2pipe', '-c:v', 'mjpeg', '-q:v', '2', '-pix_fmt', 'yuvj420p', 'pipe:1'],
+                            input=image_data, check=False)
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+        logger.warning(f"FFmpeg image conversion failed: {result.stderr[-200:]!r}")
+    except Exception as e:
+        logger.warning(f"FFmpeg image conversion failed: {e}")
+    return None
+
+
+def _decode(image_data):
+    """
+    Decode an image to RGB no larger than needed for the biggest variant.
+    For JPEGs, draft() has libjpeg scale down by a power of two while decoding,
+    so a 3000px source is never fully decoded just to make a 500px cover.
+
+    Raises:
+        PIL.UnidentifiedImageError or OSError: If Pillow can't decode the data
+    """
+    from PIL import Image
+
+    max_edge = max(settings.COVER_ART_SIZES.values())
+    img = Image.open(BytesIO(image_data))
+    img.draft('RGB', (max_edge, max_edge))
+    img.load()
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
+def render(image_data):
+    """
+    Make the stored JPEG variants of an image, entirely in memory: one decode,
+    then each variant is downscaled from the previous (larger) one and encoded.
+    ffmpeg is only used for images Pillow can't decode at all.
+
+    Returns:
+        Dict of size name (see COVER_ART_SIZES) -> JPEG bytes; empty if the image can't be read
+    """
+    try:
+        img = _decode(image_data)
+    except Exception as e:
+        logger.warning(f"Pillow can't decode image ({e}), trying ffmpeg")
+        jpeg = _ffmpeg_to_jpeg(image_data)
+        if not jpeg:
+            return {}
+        try:
+            img = _decode(jpeg)
+        except Exception as e:
+            logger.warning(f"Could not decode ffmpeg output: {e}")
+            return {}
+
+    variants = {}
+    for name, max_edge in sorted(settings.COVER_ART_SIZES.items(), key=lambda item: -item[1]):
+        # thumbnail() only ever shrinks, in place, so each size starts from the last
+        img.thumbnail((max_edge, max_edge))
+        out = BytesIO()
+        img.save(out, format='JPEG', quality=settings.COVER_ART_JPEG_QUALITY)
+        variants[name] = out.getvalue()
+    return variants
+
+
+def _publish(key, variants):
+    """Write every variant of an artwork into the store atomically"""
+    from .utils import make_staging_dir, publish_file
+
+    staging_dir = make_staging_dir()
+    try:
+        for name, data in variants.items():
+            part_path = os.path.join(staging_dir, name)
+            with open(part_path, 'wb') as f:
+                f.write(data)
+            publish_file(part_path, cover_path(key, name))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _read(key, size):
+    try:
+        with open(cover_path(key, size), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def fetch_cover(key, thumbnail_url=None):
+    """
+    Download an artwork, render its variants and add them to the store.
+
+    Returns:
+        Dict of size name -> JPEG bytes, or None if no source gave a usable image
+    """
+    for url in _source_urls(key, thumbnail_url):
+        image_data = _download(url)
+        if not image_data:
+            continue
+        variants = render(image_data)
+        if variants:
+            _publish(key, variants)
+            logger.info(f"Stored cover art {key} from {url}")
+            return variants
+    cache.set(FAILED_KEY.format(_key_hash(key)), 1, settings.COVER_ART_FAILURE_TTL)
+    return None
+
+
+def get_cover(thumbnail_url=None, youtube_id=None, size='large'):
+    """
+    Processed cover art for a track, from the store, fetching it on first use.
+    Artwork is fetched once and then shared by every song and user with it.
+
+    Args:
+        thumbnail_url: The track's thumbnail URL (remote or /media/...)
+        youtube_id: YouTube video id, used when there is no thumbnail URL
+        size: A COVER_ART_SIZES name
+
+    Returns:
+        JPEG bytes, or None if there is no artwork
+    """
+    key = cover_key(thumbnail_url, youtube_id)
+    if not key:
+        return None
+    data = _read(key, size)
+    if data is not None:
+        return data
+
+    failed_key = FAILED_KEY.format(_key_hash(key))
+    if cache.get(failed_key):
+        return None
+
+    lock_key = FETCHING_KEY.format(_key_hash(key))
+    locked = cache.add(lock_key, 1, settings.COVER_ART_FETCH_WAIT + 30)
+    if not locked:
+        # Someone else is fetching it; use their result once it lands
+        deadline = time.monotonic() + settings.COVER_ART_FETCH_WAIT
+        while time.monotonic() < deadline and cache.get(lock_key):
+            time.sleep(0.2)
+        data = _read(key, size)
+        if data is not None or cache.get(failed_key):
+            return data
+    try:
+        variants = fetch_cover(key, thumbnail_url)
+        return variants.get(size) if variants else None
+    finally:
+        if locked:
+            cache.delete(lock_key)
@@ -0,0 +1,250 @@
+import os
+import re
+import logging
+import mimetypes
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, content_disposition_header
+from django.conf import settings
+
+from .utils import content_hash
+
+logger = logging.getLogger(__name__)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def file_etag(path):
+    """Strong ETag for a file, derived from its content hash"""
+    return f'"{content_hash(path)}"'
+
+
+def _etag_matches(header, etag):
+    """Weak comparison used for If-None-Match: W/ prefixes are ignored"""
+    if header.strip() == '*':
+        return True
+    strip_weak = lambda tag: tag[2:] if tag.startswith('W/') else tag
+    return strip_weak(etag) in {strip_weak(tag) for tag in parse_etags(header)}
+
+
+def _not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2)
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+def _range_applies(request, etag, mtime):
+    """Check If-Range: a range is only served if the client's copy is still current"""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        # Strong comparison; weak tags never match
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(mtime)
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range Range header against a file of size bytes.
+
+    Returns:
+        (start, end) inclusive byte positions, None if the header should be
+        ignored (malformed, or several ranges) or 'unsatisfiable'
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        # Multiple ranges aren't supported; a full 200 response is valid for them
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        return 'unsatisfiable'
+    end = int(end) if end else size - 1
+    return start, min(end, size - 1)
+
+
+class _FileRange:
+    """
+    File-like view of length bytes of an open file, starting at its current offset.
+    It exposes fileno() but not tell()/seek(), so FileResponse leaves Content-Length
+    to us and a WSGI server whose wsgi.file_wrapper uses os.sendfile (gunicorn)
+    sends exactly Content-Length bytes from the current offset without copying
+    them through Python. Other servers read it in chunks.
+    """
+
+    def __init__(self, f, length):
+        self._file = f
+        self._remaining = length
+
+    def read(self, size=-1):
+        if self._remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+
+def _offload_response(path, filename, content_type, as_attachment):
+    """
+    Headers-only response telling the front-end server to send the file, or None
+    if the python backend is configured or the file is outside MEDIA_ROOT.
+    The front-end server then handles Range requests itself.
+    """
+    from urllib.parse import quote
+    from django.core.exceptions import ImproperlyConfigured
+
+    backend = settings.MEDIA_DELIVERY_BACKEND
+    if backend == 'python':
+        return None
+    if backend not in ('nginx', 'apache'):
+        raise ImproperlyConfigured(f"Unknown MEDIA_DELIVERY_BACKEND: {backend}")
+
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    real_path = os.path.realpath(path)
+    if not real_path.startswith(media_root + os.sep):
+        return None
+
+    response = HttpResponse(content_type=content_type)
+    if backend == 'nginx':
+        rel_path = os.path.relpath(real_path, media_root).replace(os.sep, '/')
+        response['X-Accel-Redirect'] = quote(f"{settings.MEDIA_ACCEL_REDIRECT_LOCATION.rstrip('/')}/{rel_path}")
+    else:
+        response['X-Sendfile'] = real_path
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    return response
+
+
+def serve_file(request, path, filename=None, content_type=None, as_attachment=True, etag=None):
+    """
+    Serve a stored file with validators and byte-range support.
+
+    Every response carries a strong ETag (content hash), Last-Modified and
+    Accept-Ranges. For GET/HEAD, a matching If-None-Match/If-Modified-Since gives
+    a 304 and a single-range Range header gives a 206 with just those bytes
+    (subject to If-Range). Unsatisfiable ranges get a 416.
+
+    With MEDIA_DELIVERY_BACKEND set to nginx or apache, files under MEDIA_ROOT are
+    handed to the front-end server (X-Accel-Redirect / X-Sendfile) and Django
+    only sends headers.
+
+    Args:
+        request: The incoming request, or None to skip conditional handling
+        path: Absolute path of the file
+        filename: Download filename, defaults to the file's name
+        content_type: Defaults to a guess from the filename
+        as_attachment: Send Content-Disposition: attachment rather than inline
+        etag: Strong ETag to use instead of hashing the file, for files whose
+            content is already identified by their name
+
+    Returns:
+        HttpResponse subclass
+    """
+    from .storage import media_rel_path, record_access
+
+    stat = os.stat(path)
+    size = stat.st_size
+    filename = filename or os.path.basename(path)
+    record_access(media_rel_path(path))
+    content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    etag = etag or file_etag(path)
+    last_modified = http_date(stat.st_mtime)
+
+    conditional = request is not None and request.method in ('GET', 'HEAD')
+    if conditional and _not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
+
+    response = _offload_response(path, filename, content_type, as_attachment)
+    byte_range = None
+    if response is None and conditional:
+        range_header = request.META.get('HTTP_RANGE')
+        if range_header and _range_applies(request, etag, stat.st_mtime):
+            byte_range = parse_range(range_header, size)
+
+    if response is not None:
+        pass
+    elif byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        f = open(path, 'rb')
+        f.seek(start)
+        response = FileResponse(_FileRange(f, length), status=206, as_attachment=as_attachment, filename=filename)
+        response['Content-Type'] = content_type
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    else:
+        response = FileResponse(open(path, 'rb'), as_attachment=as_attachment, filename=filename)
+        response['Content-Type'] = content_type
+
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def serve_cold_file(rel_path, filename=None, content_type=None, as_attachment=True):
+    """
+    Stream a file that only exists in the cold storage tier, reading ahead of
+    the client. Ranges and validators aren't offered, since answering them would
+    mean fetching the file first; the next rebalance brings popular files back
+    to local disk, where serve_file handles them.
+
+    Returns:
+        StreamingHttpResponse, or None if the cold tier doesn't have the file either
+    """
+    from django.http import StreamingHttpResponse
+    from .storage import open_cold
+
+    opened = open_cold(rel_path)
+    if opened is None:
+        return None
+    reader, size = opened
+    filename = filename or os.path.basename(rel_path)
+    response = StreamingHttpResponse(reader, content_type=content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response['Content-Length'] = str(size)
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    return response
+
+
+def serve_media_file(request, path, filename=None, content_type=None, as_attachment=True):
+    """
+    Serve a MEDIA_ROOT file from whichever storage tier holds it: local files
+    through serve_file, demoted ones streamed from the cold tier.
+
+    Returns:
+        The response, or None if neither tier has the file
+    """
+    from .storage import media_rel_path
+
+    if os.path.isfile(path):
+        return serve_file(request, path, filename, content_type, as_attachment)
+    rel_path = media_rel_path(path)
+    return serve_cold_file(rel_path, filename, content_type, as_attachment) if rel_path else None
@@ -1,26 +1,30 @@
 import os
 import logging
 import time
-import tempfile
 import shutil
 import requests
 import json
 import yt_dlp
 from django.conf import settings
-from django.http import FileResponse
-from django.utils import timezone
-from datetime import timedelta
+from django.http import StreamingHttpResponse
+from django.utils.text import Truncator
 from rest_framework import status
 from rest_framework.response import Response
-import concurrent.futures # Added
-import threading # Added
 
-from .models import Song, SongCache, UserMusicProfile, UserAnalytics, Playlist, DownloadProgress
+from .models import (
+    Song, SongCache, UserMusicProfile, UserAnalytics, Playlist, DownloadProgress, DownloadJob, SpotifyMatch,
+    MediaFileIndex
+)
 from .utils import (
     youtube_api_retry, spotify_api_retry, download_from_youtube, 
-    convert_audio_format, sanitize_filename, embed_metadata,
-    download_youtube_util
+    get_transcoded_file, get_cached_transcode, stream_transcoded_file,
+    sanitize_filename, embed_metadata,
+    download_youtube_util, SpotifyAPIError, ExternalAPIError, SourceUnavailableError,
+    check_source, source_guard, classify_source_error, make_staging_dir, publish_file
 )
+from .ffmpeg import FFmpegBusy
+from .delivery import serve_file
+from .storage import ensure_local, tiered_storage
 from .spotify_api import extract_spotify_id, get_track_info, get_playlist_info, get_playlist_tracks
 
 logger = logging.getLogger(__name__)
@@ -49,57 +53,134 @@ def sanitize_for_db(text, max_length=95):
         
     return sanitized.strip()
 
-@youtube_api_retry
-def download_youtube(request, url, output_format=None):
-    """Direct YouTube download with streaming response"""
+def _report_progress(progress, percent, stage):
+    """Forward a progress update to an optional callback without failing the download"""
+    if not progress:
+        return
+    try:
+        progress(percent, stage)
+    except Exception as progress_error:
+        logger.warning(f"Error reporting download progress: {progress_error}")
+
+def build_download_response(result, request=None):
+    """
+    Build the attachment response for a track returned by fetch_youtube_track
+    or fetch_spotify_track. With a request, Range and conditional headers are honoured.
+    """
+    response = serve_file(request, result['path'], result['filename'], result['content_type'])
+    if response.status_code in (200, 206):
+        # Explicitly set Content-Disposition header with filename
+        response['Content-Disposition'] = f'attachment; filename="{result["filename"]}"'
+    # Add song metadata headers
+    response['x-song-title'] = result['title']
+    response['x-song-artist'] = result['artist']
+    if result.get('album'):
+        response['x-album-name'] = result['album']
+    if result.get('thumbnail_url'):
+        response['x-cover-url'] = result['thumbnail_url']
+    return response
+
+def build_transcode_response(request, source_path, output_format, filename, song=None):
+    """
+    Build the attachment response for source_path in another format.
+    An already transcoded variant is served from disk. Otherwise, with
+    TRANSCODE_STREAMING on, ffmpeg's output is streamed to the client as it is
+    produced (and cached on the way) instead of waiting for the whole file.
+
+    Args:
+        request: The incoming request, for Range and conditional headers on cached variants
+        source_path: Absolute path of the stored audio file
+        output_format: Requested format
+        filename: Attachment filename
+        song: Optional Song whose metadata is added as x-* headers
+    """
+    content_type = f'audio/{output_format}'
+    cached_path = get_cached_transcode(source_path, output_format)
+    if cached_path:
+        response = serve_file(request, cached_path, filename, content_type)
+    elif settings.TRANSCODE_STREAMING:
+        logger.info(f"Streaming {output_format} transcode of {source_path}")
+        try:
+            chunks = stream_transcoded_file(source_path, output_format)
+        except FFmpegBusy:
+            response = Response(
+                {'error': 'Server is busy converting other files, please retry shortly'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+            response['Retry-After'] = '10'
+            return response
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    else:
+        converted_path = get_transcoded_file(source_path, output_format)
+        response = serve_file(request, converted_path, filename, content_type)
+
+    if song:
+        # Add song metadata headers
+        response['x-song-title'] = song.title
+        response['x-song-artist'] = song.artist
+        if song.album:
+            response['x-album-name'] = song.album
+        if song.thumbnail_url:
+            response['x-cover-url'] = song.thumbnail_url
+    return response
+
+def fetch_youtube_track(user, url, output_format=None, progress=None):
+    """
+    Fetch a YouTube track for a user, using the song cache when possible.
+
+    Runs the Hugging Face download, format conversion, metadata embedding and
+    DB writes, but builds no HTTP response so it can be called from a request
+    thread or from a Celery worker.
+
+    Args:
+        user: The user the download is recorded against
+        url (str): YouTube video URL
+        output_format (str, optional): Requested audio format
+        progress (callable, optional): Called as progress(percent, stage)
+
+    Returns:
+        dict: path, filename, content_type, title, artist, album, thumbnail_url and song_id
+    """
     # Initialize variables for file cleanup
     temp_dir = None
-    
+
     try:
-        # Check if this is a playlist URL
-        if 'playlist' in url or 'list=' in url:
-            # Redirect to the async playlist download
-            from .tasks import download_youtube_playlist
-            task = download_youtube_playlist.delay(url, request.user.id)
-            return Response({
-                'message': 'Playlist download initiated',
-                'task_id': task.id,
-                'status': 'processing'
-            }, status=status.HTTP_202_ACCEPTED)
-            
+        _report_progress(progress, 5, 'Checking cache')
+
         # Check if the song is in cache
         cached_song = SongCache.get_cached_song(url)
-        if (cached_song):
+        # The cached file is tagged and transcoded below, so a demoted one is copied back first
+        cached_file_path = ensure_local(os.path.join(settings.MEDIA_ROOT, cached_song.file_path)) if cached_song else None
+        if cached_song and not cached_file_path:
+            logger.warning(f"File not found for cached song {url}, will redownload")
+        if cached_file_path:
             logger.info(f"Using cached version for URL: {url}")
             # Record download in analytics for cached song
             try:
-                UserAnalytics.record_download(request.user)
+                UserAnalytics.record_download(user)
             except Exception as analytics_error:
                 logger.warning(f"Error recording download in analytics: {analytics_error}")
-            # Get the cached file path
-            cached_file_path = os.path.join(settings.MEDIA_ROOT, cached_song.local_path.name if hasattr(cached_song, 'local_path') else cached_song.file_path)
-            
             # Get metadata from cache
             metadata = cached_song.metadata or {}
             title = metadata.get('title', 'Unknown Title')
             artist = metadata.get('artist', 'Unknown Artist')
             album = metadata.get('album', 'Unknown Album')
-            
-            # Check if we need format conversion
-            if output_format != 'mp3' and os.path.splitext(cached_file_path)[1][1:] != output_format:
-                # Convert the format
-                logger.info(f"Converting cached song from {os.path.splitext(cached_file_path)[1][1:]} to {output_format}")
-                final_filename = convert_audio_format(cached_file_path, output_format)
-            else:
-                final_filename = cached_file_path
-                
+
+            final_filename = cached_file_path
+
+            song_id = None
             # Create a song entry for this user if they don't already have it
-            if not Song.objects.filter(user=request.user, song_url=url).exists():
+            existing_song = Song.objects.filter(user=user, song_url=url).first()
+            if existing_song:
+                song_id = existing_song.id
+            else:
                 # Create the song record
-                rel_path = os.path.relpath(final_filename, settings.MEDIA_ROOT)
-                rel_path = sanitize_filename(rel_path, max_length=95)
-                
+                # The cached file's own path; its name was sanitized when it was stored
+                rel_path = cached_song.file_path
+
                 # Embed metadata including thumbnail into the MP3 file
+                _report_progress(progress, 70, 'Embedding metadata')
                 embed_metadata(
                     mp3_path=final_filename,
                     title=title,
@@ -110,9 +191,10 @@ def download_youtube(request, url, output_format=None):
                     album_artist=metadata.get('channel', metadata.get('artist', 'Unknown Artist')),
                     youtube_id=metadata.get('id')
                 )
-                
+
+                _report_progress(progress, 90, 'Saving')
                 song = Song.objects.create(
-                    user=request.user,
+                    user=user,
                     title=sanitize_for_db(title),
                     artist=sanitize_for_db(artist),
                     album=sanitize_for_db(album),
@@ -121,81 +203,69 @@ def download_youtube(request, url, output_format=None):
                     thumbnail_url=sanitize_for_db(metadata.get('thumbnail_url', ''), max_length=190),
                     song_url=url
                 )
-                
+                MediaFileIndex.record_songs([song])
+                song_id = song.id
+
                 # Update user's music profile
                 try:
-                    profile, created = UserMusicProfile.objects.get_or_create(user=request.user)
+                    profile, created = UserMusicProfile.objects.get_or_create(user=user)
                     profile.update_profile(song)
                 except Exception as profile_error:
                     logger.warning(f"Error updating user profile: {profile_error}")
-                
+
                 # Increment download count
-                request.user.increment_download_count()
-                
+                user.increment_download_count()
+
                 # Record download in analytics
                 try:
-                    UserAnalytics.record_download(request.user)
+                    UserAnalytics.record_download(user)
                 except Exception as analytics_error:
                     logger.warning(f"Error recording download in analytics: {analytics_error}")
-            
-            # Serve the file - We'll use Django's FileResponse which manages closing the file
+
+            # Serve another format from the transcode cache; the song keeps the cached source
+            if output_format and output_format != 'mp3' and os.path.splitext(cached_file_path)[1][1:] != output_format:
+                logger.info(f"Converting cached song from {os.path.splitext(cached_file_path)[1][1:]} to {output_format}")
+                _report_progress(progress, 95, 'Converting')
+                final_filename = get_transcoded_file(cached_file_path, output_format)
+
             formatted_filename = f"{title} - {artist}.{output_format or 'mp3'}"
             formatted_filename = sanitize_filename(formatted_filename)
-            
-            # Important: Let Django's FileResponse manage the file handle
-            response = FileResponse(
-                open(final_filename, 'rb'),
-                as_attachment=True,
-                filename=formatted_filename
-            )
-            response['Content-Type'] = f'audio/{output_format or "mp3"}'
-            # Add song metadata headers
-            response['x-song-title'] = title
-            response['x-song-artist'] = artist
-            if album:
-                response['x-album-name'] = album
-            if metadata.get('thumbnail_url'):
-                response['x-cover-url'] = metadata.get('thumbnail_url')
-            response['Content-Disposition'] = f'attachment; filename="{formatted_filename}"'
-            return response
-        
+
+            return {
+                'path': final_filename,
+                'filename': formatted_filename,
+                'content_type': f'audio/{output_format or "mp3"}',
+                'title': title,
+                'artist': artist,
+                'album': album,
+                'thumbnail_url': metadata.get('thumbnail_url'),
+                'song_id': song_id,
+            }
+
         # If not in cache, proceed with downloading
-        # Create temp directory for download
-        temp_dir = tempfile.mkdtemp()
-        
+        # Stage the download on the media volume so finishing it is a rename
+        temp_dir = make_staging_dir()
+
         # CHANGED: Use Hugging Face Spaces API instead of direct yt-dlp download
-        info = download_from_huggingface(url, temp_dir)
-        
-        # The downloaded file should already be an mp3
-        temp_mp3_filename = info['filepath']
-        
-        # Convert to requested format if different from mp3
-        if output_format and output_format != 'mp3':
-            final_filename = convert_audio_format(temp_mp3_filename, output_format)
-        else:
-            final_filename = temp_mp3_filename
-        
+        _report_progress(progress, 10, 'Downloading')
+        with source_guard(url):
+            info = download_from_huggingface(url, temp_dir)
+
+        # The downloaded file is an mp3; the song and the cache keep it, and other
+        # formats are made from it by the transcode cache
+        mp3_filename = info['filepath']
+
         # Get thumbnail URL from info
         thumbnail_url = info.get('thumbnail')
-        
+
         # Create destination paths
-        formatted_filename = f"{info['title']} - {info.get('artist', 'Unknown Artist')}.{output_format or 'mp3'}"
+        formatted_filename = f"{info['title']} - {info.get('artist', 'Unknown Artist')}.mp3"
         formatted_filename = sanitize_filename(formatted_filename)
-        
-        # Copy to media directory
-        media_dir = os.path.join(settings.MEDIA_ROOT, 'songs')
-        os.makedirs(media_dir, exist_ok=True)
-        media_path = os.path.join(media_dir, formatted_filename)
-        
-        shutil.copy2(final_filename, media_path)
-        
-        # Create the song record
-        rel_path = os.path.join('songs', formatted_filename)
-        rel_path = sanitize_filename(rel_path, max_length=95)
-        
-        # Embed metadata including thumbnail into the MP3 file
+
+        # Embed metadata including thumbnail while the file is still staged
+        _report_progress(progress, 70, 'Embedding metadata')
         embed_metadata(
-            mp3_path=media_path,
+            mp3_path=mp3_filename,
             title=info['title'],
             artist=info.get('artist', 'Unknown Artist'),
             album=info.get('album', 'Unknown'),
@@ -204,9 +274,17 @@ def download_youtube(request, url, output_format=None):
             album_artist=info.get('artist', 'Unknown Artist'),
             youtube_id=info.get('id')
         )
-        
+
+        # Move the finished file into the media directory in one rename
+        media_path = publish_file(mp3_filename, os.path.join(settings.MEDIA_ROOT, 'songs', formatted_filename))
+
+        # Create the song record
+        # formatted_filename is already sanitized; only the directory is added
+        rel_path = f"songs/{formatted_filename}"
+
+        _report_progress(progress, 90, 'Saving')
         song = Song.objects.create(
-            user=request.user,
+            user=user,
             title=sanitize_for_db(info['title']),
             artist=sanitize_for_db(info.get('artist', 'Unknown Artist')),
             album=sanitize_for_db(info.get('album', 'Unknown')),
@@ -215,81 +293,47 @@ def download_youtube(request, url, output_format=None):
             thumbnail_url=sanitize_for_db(thumbnail_url, max_length=190) if thumbnail_url else None,
             song_url=url
         )
+        MediaFileIndex.record_songs([song])
 
         # Update user's music profile
         try:
-            profile, created = UserMusicProfile.objects.get_or_create(user=request.user)
+            profile, created = UserMusicProfile.objects.get_or_create(user=user)
             profile.update_profile(song)
         except Exception as profile_error:
             logger.warning(f"Error updating user profile: {profile_error}")
 
         # Increment download count
-        request.user.increment_download_count()
-        
+        user.increment_download_count()
+
         # Add to cache for future use
-        try:
-            cache_path = os.path.join('cache', formatted_filename)
-            cache_full_path = os.path.join(settings.MEDIA_ROOT, cache_path)
-            
-            # Make sure the cache directory exists
-            os.makedirs(os.path.dirname(cache_full_path), exist_ok=True)
-            
-            # Copy the file to the cache directory if it's not already there
-            if not os.path.exists(cache_full_path):
-                shutil.copy2(final_filename, cache_full_path)
-            
-            # Calculate file size
-            file_size = os.path.getsize(final_filename)
-            
-            # Prepare metadata
-            metadata = {
-                'title': info['title'],
-                'artist': info.get('artist', 'Unknown Artist'),
-                'album': info.get('album', 'Unknown'),
-                'thumbnail_url': thumbnail_url,
-                'source': 'youtube',
-                'id': info.get('id')
-            }
-            
-            # Create or update cache entry with metadata in the JSON field
-            SongCache.objects.update_or_create(
-                song_url=url,
-                defaults={
-                    'file_path': cache_path,
-                    'file_size': file_size,
-                    'expires_at': timezone.now() + timedelta(days=7),  # Cache for 7 days
-                    'metadata': metadata,
-                    'title': song.title,     # Store these for backward compatibility
-                    'artist': song.artist
-                }
-            )
-            logger.info(f"Added song to cache: {url}")
-        except Exception as cache_error:
-            logger.warning(f"Error adding song to cache: {cache_error}")
-            
-        # Return streaming response - serve from media directory to avoid temp cleanup issues
-        response = FileResponse(
-            open(media_path, 'rb'),
-            as_attachment=True,
-            filename=formatted_filename
-        )
-        response['Content-Type'] = f'audio/{output_format or "mp3"}'
-        # Add song metadata headers
-        response['x-song-title'] = info['title']
-        response['x-song-artist'] = info.get('artist', 'Unknown Artist')
-        response['Content-Disposition'] = f'attachment; filename="{formatted_filename}"'
-        if info.get('album'):
-            response['x-album-name'] = info.get('album')
-        if thumbnail_url:
-            response['x-cover-url'] = thumbnail_url
-        return response
-            
-    except Exception as e:
-        logger.error(f"YouTube download error: {e}", exc_info=True)
-        return Response(
-            {'error': f'Download failed: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        SongCache.ingest(url, os.path.relpath(media_path, settings.MEDIA_ROOT), {
+            'title': info['title'],
+            'artist': info.get('artist', 'Unknown Artist'),
+            'album': info.get('album', 'Unknown'),
+            'thumbnail_url': thumbnail_url,
+            'source': 'youtube',
+            'id': info.get('id')
+        })
+
+        # Check if format conversion is needed
+        if output_format and output_format != 'mp3':
+            _report_progress(progress, 90, 'Converting')
+            final_filename = get_transcoded_file(media_path, output_format)
+            formatted_filename = sanitize_filename(f"{info['title']} - {info.get('artist', 'Unknown Artist')}.{output_format}")
+        else:
+            final_filename = media_path
+
+        # Serve from media directory to avoid temp cleanup issues
+        return {
+            'path': final_filename,
+            'filename': formatted_filename,
+            'content_type': f'audio/{output_format or "mp3"}',
+            'title': info['title'],
+            'artist': info.get('artist', 'Unknown Artist'),
+            'album': info.get('album'),
+            'thumbnail_url': thumbnail_url,
+            'song_id': song.id,
+        }
     finally:
         # Clean up resources
         if temp_dir and os.path.exists(temp_dir):
@@ -298,13 +342,99 @@ def download_youtube(request, url, output_format=None):
             except:
                 pass
 
-@spotify_api_retry
-def download_spotify_track(request, url, output_format=None):
-    """Direct Spotify track download with streaming response"""
+@youtube_api_retry
+def download_youtube(request, url, output_format=None):
+    """Direct YouTube download with streaming response"""
+    try:
+        # Check if this is a playlist URL
+        if 'playlist' in url or 'list=' in url:
+            # Redirect to the async playlist download
+            from .tasks import download_youtube_playlist
+            task = download_youtube_playlist.delay(url, request.user.id)
+            return Response({
+                'message': 'Playlist download initiated',
+                'task_id': task.id,
+                'status': 'processing'
+            }, status=status.HTTP_202_ACCEPTED)
+
+        result = fetch_youtube_track(request.user, url, output_format)
+        return build_download_response(result, request)
+
+    except SourceUnavailableError as e:
+        return source_unavailable_response(e)
+    except Exception as e:
+        logger.error(f"YouTube download error: {e}", exc_info=True)
+        return Response(
+            {'error': f'Download failed: {str(e)}'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+def download_spotify_source(track_info, temp_dir):
+    """
+    Download the YouTube audio for a Spotify track via the download API.
+
+    Uses the remembered spotify_id -> youtube_id match when there is a trusted one,
+    so no search is needed. If that video turns out to be unavailable the match is
+    forgotten and the track is searched for by title and artist; other failures
+    (timeouts, throttling, upstream errors) are raised and the match is kept.
+
+    Returns:
+        dict: Info dictionary from download_from_huggingface
+    """
+    match = SpotifyMatch.lookup(track_info.get('spotify_id'))
+    if match:
+        logger.info(f"Using remembered YouTube match {match.youtube_id} for Spotify track {match.spotify_id}")
+        try:
+            info = download_from_huggingface(match.youtube_url, temp_dir, spotify_metadata=track_info)
+            info['id'] = info.get('id') or match.youtube_id
+            return info
+        except Exception as e:
+            if classify_source_error(e) != 'unavailable':
+                # Searching would hit the same outage; the match is still good
+                raise
+            logger.warning(f"Remembered match {match.youtube_id} is unavailable, searching instead: {e}")
+            SpotifyMatch.forget(match.spotify_id)
+
+    # Build a YouTube search URL that the API can use
+    query = f"{track_info['title']} {track_info['artist']}"
+    search_url = f"https://youtube.com/results?search_query={query.replace(' ', '+')}"
+    return download_from_huggingface(search_url, temp_dir, spotify_metadata=track_info)
+
+def _build_spotify_match(track_info, info):
+    """Build the SpotifyMatch for a successful download, or None if the video is unknown"""
+    return SpotifyMatch.build(
+        track_info.get('spotify_id'),
+        info.get('id'),
+        title=track_info.get('title'),
+        artist=track_info.get('artist'),
+        youtube_title=info.get('source_title')
+    )
+
+def fetch_spotify_track(user, url, output_format=None, progress=None):
+    """
+    Fetch a Spotify track for a user by resolving it to a YouTube download.
+
+    Uses the song cache when possible. Like fetch_youtube_track, this builds no
+    HTTP response so the same code serves request threads and Celery workers.
+
+    Args:
+        user: The user the download is recorded against
+        url (str): Spotify track URL
+        output_format (str, optional): Requested audio format
+        progress (callable, optional): Called as progress(percent, stage)
+
+    Returns:
+        dict: path, filename, content_type, title, artist, album, thumbnail_url and song_id
+
+    Raises:
+        ValueError: If the URL is not a valid Spotify track URL
+    """
     # Initialize variables for file cleanup
     temp_dir = None
-    
+
     try:
+        _report_progress(progress, 5, 'Checking cache')
+
         # Check if the song is in cache
         cached_song = SongCache.get_cached_song(url)
         if cached_song:
@@ -312,7 +442,7 @@ def download_spotify_track(request, url, output_format=None):
             logger.info(f"Using cached version for Spotify URL: {url}")
             # Record download in analytics for cached song
             try:
-                UserAnalytics.record_download(request.user)
+                UserAnalytics.record_download(user)
             except Exception as analytics_error:
                 logger.warning(f"Error recording download in analytics: {analytics_error}")
             # Get the cached file path
@@ -321,7 +451,7 @@ def download_spotify_track(request, url, output_format=None):
                 cached_file_path = os.path.join(settings.MEDIA_ROOT, cached_path)
             else:
                 cached_file_path = os.path.join(settings.MEDIA_ROOT, cached_path.name)
-            
+
             # Get metadata from cache
             metadata = cached_song.metadata or {}
             title = metadata.get('title', 'Unknown Title')
@@ -329,29 +459,30 @@ def download_spotify_track(request, url, output_format=None):
             album = metadata.get('album', 'Unknown Album')
             spotify_id = metadata.get('spotify_id')
             thumbnail_url = metadata.get('thumbnail_url')
-            
-            # Check if the file actually exists
-            if not os.path.exists(cached_file_path):
+
+            # Check if the file actually exists in either tier; it's tagged and
+            # transcoded below, so a demoted one is copied back first
+            cached_file_path = ensure_local(cached_file_path)
+            if not cached_file_path:
                 logger.warning(f"File not found for cached song {url}, will redownload")
                 # Continue to download logic below (don't return)
             else:
-                # Check if we need format conversion
-                if output_format and output_format != 'mp3' and os.path.splitext(cached_file_path)[1][1:] != output_format:
-                    # Convert the format
-                    logger.info(f"Converting cached Spotify song from {os.path.splitext(cached_file_path)[1][1:]} to {output_format}")
-                    final_filename = convert_audio_format(cached_file_path, output_format)
-                else:
-                    final_filename = cached_file_path
-                    
+                final_filename = cached_file_path
+
+                song_id = None
                 # Create a song entry for this user if they don't already have it
-                if not Song.objects.filter(user=request.user, song_url=url).exists():
+                existing_song = Song.objects.filter(user=user, song_url=url).first()
+                if existing_song:
+                    song_id = existing_song.id
+                else:
                     # Create the song record with proper file path
-                    rel_path = os.path.relpath(final_filename, settings.MEDIA_ROOT)
-                    rel_path = sanitize_filename(rel_path, max_length=95)
-                    
+                    # The cached file's own path; its name was sanitized when it was stored
+                    rel_path = cached_song.file_path
+
                     # Make sure to embed the thumbnail metadata even for cached songs
                     if thumbnail_url:
                         logger.info(f"Embedding thumbnail from cache metadata: {thumbnail_url}")
+                        _report_progress(progress, 70, 'Embedding metadata')
                         embed_metadata(
                             mp3_path=final_filename,
                             title=title,
@@ -363,9 +494,10 @@ def download_spotify_track(request, url, output_format=None):
                             album_artist=metadata.get('album_artist', artist),
                             spotify_id=spotify_id
                         )
-                    
+
+                    _report_progress(progress, 90, 'Saving')
                     song = Song.objects.create(
-                        user=request.user,
+                        user=user,
                         title=sanitize_for_db(title),
                         artist=sanitize_for_db(artist),
                         album=sanitize_for_db(album),
@@ -375,112 +507,95 @@ def download_spotify_track(request, url, output_format=None):
                         thumbnail_url=sanitize_for_db(thumbnail_url, max_length=190) if thumbnail_url else None,
                         song_url=url
                     )
-                    
+                    MediaFileIndex.record_songs([song])
+                    song_id = song.id
+
                     # Update user's music profile
                     try:
-                        profile, created = UserMusicProfile.objects.get_or_create(user=request.user)
+                        profile, created = UserMusicProfile.objects.get_or_create(user=user)
                         profile.update_profile(song)
                     except Exception as profile_error:
                         logger.warning(f"Error updating user profile: {profile_error}")
-                    
+
                     # Increment download count
-                    request.user.increment_download_count()
-                
-                # Serve the file
+                    user.increment_download_count()
+
+                # Serve another format from the transcode cache; the song keeps the cached source
+                if output_format and output_format != 'mp3' and os.path.splitext(cached_file_path)[1][1:] != output_format:
+                    logger.info(f"Converting cached Spotify song from {os.path.splitext(cached_file_path)[1][1:]} to {output_format}")
+                    _report_progress(progress, 95, 'Converting')
+                    final_filename = get_transcoded_file(cached_file_path, output_format)
+
                 formatted_filename = f"{title} - {artist}.{output_format or 'mp3'}"
                 formatted_filename = sanitize_filename(formatted_filename)
-                
-                # Let Django's FileResponse manage the file handle
-                response = FileResponse(
-                    open(final_filename, 'rb'),
-                    as_attachment=True,
-                    filename=formatted_filename
-                )
-                content_type = f'audio/{output_format}' if output_format else 'audio/mpeg'
-                response['Content-Type'] = content_type
-                
-                # Explicitly set Content-Disposition header with filename
-                response['Content-Disposition'] = f'attachment; filename="{formatted_filename}"'
-                
-                # Add song metadata headers
-                response['x-song-title'] = title
-                response['x-song-artist'] = artist
-                if album:
-                    response['x-album-name'] = album
-                if thumbnail_url:
-                    response['x-cover-url'] = thumbnail_url
-                    
-                return response
+
+                return {
+                    'path': final_filename,
+                    'filename': formatted_filename,
+                    'content_type': f'audio/{output_format}' if output_format else 'audio/mpeg',
+                    'title': title,
+                    'artist': artist,
+                    'album': album,
+                    'thumbnail_url': thumbnail_url,
+                    'song_id': song_id,
+                }
 
         # If song not in cache or file doesn't exist, download it
         # Extract Spotify ID from URL
         spotify_id = extract_spotify_id(url)
         if not spotify_id:
-            return Response(
-                {'error': 'Invalid Spotify URL'}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
+            raise ValueError('Invalid Spotify URL')
+
         logger.info(f"Getting info for Spotify track ID: {spotify_id}")
-        
+
         # Get track info from Spotify
-        track_info = get_track_info(url)
-        if not track_info:
-            return Response(
-                {'error': 'Failed to get track info from Spotify'}, 
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
-        
+        with source_guard(url):
+            track_info = get_track_info(url)
+            if not track_info:
+                raise SpotifyAPIError('Failed to get track info from Spotify')
+
         # Make sure we have the thumbnail URL from Spotify API
         thumbnail_url = track_info.get('image_url')
 
         logger.info(f"Spotify API returned thumbnail URL: {thumbnail_url}")
-        
+
         # Sanitize track info fields for the database
         track_info['title'] = sanitize_for_db(track_info['title'])
         track_info['artist'] = sanitize_for_db(track_info['artist'])
         if 'album' in track_info:
             track_info['album'] = sanitize_for_db(track_info['album'])
-        
+
         logger.info(f"Got track info: {track_info['title']} by {track_info['artist']}")
-        
-        # Build a search query for YouTube
-        query = f"{track_info['title']} {track_info['artist']}"
-        
-        # Create a temporary directory that we'll clean up manually
-        temp_dir = tempfile.mkdtemp()
-        
-        # Create a YouTube search URL that the API can use
-        search_url = f"https://youtube.com/results?search_query={query.replace(' ', '+')}"
-        
-        # Download using Hugging Face Spaces API
-        info = download_from_huggingface(search_url, temp_dir, spotify_metadata=track_info)
+
+        # Stage the download on the media volume so finishing it is a rename
+        temp_dir = make_staging_dir()
+
+        # Download using Hugging Face Spaces API, skipping the search if we know the video
+        _report_progress(progress, 10, 'Downloading')
+        with source_guard(url):
+            info = download_spotify_source(track_info, temp_dir)
         mp3_filename = info['filepath']
-        
+        SpotifyMatch.remember([_build_spotify_match(track_info, info)])
+
         logger.info(f"Downloaded file to: {mp3_filename}")
-        
+
         # Create a proper formatted filename for the final file
         formatted_filename = f"{track_info['title']} - {track_info['artist']}.mp3"
         formatted_filename = sanitize_filename(formatted_filename)
-        
-        # Copy to media directory to avoid temp directory issues
-        media_dir = os.path.join(settings.MEDIA_ROOT, 'songs')
-        os.makedirs(media_dir, exist_ok=True)
-        media_path = os.path.join(media_dir, formatted_filename)
-        
-        shutil.copy2(mp3_filename, media_path)
 
         # Check if this song already exists for this user before creating a new one
         existing_song = Song.objects.filter(
-            user=request.user, 
+            user=user,
             song_url=url
         ).first()
-        
+
         # IMPORTANT: Always embed Spotify metadata into the file, overwriting any existing tags
         # This step ensures we use the correct info from Spotify API rather than potential incorrect YouTube data
-        logger.info(f"Embedding Spotify metadata into MP3 file: {media_path}")
+        # Tags are written while the file is staged, before anyone can see it
+        logger.info(f"Embedding Spotify metadata into MP3 file: {mp3_filename}")
+        _report_progress(progress, 60, 'Embedding metadata')
         embed_metadata(
-            mp3_path=media_path,
+            mp3_path=mp3_filename,
             title=track_info['title'],
             artist=track_info['artist'],
             album=track_info.get('album', 'Unknown'),
@@ -490,7 +605,11 @@ def download_spotify_track(request, url, output_format=None):
             album_artist=track_info.get('album_artist', track_info['artist']),
             spotify_id=track_info.get('spotify_id')
         )
-        
+
+        # Move the finished file into the media directory in one rename
+        media_path = publish_file(mp3_filename, os.path.join(settings.MEDIA_ROOT, 'songs', formatted_filename))
+
+        _report_progress(progress, 80, 'Saving')
         if existing_song:
             song = existing_song
             # Update the thumbnail URL if it was missing before
@@ -498,12 +617,11 @@ def download_spotify_track(request, url, output_format=None):
                 existing_song.thumbnail_url = sanitize_for_db(thumbnail_url, max_length=190)
                 existing_song.save()
         else:
-            rel_path = os.path.join('songs', formatted_filename)
-            # Sanitize the file path to ensure it doesn't exceed DB limits
-            rel_path = sanitize_filename(rel_path, max_length=95)
-            
+            # formatted_filename is already sanitized (and short enough); only the directory is added
+            rel_path = f"songs/{formatted_filename}"
+
             song = Song.objects.create(
-                user=request.user,
+                user=user,
                 title=sanitize_for_db(track_info['title']),
                 artist=sanitize_for_db(track_info['artist']),
                 album=sanitize_for_db(track_info.get('album', 'Unknown')),
@@ -513,104 +631,57 @@ def download_spotify_track(request, url, output_format=None):
                 thumbnail_url=sanitize_for_db(thumbnail_url, max_length=190) if thumbnail_url else None,
                 song_url=url
             )
-        
+            MediaFileIndex.record_songs([song])
+
         # Update user's music profile
         try:
-            profile, created = UserMusicProfile.objects.get_or_create(user=request.user)
+            profile, created = UserMusicProfile.objects.get_or_create(user=user)
             profile.update_profile(song)
         except Exception as profile_error:
             logger.warning(f"Error updating user profile: {profile_error}")
-        
+
         # Increment download count
-        request.user.increment_download_count()
-        
+        user.increment_download_count()
+
         # Record download in analytics
         try:
-            UserAnalytics.record_download(request.user)
+            UserAnalytics.record_download(user)
         except Exception as analytics_error:
             logger.warning(f"Error recording download in analytics: {analytics_error}")
-        
-        # Add to cache for future use (with properly formatted filename)
-        try:
-            # Create properly named file in cache directory
-            cache_path = os.path.join('cache', formatted_filename)
-            cache_full_path = os.path.join(settings.MEDIA_ROOT, cache_path)
-            
-            # Make sure the cache directory exists
-            os.makedirs(os.path.dirname(cache_full_path), exist_ok=True)
-            
-            # Copy the file to the cache directory with the proper name
-            if not os.path.exists(cache_full_path):
-                shutil.copy2(media_path, cache_full_path)  # Copy file with Spotify metadata already embedded
-            
-            # Calculate file size
-            file_size = os.path.getsize(media_path)
-            
-            # Ensure thumbnail URL is valid for database
-            if thumbnail_url and len(thumbnail_url) > 190:
-                # Truncate long URLs or set to empty if invalid
-                logger.warning(f"Thumbnail URL too long, truncating: {thumbnail_url[:50]}...")
-                thumbnail_url = sanitize_for_db(thumbnail_url, max_length=190)
-            
-            # Prepare metadata
-            metadata = {
-                'title': song.title,
-                'artist': song.artist,
-                'album': song.album,
-                'thumbnail_url': thumbnail_url,
-                'source': 'spotify',
-                'spotify_id': song.spotify_id
-            }
-            
-            # Create or update cache entry with metadata in the JSON field
-            SongCache.objects.update_or_create(
-                song_url=url,
-                defaults={
-                    'file_path': cache_path,
-                    'file_size': file_size,
-                    'expires_at': timezone.now() + timedelta(days=7),
-                    'metadata': metadata
-                }
-            )
-            logger.info(f"Added song to cache: {url}")
-        except Exception as e:
-            logger.warning(f"Error adding song to cache: {str(e)}")
-        
+
+        # Add the tagged media file to the cache for future use
+        SongCache.ingest(url, os.path.relpath(media_path, settings.MEDIA_ROOT), {
+            'title': song.title,
+            'artist': song.artist,
+            'album': song.album,
+            'thumbnail_url': sanitize_for_db(thumbnail_url, max_length=190) if thumbnail_url else None,
+            'source': 'spotify',
+            'spotify_id': song.spotify_id,
+            'year': track_info.get('year'),
+            'genre': track_info.get('genre'),
+            'album_artist': track_info.get('album_artist'),
+        })
+
         # Check if format conversion is needed
         if output_format and output_format != 'mp3':
-            final_filename = convert_audio_format(media_path, output_format)
+            _report_progress(progress, 90, 'Converting')
+            final_filename = get_transcoded_file(media_path, output_format)
             formatted_filename = f"{track_info['title']} - {track_info['artist']}.{output_format}"
             formatted_filename = sanitize_filename(formatted_filename)
         else:
             final_filename = media_path
-        
-        # Serve the file from the permanent media location
-        response = FileResponse(
-            open(final_filename, 'rb'),
-            as_attachment=True,
-            filename=formatted_filename
-        )
-        response['Content-Type'] = f'audio/{output_format or "mp3"}'
-        
-        # Explicitly set Content-Disposition header with filename
-        response['Content-Disposition'] = f'attachment; filename="{formatted_filename}"'
-        
-        # Add song metadata headers
-        response['x-song-title'] = track_info['title']
-        response['x-song-artist'] = track_info['artist']
-        if 'album' in track_info:
-            response['x-album-name'] = track_info['album']
-        if thumbnail_url:
-            response['x-cover-url'] = thumbnail_url
-            
-        return response
 
-    except Exception as e:
-        logger.error(f"Spotify track download error: {e}", exc_info=True)
-        return Response(
-            {'error': f'Download failed: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        # Serve the file from the permanent media location
+        return {
+            'path': final_filename,
+            'filename': formatted_filename,
+            'content_type': f'audio/{output_format or "mp3"}',
+            'title': track_info['title'],
+            'artist': track_info['artist'],
+            'album': track_info.get('album'),
+            'thumbnail_url': thumbnail_url,
+            'song_id': song.id,
+        }
     finally:
         # Clean up temp directory if it exists
         if temp_dir and os.path.exists(temp_dir):
@@ -619,19 +690,105 @@ def download_spotify_track(request, url, output_format=None):
             except:
                 pass
 
+@spotify_api_retry
+def download_spotify_track(request, url, output_format=None):
+    """Direct Spotify track download with streaming response"""
+    try:
+        result = fetch_spotify_track(request.user, url, output_format)
+        return build_download_response(result, request)
+
+    except SourceUnavailableError as e:
+        return source_unavailable_response(e)
+    except ValueError as e:
+        return Response(
+            {'error': str(e)},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    except Exception as e:
+        logger.error(f"Spotify track download error: {e}", exc_info=True)
+        return Response(
+            {'error': f'Download failed: {str(e)}'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+def submit_download_job(user, url, output_format=None):
+    """
+    Queue a single-track download on Celery and return immediately.
+
+    Jobs are prioritised by subscription tier so premium users are not stuck
+    behind a burst of free-tier downloads.
+
+    Args:
+        user: The user requesting the download
+        url (str): YouTube or Spotify track URL
+        output_format (str, optional): Requested audio format
+
+    Returns:
+        DownloadJob: The queued job
+
+    Raises:
+        SourceUnavailableError: If the URL is in the negative cache; no job is queued
+    """
+    from .tasks import process_download_job
+
+    # Don't spend a worker on a source we know will fail
+    check_source(url)
+
+    tier = 'premium' if user.is_subscription_active() else 'free'
+    priority = settings.DOWNLOAD_JOB_PRIORITIES.get(tier, 5)
+
+    job = DownloadJob.objects.create(
+        user=user,
+        url=url,
+        output_format=output_format or settings.DEFAULT_AUDIO_FORMAT,
+        priority=priority,
+        stage='Queued'
+    )
+
+    # Redis emulates priorities with one list per step; lower numbers are consumed first
+    task = process_download_job.apply_async(args=[str(job.id)], priority=priority)
+    job.task_id = task.id
+    job.save(update_fields=['task_id'])
+
+    logger.info(f"Queued download job {job.id} for {url} (user={user.id}, tier={tier}, priority={priority})")
+    return job
+
+def source_unavailable_response(error):
+    """Fast failure for a negative-cached source, telling the client when to try again"""
+    http_status = (
+        status.HTTP_503_SERVICE_UNAVAILABLE if error.error_class == 'upstream_error'
+        else status.HTTP_422_UNPROCESSABLE_ENTITY
+    )
+    return Response(
+        {'error': f'Download failed: {error.message}', 'error_class': error.error_class, 'retry_after': error.retry_after},
+        status=http_status,
+        headers={'Retry-After': str(error.retry_after)}
+    )
+
+def job_accepted_response(request, job):
+    """Build the 202 response returned when a download job has been queued"""
+    from django.urls import reverse
+
+    data = job.to_dict()
+    data.update({
+        'message': 'Download queued',
+        'poll_after': settings.DOWNLOAD_JOB_POLL_SECONDS,
+        'status_url': request.build_absolute_uri(reverse('song-job-status', kwargs={'job_id': job.id})),
+        'events_url': request.build_absolute_uri(reverse('song-job-events', kwargs={'job_id': job.id})),
+        'file_url': request.build_absolute_uri(reverse('song-job-file', kwargs={'job_id': job.id})),
+    })
+    return Response(data, status=status.HTTP_202_ACCEPTED)
+
 def download_playlist(request):
-    """Download a playlist from YouTube or Spotify using parallel processing"""
+    """Download a playlist from YouTube or Spotify through the staged download pipeline"""
+    from .pipeline import DownloadPipeline, ThrottledProgress
+
     url = request.data.get('url')
     if not url:
         return Response({"error": "URL is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-    MAX_CONCURRENT_DOWNLOADS = 3 # Limit concurrency
-    progress_lock = threading.Lock() # Lock for shared progress updates
-
     try:
-        # ... existing code to get playlist_info ...
         playlist_info = get_playlist_info(url)
-        # ... existing code ...
         
         playlist_title = playlist_info.get('title', 'Downloaded Playlist')
         playlist_description = playlist_info.get('description', '')
@@ -661,375 +818,324 @@ def download_playlist(request):
             current_progress=0,
             current_file="Starting playlist download..."
         )
-        
-        completed_downloads = 0
-        successful_songs = [] # Collect successful songs here
 
-        # Helper function to process a single track
-        def _process_playlist_track(track_url):
-            nonlocal completed_downloads # Use nonlocal to modify the outer scope variable
-            
-            try:
-                # 1. Check if user already has this song
-                existing_song = Song.objects.filter(user=request.user, song_url=track_url).first()
-                if existing_song:
-                    logger.info(f"[Parallel] Found existing song for user: {track_url}")
-                    with progress_lock:
-                        completed_downloads += 1
-                        download_progress.current_progress = int(completed_downloads / download_progress.total_items * 100)
-                        download_progress.current_file = f"(Exists) {existing_song.title}"
-                        download_progress.save(update_fields=['current_progress', 'current_file'])
-                    return existing_song # Return the song to be added later
-
-                # 2. Check cache
-                cached_song = SongCache.get_cached_song(track_url)
-                if cached_song:
-                    # ... (logic to handle cached song, create Song object if needed) ...
-                    # Simplified cache handling for brevity - assumes cache hit means success
-                    # In a real scenario, you'd replicate the full cache logic here
-                    # Ensure file exists, get metadata, create Song object
-                    
-                    # Placeholder: Assume cache hit is valid and create/get the song object
-                    # This part needs the full logic from the original sequential code
-                    metadata = cached_song.metadata or {}
-                    title = metadata.get('title', 'Unknown Title')
-                    artist = metadata.get('artist', 'Unknown Artist')
-                    album = metadata.get('album', 'Unknown Album')
-                    cached_file_path_rel = cached_song.file_path # Assuming file_path is relative
-                    
-                    # Check if file exists (simplified)
-                    full_path = os.path.join(settings.MEDIA_ROOT, cached_file_path_rel)
-                    if os.path.exists(full_path):
-                        song, created = Song.objects.get_or_create(
-                            user=request.user,
-                            song_url=track_url,
-                            defaults={
-                                'title': sanitize_for_db(title),
-                                'artist': sanitize_for_db(artist),
-                                'album': sanitize_for_db(album),
-                                'file': cached_file_path_rel, # Use relative path from cache
-                                'source': 'cache', # Indicate it came from cache
-                                'spotify_id': metadata.get('spotify_id'),
-                                'thumbnail_url': sanitize_for_db(metadata.get('thumbnail_url', ''), max_length=190),
-                            }
-                        )
-                        logger.info(f"[Parallel] Used cached song: {track_url}")
-                        with progress_lock:
-                            completed_downloads += 1
-                            download_progress.current_progress = int(completed_downloads / download_progress.total_items * 100)
-                            download_progress.current_file = f"(Cache) {song.title}"
-                            download_progress.save(update_fields=['current_progress', 'current_file'])
-                        return song # Return the song
-                    else:
-                         logger.warning(f"[Parallel] Cached file not found for {track_url}, will download.")
-                         # Fall through to download
-
-                # 3. Download if not found or cache invalid
-                logger.info(f"[Parallel] Downloading track: {track_url}")
-                temp_dir = tempfile.mkdtemp()
-                song = None
-                try:
-                    if 'youtube.com' in track_url or 'youtu.be' in track_url:
-                        info_dict = download_from_huggingface(track_url, temp_dir)
-                        # ... (logic to process info_dict, create Song, add to cache) ...
-                        # Simplified processing:
-                        media_path_rel, song = _save_and_record_song(request.user, track_url, info_dict, temp_dir, source='youtube')
-                        if song:
-                             _add_to_cache(track_url, media_path_rel, info_dict, source='youtube')
-
-                    elif 'spotify.com' in track_url:
-                        track_info = get_track_info(track_url)
-                        if not track_info: raise Exception("Failed to get Spotify track info")
-                        
-                        query = f"{track_info['title']} {track_info['artist']}"
-                        search_url = f"https://youtube.com/results?search_query={query.replace(' ', '+')}"
-                        
-                        info_dict = download_from_huggingface(search_url, temp_dir, spotify_metadata=track_info)
-                        # ... (logic to process info_dict using track_info, create Song, add to cache) ...
-                        # Simplified processing:
-                        media_path_rel, song = _save_and_record_song(request.user, track_url, info_dict, temp_dir, source='spotify', spotify_info=track_info)
-                        if song:
-                            _add_to_cache(track_url, media_path_rel, info_dict, source='spotify', spotify_info=track_info)
-
-                    else:
-                        logger.warning(f"[Parallel] Unsupported URL in playlist: {track_url}")
-                        return None # Indicate failure for this track
-
-                    # If download and processing were successful
-                    if song:
-                        logger.info(f"[Parallel] Successfully processed track: {song.title}")
-                        with progress_lock:
-                            completed_downloads += 1
-                            download_progress.current_progress = int(completed_downloads / download_progress.total_items * 100)
-                            download_progress.current_file = f"(DL) {song.title}"
-                            download_progress.save(update_fields=['current_progress', 'current_file'])
-                        return song # Return the newly created song
-                    else:
-                        logger.error(f"[Parallel] Failed to process downloaded track: {track_url}")
-                        return None # Indicate failure
-
-                finally:
-                    if temp_dir and os.path.exists(temp_dir):
-                        shutil.rmtree(temp_dir, ignore_errors=True)
-
-            except Exception as track_error:
-                logger.error(f"[Parallel] Error processing track {track_url}: {track_error}", exc_info=True)
-                # Update progress even on error to show advancement
-                with progress_lock:
-                    completed_downloads += 1 # Count as processed, even if failed
-                    download_progress.current_progress = int(completed_downloads / download_progress.total_items * 100)
-                    # Optionally update current_file to show the error or skip
-                    download_progress.save(update_fields=['current_progress'])
-                return None # Indicate failure
-
-        # Use ThreadPoolExecutor for parallel processing
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as executor:
-            # Submit all tasks
-            future_to_url = {executor.submit(_process_playlist_track, url): url for url in track_urls}
-            
-            # Process results as they complete
-            for future in concurrent.futures.as_completed(future_to_url):
-                url = future_to_url[future]
-                try:
-                    result_song = future.result()
-                    if result_song:
-                        successful_songs.append(result_song)
-                except Exception as exc:
-                    logger.error(f'[Parallel] Track {url} generated an exception: {exc}')
+        # Look up the user's songs and cache rows for every track up front,
+        # one query each, so the fetch stage only downloads
+        existing_songs = {
+            song.song_url: song
+            for song in Song.objects.filter(user=request.user, song_url__in=track_urls).order_by('-created_at')
+        }
+        cached_songs = SongCache.get_cached_songs(u for u in track_urls if u not in existing_songs)
 
-        # Add all successful songs to the playlist at once
-        if successful_songs:
-            playlist.songs.add(*successful_songs)
-            logger.info(f"Added {len(successful_songs)} songs to playlist {playlist.id}")
+        # Progress is counted in memory and flushed on a timer rather than per track
+        progress = ThrottledProgress(
+            lambda count, label: DownloadProgress.add_completed(download_progress.task_id, count, label)
+        )
+        pipeline = DownloadPipeline(
+            fetch=lambda track_url: _fetch_playlist_track(track_url, existing_songs, cached_songs),
+            process=_prepare_playlist_track,
+            persist=lambda batch: _persist_playlist_tracks(request.user, playlist, batch),
+            on_progress=progress
+        )
+        successful_songs = pipeline.run(track_urls)
+        progress.flush()
+        completed_downloads = progress.done
 
         # Final progress update
-        with progress_lock:
-            download_progress.current_progress = 100
-            final_status = f"Playlist download complete. Added {len(successful_songs)}/{len(track_urls)} tracks."
-            download_progress.current_file = final_status
-            download_progress.save()
+        download_progress.refresh_from_db()
+        download_progress.current_progress = 100
+        download_progress.current_file = f"Playlist download complete. Added {len(successful_songs)}/{len(track_urls)} tracks."
+        download_progress.save()
 
         # Check if we managed to download any songs
         if not successful_songs:
-             # Clean up playlist if no songs were added? Optional.
-             # playlist.delete() 
             return Response({
                 "warning": f"Could not process any tracks from playlist '{playlist_title}'",
-                "playlist_id": playlist.id
+                "playlist_id": playlist.id,
+                "pipeline": pipeline.stats()
             }, status=status.HTTP_206_PARTIAL_CONTENT)
-            
-        # Increment download count for each successful track
-        # Note: This assumes _process_playlist_track handles incrementing for new downloads
-        # If not, increment here based on newly created songs vs existing/cached
-        # request.user.bulk_increment_download_count(len(newly_downloaded_songs)) 
-        
-        # Record all downloads in analytics (consider if this should be in _process_playlist_track)
-        try:
-            # This might over-count if existing/cached songs aren't downloads
-            # Adjust logic based on whether cache hits count as "downloads"
-            for song in successful_songs:
-                 # Maybe only record analytics if the song was newly downloaded?
-                 # Requires _process_playlist_track to return more info or check source
-                 UserAnalytics.record_download(request.user)
-        except Exception as analytics_error:
-            logger.warning(f"Error recording downloads in analytics: {analytics_error}")
 
         return Response({
             "message": f"Playlist '{playlist_title}' processed successfully",
             "playlist_id": playlist.id,
             "total_tracks": len(track_urls),
-            "processed_tracks": completed_downloads, # Use the counter updated by threads
-            "added_tracks": len(successful_songs)
+            "processed_tracks": completed_downloads,
+            "added_tracks": len(successful_songs),
+            "pipeline": pipeline.stats()
         })
 
     except Exception as e:
         logger.error(f"Playlist download error: {e}", exc_info=True)
-        # Clean up potentially created playlist object if the overall process fails early?
-        # if 'playlist' in locals() and playlist.pk and not playlist.songs.exists():
-        #     playlist.delete()
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-# Helper function to save song and create DB record (to avoid repetition)
-def _save_and_record_song(user, song_url, info_dict, temp_dir, source, spotify_info=None):
-    """Saves downloaded file, creates Song object."""
+# Pipeline stages for download_playlist
+def _fetch_playlist_track(track_url, existing_songs, cached_songs):
+    """
+    Fetch stage: resolve a playlist track to a downloaded file in a temp dir.
+    Songs the user already has and valid cache hits (both prefetched by the
+    caller) skip the process stage.
+    """
+    from .utils import wait_for_upstream
+
+    # 1. Check if user already has this song
+    existing_song = existing_songs.get(track_url)
+    if existing_song:
+        logger.info(f"[Pipeline] Found existing song for user: {track_url}")
+        return {'kind': 'existing', 'song_id': existing_song.id, 'track_url': track_url,
+                'label': f"(Exists) {existing_song.title}", 'skip_process': True}
+
+    # 2. Check cache
+    cached_song = cached_songs.get(track_url)
+    if cached_song:
+        # The song only refers to the file, so a demoted one can stay cold
+        if tiered_storage().exists(cached_song.file_path):
+            logger.info(f"[Pipeline] Using cached song: {track_url}")
+            metadata = cached_song.metadata or {}
+            return {'kind': 'cached', 'track_url': track_url, 'rel_path': cached_song.file_path,
+                    'metadata': metadata, 'label': f"(Cache) {metadata.get('title', 'Unknown Title')}",
+                    'skip_process': True}
+        logger.warning(f"[Pipeline] Cached file not found for {track_url}, will download.")
+
+    # 3. Download if not found or cache invalid, unless the source is known to fail
+    check_source(track_url)
+    if 'youtube.com' in track_url or 'youtu.be' in track_url:
+        source, spotify_info = 'youtube', None
+    elif 'spotify.com' in track_url:
+        with source_guard(track_url):
+            spotify_info = get_track_info(track_url)
+            if not spotify_info:
+                raise SpotifyAPIError("Failed to get Spotify track info")
+        source = 'spotify'
+    else:
+        logger.warning(f"[Pipeline] Unsupported URL in playlist: {track_url}")
+        return None
+
+    logger.info(f"[Pipeline] Downloading track: {track_url}")
+    wait_for_upstream('youtube')
+    temp_dir = make_staging_dir()
+    try:
+        with source_guard(track_url):
+            if spotify_info:
+                info_dict = download_spotify_source(spotify_info, temp_dir)
+            else:
+                info_dict = download_from_huggingface(track_url, temp_dir)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    return {'kind': 'downloaded', 'track_url': track_url, 'temp_dir': temp_dir, 'info_dict': info_dict,
+            'source': source, 'spotify_info': spotify_info, 'label': f"(DL) {info_dict.get('title')}"}
+
+
+def _track_metadata(info_dict, source, spotify_info=None):
+    """Resolve the tags for a downloaded track, preferring Spotify metadata"""
+    if source == 'spotify' and spotify_info:
+        artist = sanitize_for_db(spotify_info['artist'])
+        return {
+            'title': sanitize_for_db(spotify_info['title']),
+            'artist': artist,
+            'album': sanitize_for_db(spotify_info.get('album', 'Unknown')),
+            'thumbnail_url': spotify_info.get('image_url'), # Prefer Spotify image
+            'spotify_id': spotify_info.get('spotify_id'),
+            'year': spotify_info.get('year'),
+            'genre': spotify_info.get('genre', 'Unknown'),
+            'album_artist': spotify_info.get('album_artist', artist),
+            'youtube_id': None,
+        }
+
+    # YouTube or fallback
+    artist = sanitize_for_db(info_dict.get('artist', 'Unknown Artist'))
+    return {
+        'title': sanitize_for_db(info_dict['title']),
+        'artist': artist,
+        'album': sanitize_for_db(info_dict.get('album', 'Unknown')),
+        'thumbnail_url': info_dict.get('thumbnail'),
+        'spotify_id': None, # Not from Spotify
+        'year': info_dict.get('upload_date', '')[:4] if info_dict.get('upload_date') else None,
+        'genre': 'Unknown',
+        'album_artist': artist,
+        'youtube_id': info_dict.get('id'),
+    }
+
+
+def _prepare_playlist_track(payload):
+    """
+    Process stage: move a downloaded track into media/songs and embed its tags.
+    Runs in the pipeline's CPU pool, possibly in another process, so it takes and
+    returns plain dicts. Always removes the fetch stage's temp dir.
+    """
+    temp_dir = payload['temp_dir']
     try:
-        # Determine metadata based on source
-        if source == 'spotify' and spotify_info:
-            title = sanitize_for_db(spotify_info['title'])
-            artist = sanitize_for_db(spotify_info['artist'])
-            album = sanitize_for_db(spotify_info.get('album', 'Unknown'))
-            thumbnail_url = spotify_info.get('image_url') # Prefer Spotify image
-            spotify_id = spotify_info.get('spotify_id')
-            year = spotify_info.get('year')
-            genre = spotify_info.get('genre', 'Unknown')
-            album_artist = spotify_info.get('album_artist', artist)
-        else: # YouTube or fallback
-            title = sanitize_for_db(info_dict['title'])
-            artist = sanitize_for_db(info_dict.get('artist', 'Unknown Artist'))
-            album = sanitize_for_db(info_dict.get('album', 'Unknown'))
-            thumbnail_url = info_dict.get('thumbnail')
-            spotify_id = None # Not from Spotify
-            year = info_dict.get('upload_date', '')[:4] if info_dict.get('upload_date') else None
-            genre = 'Unknown'
-            album_artist = artist
+        info_dict = payload['info_dict']
+        meta = _track_metadata(info_dict, payload['source'], payload.get('spotify_info'))
 
         # Use the downloaded file path from info_dict
         downloaded_filepath = info_dict.get('filepath')
         if not downloaded_filepath or not os.path.exists(downloaded_filepath):
-             logger.error(f"Downloaded file path missing or invalid: {downloaded_filepath}")
-             return None, None
+            logger.error(f"Downloaded file path missing or invalid: {downloaded_filepath}")
+            return None
 
-        # Create final filename and sanitize it ONCE
-        # Ensure the filename itself isn't too long before joining paths
-        # Max filename length on Windows is typically 255, leave room for path
-        base_filename = f"{title} - {artist}.mp3"
-        safe_filename = sanitize_filename(base_filename, max_length=200) # Sanitize the filename part
+        # Sanitize the filename ONCE; leave room for the media path
+        safe_filename = sanitize_filename(f"{meta['title']} - {meta['artist']}.mp3", max_length=200)
 
-        media_dir = os.path.join(settings.MEDIA_ROOT, 'songs')
-        os.makedirs(media_dir, exist_ok=True)
-        media_path = os.path.join(media_dir, safe_filename) # Use sanitized filename
-
-        # Construct relative path using the SAME sanitized filename
+        media_path = os.path.join(settings.MEDIA_ROOT, 'songs', safe_filename)
         rel_path = os.path.join('songs', safe_filename)
 
-        # Check final absolute path length (optional but good practice)
         if len(media_path) > 255:
             logger.warning(f"Resulting media path might be too long: {media_path}")
-            # Consider further truncation or alternative handling if needed
 
-        logger.info(f"Moving downloaded file from {downloaded_filepath} to {media_path}")
-        # Move downloaded file to final location
-        try:
-            shutil.move(downloaded_filepath, media_path)
-        except Exception as move_error:
-            logger.error(f"Error moving file {downloaded_filepath} to {media_path}: {move_error}", exc_info=True)
-            # If move fails, the file might still be in temp_dir, which will be cleaned up later
-            return None, None # Stop if move fails
-
-        # Embed metadata
-        logger.info(f"Embedding metadata into: {media_path}")
+        # Embed metadata while the file is still staged
+        logger.info(f"Embedding metadata into: {downloaded_filepath}")
         embed_metadata(
-            mp3_path=media_path,
-            title=title,
-            artist=artist,
-            album=album,
-            thumbnail_url=thumbnail_url,
-            year=year,
-            genre=genre,
-            album_artist=album_artist,
-            spotify_id=spotify_id,
-            # Add youtube_id if applicable
-            youtube_id=info_dict.get('id') if source == 'youtube' else None
+            mp3_path=downloaded_filepath,
+            title=meta['title'],
+            artist=meta['artist'],
+            album=meta['album'],
+            thumbnail_url=meta['thumbnail_url'],
+            year=meta['year'],
+            genre=meta['genre'],
+            album_artist=meta['album_artist'],
+            spotify_id=meta['spotify_id'],
+            youtube_id=meta['youtube_id'] if payload['source'] == 'youtube' else None
         )
 
-        # Create Song object
-        # Ensure the rel_path stored in DB doesn't exceed its limit (e.g., 100 chars for FileField default)
-        # If rel_path is too long for the DB field, the create() call might fail.
-        # We removed the problematic second sanitization of rel_path here.
-        if len(rel_path) > 95: # Example check if FileField max_length is 100
+        logger.info(f"Publishing {downloaded_filepath} to {media_path}")
+        publish_file(downloaded_filepath, media_path)
+
+        if len(rel_path) > 95:
             logger.warning(f"Relative path length ({len(rel_path)}) might exceed database limits: {rel_path}")
-            # Handle this case - maybe truncate rel_path for DB storage, 
-            # but be aware this might break retrieval if not handled carefully.
-            # For now, proceed, assuming the DB field is large enough or truncation is acceptable.
-            # rel_path_for_db = Truncator(rel_path).chars(95) # Example truncation
 
-        song = Song.objects.create(
-            user=user,
-            title=title,
-            artist=artist,
-            album=album,
-            file=rel_path, # Use the calculated relative path
-            source=source,
-            spotify_id=spotify_id,
-            thumbnail_url=sanitize_for_db(thumbnail_url, max_length=190) if thumbnail_url else None,
-            song_url=song_url
-        )
+        payload = dict(payload, rel_path=rel_path, metadata=meta)
+        payload.pop('temp_dir')
+        return payload
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
-        # ... (update profile, etc.) ...
+
+def _persist_playlist_tracks(user, playlist, batch):
+    """
+    Persist stage: write a batch of tracks with a fixed number of queries,
+    whatever the batch size. New Song rows and cache rows are bulk created,
+    the profile and analytics counters get one F() update each, and
+    everything is added to the playlist at once. Runs on the pipeline's
+    single writer thread.
+    """
+    from django.db import transaction
+
+    song_ids = []
+    new_songs = []
+    new_downloads = []
+    new_matches = []
+
+    for payload in batch:
+        if payload['kind'] == 'existing':
+            song_ids.append(payload['song_id'])
+            continue
         try:
-            profile, created = UserMusicProfile.objects.get_or_create(user=user)
-            profile.update_profile(song)
-        except Exception as profile_error:
-            logger.warning(f"Error updating user profile for {song.id}: {profile_error}")
+            song = _build_playlist_song(user, payload)
+            if payload['kind'] == 'downloaded' and payload.get('spotify_info'):
+                new_matches.append(_build_spotify_match(payload['spotify_info'], payload['info_dict']))
+            if payload['kind'] == 'downloaded':
+                new_downloads.append((
+                    payload['track_url'], payload['rel_path'],
+                    _cache_metadata(payload['metadata'], payload['source'])
+                ))
+        except Exception as e:
+            logger.error(f"[Pipeline] Error preparing track {payload.get('track_url')}: {e}", exc_info=True)
+            continue
+        new_songs.append(song)
 
-        # Increment download count (consider if this should be done in bulk later)
-        # user.increment_download_count()
+    with transaction.atomic():
+        if new_songs:
+            # bulk_create skips save(), so truncate explicitly
+            for song in new_songs:
+                song.truncate_fields()
+            new_songs = Song.objects.bulk_create(new_songs)
+            song_ids.extend(song.id for song in new_songs)
 
-        logger.info(f"_save_and_record_song successful. Returning rel_path: {rel_path} for {song_url}")
-        return rel_path, song # Return relative path and song object
+        # Add the whole batch to the playlist at once
+        if song_ids:
+            playlist.songs.add(*song_ids)
+            logger.info(f"Added {len(song_ids)} songs to playlist {playlist.id}")
 
-    except Exception as e:
-        logger.error(f"Error in _save_and_record_song for {song_url}: {e}", exc_info=True)
-        # Clean up moved file if creation failed AFTER the move?
-        if 'media_path' in locals() and os.path.exists(media_path):
-             # This might happen if Song.objects.create fails
-             # Decide if you want to remove the file from media/songs in this case
-             # os.remove(media_path) # Be careful with cleanup
-             logger.warning(f"File {media_path} was moved but DB record creation failed.")
-             pass
-        return None, None
-
-
-# Helper function to add song to cache (to avoid repetition)
-def _add_to_cache(song_url, rel_path, info_dict, source, spotify_info=None):
-    """Adds the downloaded song to the SongCache."""
-    try:
-        cache_filename = os.path.basename(rel_path)
-        cache_path = os.path.join('cache', cache_filename)
-        cache_full_path = os.path.join(settings.MEDIA_ROOT, cache_path)
-        media_full_path = os.path.join(settings.MEDIA_ROOT, rel_path)
-
-        os.makedirs(os.path.dirname(cache_full_path), exist_ok=True)
-
-        if not os.path.exists(cache_full_path):
-            shutil.copy2(media_full_path, cache_full_path)
-
-        file_size = os.path.getsize(media_full_path)
-
-        # Prepare metadata based on source
-        if source == 'spotify' and spotify_info:
-            title = sanitize_for_db(spotify_info['title'])
-            artist = sanitize_for_db(spotify_info['artist'])
-            album = sanitize_for_db(spotify_info.get('album', 'Unknown'))
-            thumbnail_url = spotify_info.get('image_url')
-            spotify_id = spotify_info.get('spotify_id')
-        else: # YouTube or fallback
-            title = sanitize_for_db(info_dict['title'])
-            artist = sanitize_for_db(info_dict.get('artist', 'Unknown Artist'))
-            album = sanitize_for_db(info_dict.get('album', 'Unknown'))
-            thumbnail_url = info_dict.get('thumbnail')
-            spotify_id = None
-
-        metadata = {
-            'title': title,
-            'artist': artist,
-            'album': album,
-            'thumbnail_url': sanitize_for_db(thumbnail_url, max_length=190) if thumbnail_url else None,
-            'source': source,
-            'spotify_id': spotify_id,
-            'id': info_dict.get('id') if source == 'youtube' else None # YouTube ID
-        }
+    # Outside the transaction: admitting entries may evict (and delete) others
+    SongCache.ingest_many(new_downloads)
+    SpotifyMatch.remember(new_matches)
+    MediaFileIndex.record_songs(new_songs)
 
-        # Use setting or default to 7 days
-        expiry_days = getattr(settings, 'SONG_CACHE_EXPIRY_DAYS', 7)
-
-        SongCache.objects.update_or_create(
-            song_url=song_url,
-            defaults={
-                'file_path': cache_path, # Store relative cache path
-                'file_size': file_size,
-                'expires_at': timezone.now() + timedelta(days=expiry_days), # Use setting or default
-                'metadata': metadata,
-                # Keep these for potential backward compatibility or simpler queries
-                'title': title, 
-                'artist': artist 
-            }
+    if song_ids:
+        from .tasks import schedule_playlist_archive
+        schedule_playlist_archive(playlist.id)
+
+    # Only rows created here are downloads; songs the user already had are not
+    if new_songs:
+        try:
+            UserMusicProfile.record_downloads(user, new_songs)
+            UserAnalytics.record_downloads(user, len(new_songs))
+        except Exception as analytics_error:
+            logger.warning(f"Error recording downloads in analytics: {analytics_error}")
+
+    return song_ids
+
+
+def _build_playlist_song(user, payload):
+    """Build (but don't save) the Song for a cached or freshly downloaded pipeline payload"""
+    track_url = payload['track_url']
+
+    if payload['kind'] == 'cached':
+        metadata = payload['metadata']
+        return Song(
+            user=user,
+            song_url=track_url,
+            title=sanitize_for_db(metadata.get('title', 'Unknown Title')),
+            artist=sanitize_for_db(metadata.get('artist', 'Unknown Artist')),
+            album=sanitize_for_db(metadata.get('album', 'Unknown Album')),
+            file=payload['rel_path'], # Use relative path from cache
+            source='cache', # Indicate it came from cache
+            spotify_id=metadata.get('spotify_id'),
+            thumbnail_url=sanitize_for_db(metadata.get('thumbnail_url', ''), max_length=190),
         )
-        logger.info(f"Added/Updated song cache for: {song_url}")
 
-    except Exception as e:
-        logger.warning(f"Error adding song to cache for {song_url}: {e}", exc_info=True)
+    meta = payload['metadata']
+    return Song(
+        user=user,
+        title=meta['title'],
+        artist=meta['artist'],
+        album=meta['album'],
+        file=payload['rel_path'],
+        source=payload['source'],
+        spotify_id=meta['spotify_id'],
+        thumbnail_url=sanitize_for_db(meta['thumbnail_url'], max_length=190) if meta['thumbnail_url'] else None,
+        song_url=track_url
+    )
+
+
+def _cache_metadata(meta, source):
+    """SongCache metadata (see SongCache.ingest) for a track tagged with _track_metadata's result"""
+    metadata = {key: value for key, value in meta.items() if key != 'youtube_id'}
+    metadata['thumbnail_url'] = sanitize_for_db(meta['thumbnail_url'], max_length=190) if meta.get('thumbnail_url') else None
+    metadata['source'] = source
+    metadata['id'] = meta.get('youtube_id')
+    return metadata
+
+def download_track_file(track_url):
+    """
+    Download one track into media/songs and tag it, without creating a Song
+    (e.g. to fill the SongCache). Uses the playlist pipeline's fetch and process
+    stages in the calling thread.
+
+    Returns:
+        Dict with rel_path and SongCache metadata (see SongCache.ingest), or None
+        if the track couldn't be downloaded
+    """
+    payload = _fetch_playlist_track(track_url, {}, {})
+    if payload is None:
+        return None
+    payload = _prepare_playlist_track(payload)
+    if not payload:
+        return None
+    return {'rel_path': payload['rel_path'], 'metadata': _cache_metadata(payload['metadata'], payload['source'])}
 
 def download_by_task(request):
     """
@@ -1107,7 +1213,10 @@ def download_from_huggingface(url, output_path, spotify_metadata=None):
         
         if response.status_code != 200:
             logger.error(f"Hugging Face API error: {response.status_code} - {response.text}")
-            raise Exception(f"Hugging Face API returned status code {response.status_code}")
+            raise ExternalAPIError(
+                f"Hugging Face API returned status code {response.status_code}",
+                service="HuggingFace", status_code=response.status_code
+            )
         
         # Generate a filename for the downloaded content
         timestamp = int(time.time())
@@ -1123,7 +1232,8 @@ def download_from_huggingface(url, output_path, spotify_metadata=None):
         logger.info(f"Successfully downloaded file to {filename}")
         
         # Extract metadata from response headers if available
-        title = response.headers.get('x-song-title', 'Unknown Title')
+        source_title = response.headers.get('x-song-title')
+        title = source_title or 'Unknown Title'
         artist = response.headers.get('x-song-artist', 'Unknown Artist')
         album = response.headers.get('x-album-name', 'Unknown Album')
         thumbnail_url = response.headers.get('x-cover-url')
@@ -1145,7 +1255,9 @@ def download_from_huggingface(url, output_path, spotify_metadata=None):
             'artist': artist,
             'album': album,
             'thumbnail': thumbnail_url,
-            'id': url.split('v=')[-1].split('&')[0] if 'v=' in url else None
+            # The video the API picked, when it reports it; searches have no id in the URL
+            'id': response.headers.get('x-youtube-id') or (url.split('v=')[-1].split('&')[0] if 'v=' in url else None),
+            'source_title': source_title
         }
         
         return info
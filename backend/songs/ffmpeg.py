@@ -0,0 +1,276 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from functools import lru_cache
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Cache key counting callers waiting for a slot across all processes
+WAITING_KEY = 'ffmpeg:waiting'
+
+# Process-local fallback when slot files can't be locked (no fcntl)
+_local_slots = None
+_local_slots_lock = threading.Lock()
+
+
+class FFmpegBusy(Exception):
+    """Raised when no ffmpeg slot frees up within FFMPEG_QUEUE_TIMEOUT"""
+    pass
+
+
+def _slot_dir():
+    slot_dir = settings.FFMPEG_SLOT_DIR or os.path.join(tempfile.gettempdir(), 'songfer-ffmpeg')
+    os.makedirs(slot_dir, exist_ok=True)
+    return slot_dir
+
+
+def _try_lock_slot(index):
+    """Try to take slot index without blocking; returns the open lock file or None"""
+    f = open(os.path.join(_slot_dir(), f"slot-{index}.lock"), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+    except OSError:
+        f.close()
+        return None
+
+
+def _get_local_slots():
+    global _local_slots
+    with _local_slots_lock:
+        if _local_slots is None:
+            _local_slots = threading.BoundedSemaphore(settings.FFMPEG_MAX_CONCURRENCY)
+        return _local_slots
+
+
+def _change_waiting(delta):
+    try:
+        cache.add(WAITING_KEY, 0, None)
+        if delta > 0:
+            cache.incr(WAITING_KEY, delta)
+        else:
+            cache.decr(WAITING_KEY, -delta)
+    except Exception as e:
+        logger.debug(f"Could not update ffmpeg queue depth: {e}")
+
+
+@contextmanager
+def slot(queue_timeout=None):
+    """
+    Hold one of the FFMPEG_MAX_CONCURRENCY host-wide ffmpeg slots.
+    Slots are flock()ed files, so every web and Celery process on the host shares
+    the same limit and a crashed process releases its slot automatically.
+
+    Raises:
+        FFmpegBusy: If no slot frees up within queue_timeout seconds
+    """
+    if queue_timeout is None:
+        queue_timeout = settings.FFMPEG_QUEUE_TIMEOUT
+
+    if fcntl is None:
+        local_slots = _get_local_slots()
+        _change_waiting(1)
+        try:
+            acquired = local_slots.acquire(timeout=queue_timeout)
+        finally:
+            _change_waiting(-1)
+        if not acquired:
+            raise FFmpegBusy(f"No ffmpeg slot free after {queue_timeout}s")
+        try:
+            yield
+        finally:
+            local_slots.release()
+        return
+
+    deadline = time.monotonic() + queue_timeout
+    lock_file = None
+    delay = 0.05
+    waiting = False
+    try:
+        while lock_file is None:
+            for index in range(settings.FFMPEG_MAX_CONCURRENCY):
+                lock_file = _try_lock_slot(index)
+                if lock_file:
+                    break
+            if lock_file:
+                break
+            if not waiting:
+                waiting = True
+                _change_waiting(1)
+            if time.monotonic() >= deadline:
+                raise FFmpegBusy(f"No ffmpeg slot free after {queue_timeout}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+    finally:
+        if waiting:
+            _change_waiting(-1)
+
+    try:
+        yield
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+@lru_cache(maxsize=None)
+def _which(name):
+    return shutil.which(name)
+
+
+def limited_command(command):
+    """
+    Prefix command with nice and prlimit (where installed) so the child runs at
+    FFMPEG_NICE with an RLIMIT_CPU of FFMPEG_CPU_SECONDS. Both exec the command,
+    so the pid (and any kill) is still ffmpeg's. Unlike a preexec_fn, this is
+    safe to start from threaded processes.
+    """
+    prefix = []
+    if _which('nice'):
+        prefix += [_which('nice'), '-n', str(settings.FFMPEG_NICE)]
+    if _which('prlimit'):
+        cpu_seconds = settings.FFMPEG_CPU_SECONDS
+        prefix += [_which('prlimit'), f'--cpu={cpu_seconds}:{cpu_seconds + 5}']
+    return prefix + list(command)
+
+
+def run(command, timeout=None, check=True, **kwargs):
+    """
+    Run an ffmpeg command once a host-wide slot is free.
+    The child runs at FFMPEG_NICE with an RLIMIT_CPU of FFMPEG_CPU_SECONDS and is
+    killed after timeout (FFMPEG_TIMEOUT) seconds of wall time.
+
+    Args:
+        command: Full argument list, starting with 'ffmpeg'
+        timeout: Wall-clock limit in seconds, defaults to FFMPEG_TIMEOUT
+        check: Raise CalledProcessError on a non-zero exit
+        **kwargs: Passed to subprocess.run (stdout/stderr default to PIPE)
+
+    Returns:
+        subprocess.CompletedProcess
+    """
+    if timeout is None:
+        timeout = settings.FFMPEG_TIMEOUT
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('stderr', subprocess.PIPE)
+
+    with slot():
+        started = time.monotonic()
+        try:
+            return subprocess.run(limited_command(command), timeout=timeout, check=check, **kwargs)
+        finally:
+            logger.debug(f"ffmpeg finished in {time.monotonic() - started:.1f}s: {' '.join(command[:3])}...")
+
+
+class FFmpegStream:
+    """
+    Iterate over an ffmpeg command's stdout in chunks while holding a slot,
+    so output can be sent to the client without writing a file first.
+    The slot is taken on construction (raising FFmpegBusy up front) and given back
+    when the output ends or close() is called, e.g. by Django when the client
+    disconnects, which also kills ffmpeg.
+
+    Args:
+        command: Full argument list writing its output to 'pipe:1'
+        chunk_size: Bytes per chunk, defaults to FFMPEG_STREAM_CHUNK_SIZE
+        timeout: Wall-clock limit in seconds, defaults to FFMPEG_TIMEOUT
+    """
+
+    def __init__(self, command, chunk_size=None, timeout=None):
+        self.chunk_size = chunk_size or settings.FFMPEG_STREAM_CHUNK_SIZE
+        self.timeout = timeout if timeout is not None else settings.FFMPEG_TIMEOUT
+        self.returncode = None
+        self._slot = slot()
+        self._slot.__enter__()
+        try:
+            self.process = subprocess.Popen(
+                limited_command(command),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+        except Exception:
+            self._slot.__exit__(None, None, None)
+            self._slot = None
+            raise
+        # Reads block, so the wall-clock limit is enforced from another thread:
+        # killing ffmpeg ends the read even if it stalled without output
+        self._timed_out = False
+        self._watchdog = threading.Timer(self.timeout, self._kill_on_timeout)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _kill_on_timeout(self):
+        if self.process.poll() is None:
+            self._timed_out = True
+            logger.warning(f"Killing ffmpeg stream after {self.timeout}s")
+            self.process.kill()
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.process.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            if self._timed_out:
+                raise subprocess.TimeoutExpired(self.process.args, self.timeout)
+            self.returncode = self.process.wait()
+            if self.returncode != 0:
+                raise subprocess.CalledProcessError(self.returncode, self.process.args)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._slot is None:
+            return
+        self._watchdog.cancel()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.returncode = self.process.wait()
+        self._slot.__exit__(None, None, None)
+        self._slot = None
+
+
+def stream(command, chunk_size=None, timeout=None):
+    """Start command under the ffmpeg executor and return an FFmpegStream over its stdout"""
+    return FFmpegStream(command, chunk_size=chunk_size, timeout=timeout)
+
+
+def queue_stats():
+    """
+    Host-wide ffmpeg load: configured slots, slots in use and callers waiting.
+
+    Returns:
+        Dict with slots, running and waiting counts
+    """
+    running = 0
+    if fcntl is not None:
+        for index in range(settings.FFMPEG_MAX_CONCURRENCY):
+            lock_file = _try_lock_slot(index)
+            if lock_file is None:
+                running += 1
+            else:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+    try:
+        waiting = max(0, cache.get(WAITING_KEY) or 0)
+    except Exception:
+        waiting = 0
+    return {
+        'slots': settings.FFMPEG_MAX_CONCURRENCY,
+        'running': running,
+        'waiting': waiting,
+    }
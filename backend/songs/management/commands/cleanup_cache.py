@@ -1,12 +1,84 @@
 import os
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
-from songs.models import SongCache
+from django.db.models import Q
+from songs.models import Song, SongCache
 from django.utils import timezone
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+# Progress of an interrupted run, so the next one carries on where it stopped
+CHECKPOINT_KEY = 'cleanup_cache:checkpoint:{}'
+
+# Directories (under MEDIA_ROOT) searched for files no Song or cache entry uses
+ORPHAN_DIRS = ('songs', 'cache')
+
+
+class RateLimiter:
+    """Token bucket shared by the worker threads: at most rate operations per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, count=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.updated) * self.rate)
+            self.updated = now
+            self.allowance -= count
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+def _unlink(path):
+    """Remove a file and the thumbnail saved beside it; returns bytes freed"""
+    freed = 0
+    for candidate in (path, f"{os.path.splitext(path)[0]}.jpg"):
+        try:
+            size = os.stat(candidate).st_size
+            os.remove(candidate)
+            freed += size
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # One bad file shouldn't stop the batch before its rows are deleted
+            logger.warning(f"Could not remove {candidate}: {e}")
+    return freed
+
+
+def _sorted_walk(root, rel_parts=(), after=None):
+    """
+    Yield (rel_parts, DirEntry) for files under root in a stable order, so a
+    run can resume after the path it last finished. Uses os.scandir, whose
+    entries carry their type (and on some platforms their stat) already.
+    """
+    try:
+        with os.scandir(os.path.join(root, *rel_parts)) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        parts = rel_parts + (entry.name,)
+        if after is not None and parts < after[:len(parts)]:
+            # Everything in here was handled before the checkpoint
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from _sorted_walk(root, parts, after)
+        elif entry.is_file(follow_symlinks=False) and (after is None or parts > after):
+            yield parts, entry
+
+
 class Command(BaseCommand):
     help = 'Clean up expired song cache entries and unused media files'
 
@@ -25,175 +97,204 @@ class Command(BaseCommand):
         parser.add_argument(
             '--unused',
             action='store_true',
-            help='Clean up cached entries not accessed in the last week',
+            help='Clean up cached entries not accessed in the last week, and orphaned files',
         )
         parser.add_argument(
             '--dry-run',
             action='store_true',
             help='Only show what would be deleted without actually deleting',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.CACHE_CLEANUP_BATCH_SIZE,
+            help='Rows or files handled per batch',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.CACHE_CLEANUP_WORKERS,
+            help='Threads removing files',
+        )
+        parser.add_argument(
+            '--rate',
+            type=int,
+            default=settings.CACHE_CLEANUP_MAX_FILE_OPS,
+            help='Maximum file operations (stats and removals) per second, 0 for no limit',
+        )
+        parser.add_argument(
+            '--orphan-age-hours',
+            type=int,
+            default=24,
+            help='Only remove orphaned files at least this old',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore the checkpoint of an interrupted run and start from the beginning',
+        )
 
     def handle(self, *args, **options):
-        days = options['days']
-        force = options['force']
-        unused = options['unused']
-        dry_run = options['dry_run']
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        self.workers = options['workers']
+        self.limiter = RateLimiter(options['rate'])
+        if options['restart']:
+            cache.delete_many([CHECKPOINT_KEY.format('entries'), CHECKPOINT_KEY.format('orphans')])
 
         now = timezone.now()
-        cutoff_date = now - timezone.timedelta(days=days)
-        
-        self.stdout.write(self.style.SUCCESS(f"Starting cache cleanup..."))
-        
-        # Get expired cache entries
-        if force:
-            expired_entries = SongCache.objects.filter(expires_at__lte=now)
-            self.stdout.write(f"Found {expired_entries.count()} expired cache entries")
-        else:
-            expired_entries = SongCache.objects.filter(created_at__lte=cutoff_date)
-            self.stdout.write(f"Found {expired_entries.count()} cache entries older than {days} days")
-        
-        # Get unused cache entries (not accessed in the last week)
-        if unused:
-            unused_cutoff = now - timezone.timedelta(days=7)
-            unused_entries = SongCache.objects.filter(last_accessed__lte=unused_cutoff)
-            self.stdout.write(f"Found {unused_entries.count()} unused cache entries (not accessed in 7 days)")
-            
-            # Combine with expired entries, removing duplicates
-            entries_to_delete = expired_entries.union(unused_entries)
+        self.stdout.write(self.style.SUCCESS("Starting cache cleanup..."))
+
+        if options['force']:
+            condition = Q(expires_at__lte=now)
+            description = "expired"
         else:
-            entries_to_delete = expired_entries
-        
-        # Prepare stats
-        total_size = 0
-        deleted_count = 0
-        error_count = 0
-        
-        # Process each entry
-        for entry in entries_to_delete:
-            try:
-                # Get file size before deletion
-                file_path = os.path.join(settings.MEDIA_ROOT, entry.local_path)
-                if os.path.exists(file_path):
-                    file_size = os.path.getsize(file_path)
-                    total_size += file_size
-                    
-                    if not dry_run:
-                        # Delete the file
-                        os.remove(file_path)
-                        
-                        # Also delete thumbnail if it exists
-                        thumbnail_path = f"{os.path.splitext(file_path)[0]}.jpg"
-                        if os.path.exists(thumbnail_path):
-                            os.remove(thumbnail_path)
-                        
-                        # Delete the database entry
-                        entry.delete()
-                    
-                    deleted_count += 1
-                    
-                    if deleted_count % 10 == 0:
-                        self.stdout.write(f"Processed {deleted_count} entries...")
-                    
-                else:
-                    # File doesn't exist but the DB entry does
-                    if not dry_run:
-                        entry.delete()
-                    self.stdout.write(self.style.WARNING(f"File not found: {file_path}, but DB entry was deleted"))
-                    
-            except Exception as e:
-                error_count += 1
-                logger.error(f"Error cleaning up cache entry {entry.id}: {e}")
-                self.stdout.write(self.style.ERROR(f"Error with {entry.song_url}: {e}"))
-        
-        # Convert total size to MB
+            condition = Q(created_at__lte=now - timezone.timedelta(days=options['days']))
+            description = f"older than {options['days']} days"
+        if options['unused']:
+            condition |= Q(accessed_at__lte=now - timezone.timedelta(days=7))
+            description += " or not accessed in 7 days"
+
+        deleted_count, total_size = self.cleanup_entries(condition)
         total_size_mb = total_size / (1024 * 1024)
-        
-        if dry_run:
-            self.stdout.write(self.style.SUCCESS(
-                f"DRY RUN: Would have deleted {deleted_count} cache entries "
-                f"({total_size_mb:.2f} MB) with {error_count} errors"
-            ))
-        else:
-            self.stdout.write(self.style.SUCCESS(
-                f"Successfully deleted {deleted_count} cache entries "
-                f"({total_size_mb:.2f} MB) with {error_count} errors"
-            ))
-        
+        prefix = "DRY RUN: Would have deleted" if self.dry_run else "Successfully deleted"
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {deleted_count} cache entries {description} ({total_size_mb:.2f} MB)"
+        ))
+
         # Optional: add cleanup for orphaned files not in database
-        if options.get('unused'):
+        if options['unused']:
             self.stdout.write("Checking for orphaned files...")
-            self.cleanup_orphaned_files(dry_run)
-    
-    def cleanup_orphaned_files(self, dry_run=False):
-        """Clean up files in the songs directory that are not referenced in the database"""
-        from songs.models import Song
-        
-        # Get all files referenced in the songs table
-        all_song_files = set(Song.objects.values_list('file', flat=True))
-        # Get all files referenced in the cache table
-        all_cache_files = set(SongCache.objects.values_list('local_path', flat=True))
-        
-        # Get all actual files in the songs directory
-        songs_dir = os.path.join(settings.MEDIA_ROOT, 'songs')
-        if not os.path.exists(songs_dir):
-            self.stdout.write(self.style.WARNING(f"Songs directory not found: {songs_dir}"))
-            return
-        
-        actual_files = []
-        for root, dirs, files in os.walk(songs_dir):
-            for file in files:
-                # Only consider mp3 files for cleaning
-                if file.lower().endswith('.mp3'):
-                    file_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(file_path, settings.MEDIA_ROOT)
-                    actual_files.append(rel_path)
-        
-        # Find orphaned files (in directory but not in DB)
-        orphaned_files = [f for f in actual_files if f not in all_song_files and f not in all_cache_files]
-        
-        if not orphaned_files:
-            self.stdout.write("No orphaned files found.")
-            return
-        
-        self.stdout.write(f"Found {len(orphaned_files)} orphaned files.")
-        
-        # Process orphaned files
+            self.cleanup_orphaned_files(options['orphan_age_hours'])
+
+    def _checkpoint(self, phase):
+        return cache.get(CHECKPOINT_KEY.format(phase))
+
+    def _save_checkpoint(self, phase, value):
+        if not self.dry_run:
+            cache.set(CHECKPOINT_KEY.format(phase), value, None)
+
+    def _clear_checkpoint(self, phase):
+        if not self.dry_run:
+            cache.delete(CHECKPOINT_KEY.format(phase))
+
+    def _remove_files(self, paths, executor):
+        """Remove files (rate limited, in the thread pool); returns bytes freed"""
+        if self.dry_run:
+            return 0
+        self.limiter.wait(len(paths))
+        return sum(executor.map(_unlink, paths))
+
+    def cleanup_entries(self, condition):
+        """
+        Delete matching SongCache rows and their files, batch by batch in id order.
+        Each batch is one SELECT, one DELETE and parallel unlinks; the last id
+        done is checkpointed.
+
+        Returns:
+            Tuple of (entries deleted, bytes of their files)
+        """
+        from songs import cache_manager
+
+        last_id = self._checkpoint('entries') or 0
+        if last_id:
+            self.stdout.write(f"Resuming after cache entry {last_id}")
+
+        deleted_count = 0
         total_size = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                batch = list(
+                    SongCache.objects.filter(condition, id__gt=last_id)
+                    .order_by('id')
+                    .values_list('id', 'song_url', 'file_path', 'file_size')[:self.batch_size]
+                )
+                if not batch:
+                    break
+
+                paths = [file_path for _, _, file_path, _ in batch if file_path]
+                # Songs sometimes point at the cached file itself
+                in_use = set(Song.objects.filter(file__in=paths).values_list('file', flat=True))
+                removable = [os.path.join(settings.MEDIA_ROOT, p) for p in paths if p not in in_use]
+
+                if self.dry_run:
+                    total_size += sum(file_size for *_, file_size in batch)
+                else:
+                    total_size += self._remove_files(removable, executor)
+                    SongCache.objects.filter(id__in=[row[0] for row in batch]).delete()
+                    cache_manager.release_bytes(sum(file_size for *_, file_size in batch))
+                    cache_manager.forget_entries(row[1] for row in batch)
+
+                deleted_count += len(batch)
+                last_id = batch[-1][0]
+                self._save_checkpoint('entries', last_id)
+                self.stdout.write(f"Processed {deleted_count} entries...")
+
+        self._clear_checkpoint('entries')
+        return deleted_count, total_size
+
+    def _walk_orphan_dirs(self, after):
+        for directory in sorted(ORPHAN_DIRS):
+            if after is not None and (directory,) < after[:1]:
+                continue
+            yield from _sorted_walk(settings.MEDIA_ROOT, (directory,), after)
+
+    def cleanup_orphaned_files(self, min_age_hours=24):
+        """
+        Remove files under songs/ and cache/ older than min_age_hours that no Song
+        or cache entry uses. Files are checked against the database a batch at a time instead
+        of loading every known path into memory, and the walk checkpoints the
+        last path done.
+        """
+        checkpoint = self._checkpoint('orphans')
+        if checkpoint:
+            self.stdout.write(f"Resuming after {'/'.join(checkpoint)}")
+        after = tuple(checkpoint) if checkpoint else None
+        cutoff = time.time() - min_age_hours * 3600
+
+        scanned = 0
         deleted_count = 0
-        
-        for rel_path in orphaned_files:
-            file_path = os.path.join(settings.MEDIA_ROOT, rel_path)
-            try:
-                if os.path.exists(file_path):
-                    file_size = os.path.getsize(file_path)
-                    total_size += file_size
-                    
-                    # Get file creation time and check if it's older than 1 day
-                    # Only delete files that are at least a day old
-                    file_ctime = os.path.getctime(file_path)
-                    file_age = timezone.now() - timezone.datetime.fromtimestamp(file_ctime, tz=timezone.get_current_timezone())
-                    
-                    if file_age.days >= 1:
-                        self.stdout.write(f"Orphaned file: {rel_path} ({file_size / (1024*1024):.2f} MB)")
-                        if not dry_run:
-                            os.remove(file_path)
-                            # Also check for thumbnail
-                            thumbnail_path = f"{os.path.splitext(file_path)[0]}.jpg"
-                            if os.path.exists(thumbnail_path):
-                                os.remove(thumbnail_path)
-                            deleted_count += 1
-            except Exception as e:
-                logger.error(f"Error cleaning up orphaned file {rel_path}: {e}")
-                self.stdout.write(self.style.ERROR(f"Error with {rel_path}: {e}"))
-        
-        # Convert total size to MB
+        total_size = 0
+        batch = []
+
+        def flush(executor):
+            nonlocal deleted_count, total_size
+            rel_paths = ['/'.join(parts) for parts, _ in batch]
+            known = set(Song.objects.filter(file__in=rel_paths).values_list('file', flat=True))
+            known |= set(SongCache.objects.filter(file_path__in=rel_paths).values_list('file_path', flat=True))
+            orphans = [(rel, size) for rel, (_, size) in zip(rel_paths, batch) if rel not in known]
+            for rel_path, size in orphans:
+                logger.debug(f"Orphaned file: {rel_path} ({size / (1024*1024):.2f} MB)")
+            if self.dry_run:
+                total_size += sum(size for _, size in orphans)
+            else:
+                total_size += self._remove_files([os.path.join(settings.MEDIA_ROOT, rel) for rel, _ in orphans], executor)
+            deleted_count += len(orphans)
+            self._save_checkpoint('orphans', list(batch[-1][0]))
+            batch.clear()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for parts, entry in self._walk_orphan_dirs(after):
+                if not entry.name.lower().endswith('.mp3'):
+                    continue
+                self.limiter.wait()
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                scanned += 1
+                # Leave recent files alone, they may belong to a download in progress
+                if stat.st_ctime > cutoff:
+                    continue
+                batch.append((parts, stat.st_size))
+                if len(batch) >= self.batch_size:
+                    flush(executor)
+            if batch:
+                flush(executor)
+
+        self._clear_checkpoint('orphans')
         total_size_mb = total_size / (1024 * 1024)
-        
-        if dry_run:
-            self.stdout.write(self.style.SUCCESS(
-                f"DRY RUN: Would have deleted {deleted_count} orphaned files ({total_size_mb:.2f} MB)"
-            ))
-        else:
-            self.stdout.write(self.style.SUCCESS(
-                f"Successfully deleted {deleted_count} orphaned files ({total_size_mb:.2f} MB)"
-            )) 
\ No newline at end of file
+        prefix = "DRY RUN: Would have deleted" if self.dry_run else "Successfully deleted"
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {deleted_count} orphaned files of {scanned} scanned ({total_size_mb:.2f} MB)"
+        ))
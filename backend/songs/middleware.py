@@ -0,0 +1,47 @@
+import os
+import time
+import logging
+from django.conf import settings
+from django.http import HttpResponseForbidden, HttpResponseNotFound
+from django.utils.cache import patch_cache_control
+
+from .signing import normalize_media_path, verify_media_signature, media_file_path
+
+logger = logging.getLogger(__name__)
+
+
+class SignedMediaMiddleware:
+    """
+    Serve files behind URLs made by signing.sign_media_path.
+    The HMAC signature is checked before anything else runs, so plays and
+    downloads through these URLs need no session, user or database lookup.
+    Other requests pass straight through.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        prefix = settings.SIGNED_MEDIA_URL
+        if not request.path.startswith(prefix) or request.method not in ('GET', 'HEAD'):
+            return self.get_response(request)
+
+        from .delivery import serve_cold_file, serve_file
+
+        # request.path is already percent-decoded
+        rel_path = normalize_media_path(request.path[len(prefix):])
+        expires = request.GET.get('expires')
+        if rel_path is None or not verify_media_signature(rel_path, expires, request.GET.get('sig')):
+            logger.warning(f"Rejected signed media request for {request.path}")
+            return HttpResponseForbidden("Invalid or expired link")
+
+        path = media_file_path(rel_path)
+        if os.path.isfile(path):
+            response = serve_file(request, path, as_attachment='download' in request.GET)
+        else:
+            response = serve_cold_file(rel_path, as_attachment='download' in request.GET)
+            if response is None:
+                return HttpResponseNotFound("File not found")
+        # Browsers may reuse the file until the link expires
+        patch_cache_control(response, private=True, max_age=max(0, int(expires) - int(time.time())))
+        return response
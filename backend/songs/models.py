@@ -1,14 +1,18 @@
 from django.db import models
 from django.conf import settings
-from django.db.models import Count, Q, Sum, Avg
+from django.db.models import Count, Q, Sum, Avg, F
+from django.db.models.functions import Least
 from django.urls import reverse
 import os
+import uuid
 import logging
 from django.utils import timezone
 from datetime import timedelta
 from django.utils.text import Truncator
 from django.db import transaction
 
+from .storage import tiered_storage
+
 logger = logging.getLogger(__name__)
 
     
@@ -42,7 +46,7 @@ class Song(models.Model):
     genre = models.CharField(max_length=100, blank=True, null=True)
     year = models.IntegerField(blank=True, null=True)
     # Increase max_length for the file path
-    file = models.FileField(upload_to='songs/', max_length=500, blank=True, null=True) 
+    file = models.FileField(upload_to='songs/', max_length=500, blank=True, null=True, storage=tiered_storage) 
     waveform = models.JSONField(blank=True, null=True)
     duration = models.FloatField(blank=True, null=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='processing')
@@ -118,6 +122,16 @@ class Song(models.Model):
 
     def save(self, *args, **kwargs):
         """Truncate fields if necessary before saving"""
+        self.truncate_fields()
+
+        # Call the parent save method
+        super(Song, self).save(*args, **kwargs)
+
+    def truncate_fields(self):
+        """
+        Truncate fields to fit their columns.
+        Called by save(); call it directly before bulk_create, which skips save().
+        """
         # Truncate text fields to their max lengths (using 95-98 to be safe)
         if self.title and len(self.title) > 98:
             self.title = Truncator(self.title).chars(98)
@@ -146,9 +160,6 @@ class Song(models.Model):
             self.thumbnail_url = self.thumbnail_url.encode('ascii', 'ignore').decode('ascii')
             if len(self.thumbnail_url) > 190:
                 self.thumbnail_url = Truncator(self.thumbnail_url).chars(190)
-                
-        # Call the parent save method
-        super(Song, self).save(*args, **kwargs)
 
 class Playlist(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -208,18 +219,456 @@ class UserMusicProfile(models.Model):
                     except Exception as e:
                         logger.warning(f"Error adding genre {genre_name}: {e}")
 
+    @classmethod
+    def record_downloads(cls, user, songs):
+        """
+        Batch version of update_profile for many new songs:
+        one counter update instead of a save per song
+        """
+        profile, created = cls.objects.get_or_create(user=user)
+        cls.objects.filter(pk=profile.pk).update(
+            total_songs_downloaded=F('total_songs_downloaded') + len(songs)
+        )
+
+        genre_names = set()
+        for song in songs:
+            if song.genre:
+                genre_names.update(g.strip() for g in song.genre.replace('/', ',').split(',') if g.strip())
+        for genre_name in genre_names:
+            try:
+                with transaction.atomic():
+                    genre, created = Genre.objects.get_or_create(name=genre_name)
+                    profile.favorite_genres.add(genre)
+            except Exception as e:
+                logger.warning(f"Error adding genre {genre_name}: {e}")
+
+        return profile
+
 class DownloadProgress(models.Model):
     task_id = models.CharField(max_length=255, unique=True)
     current_progress = models.IntegerField(default=0)
     total_items = models.IntegerField(default=0)
+    completed_items = models.IntegerField(default=0)
     current_file = models.CharField(max_length=255, blank=True)
     started_at = models.DateTimeField(auto_now_add=True)
     last_update = models.DateTimeField(auto_now=True)
     estimated_completion_time = models.DateTimeField(null=True, blank=True)
 
+    @classmethod
+    def add_completed(cls, task_id, count, current_file=None):
+        """
+        Count finished items with a single UPDATE, safe to call from
+        several threads or workers sharing one progress row
+        """
+        updates = {
+            'completed_items': F('completed_items') + count,
+            # Stays below 100 until the owner marks the download complete
+            'current_progress': Least(99, (F('completed_items') + count) * 100 / F('total_items')),
+            'last_update': timezone.now(),
+        }
+        if current_file:
+            updates['current_file'] = current_file[:255]
+        return cls.objects.filter(task_id=task_id, total_items__gt=0).update(**updates)
+
+class DownloadJob(models.Model):
+    """
+    A single-track download submitted through the jobs API and processed on Celery,
+    so request workers are not held for the duration of the download
+    """
+
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='download_jobs')
+    url = models.URLField(max_length=500)
+    output_format = models.CharField(max_length=10, default='mp3')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    priority = models.PositiveSmallIntegerField(default=0, help_text="Celery priority the job was queued with")
+    progress = models.PositiveSmallIntegerField(default=0, help_text="Progress in percent")
+    stage = models.CharField(max_length=255, blank=True)
+    task_id = models.CharField(max_length=255, blank=True)
+    song = models.ForeignKey(Song, on_delete=models.SET_NULL, null=True, blank=True, related_name='download_jobs')
+    file_path = models.CharField(max_length=500, blank=True, help_text="Path of the finished file relative to MEDIA_ROOT")
+    filename = models.CharField(max_length=255, blank=True)
+    content_type = models.CharField(max_length=50, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.status}): {self.url}"
+
+    @property
+    def is_finished(self):
+        return self.status in ('completed', 'failed')
+
+    @classmethod
+    def pending_count(cls, user):
+        """Jobs of user's still queued or running; each counts towards the daily limit when it finishes"""
+        return cls.objects.filter(user=user, status__in=('queued', 'running')).count()
+
+    def update_progress(self, percent, stage):
+        """Record progress with a single UPDATE so it is cheap to call from workers"""
+        self.progress = max(0, min(int(percent), 100))
+        self.stage = stage[:255]
+        DownloadJob.objects.filter(pk=self.pk).update(
+            progress=self.progress,
+            stage=self.stage,
+            updated_at=timezone.now()
+        )
+
+    def to_dict(self):
+        """Serialise the job for the status and event endpoints"""
+        return {
+            'job_id': str(self.id),
+            'url': self.url,
+            'format': self.output_format,
+            'status': self.status,
+            'progress': self.progress,
+            'stage': self.stage,
+            'song_id': self.song_id,
+            'error': self.error or None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+class SpotifyMatch(models.Model):
+    """
+    Remembers which YouTube video a Spotify track resolved to, so later
+    downloads of the same track skip the search and fetch that video directly
+    """
+    spotify_id = models.CharField(max_length=50, unique=True)
+    youtube_id = models.CharField(max_length=20)
+    youtube_title = models.CharField(max_length=255, blank=True)
+    confidence = models.FloatField(default=0, help_text="How closely the video title matched the track (0-1)")
+    last_verified_at = models.DateTimeField(help_text="Last time a download from this video succeeded")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.spotify_id} -> {self.youtube_id} ({self.confidence:.2f})"
+
+    @property
+    def youtube_url(self):
+        return f"https://www.youtube.com/watch?v={self.youtube_id}"
+
+    @staticmethod
+    def score(title, artist, youtube_title):
+        """Confidence that a YouTube video title is the given track"""
+        from difflib import SequenceMatcher
+
+        if not youtube_title:
+            return 0.0
+        expected = f"{artist} {title}".lower()
+        found = youtube_title.lower()
+        ratio = SequenceMatcher(None, expected, found).ratio()
+        # Titles like "Artist - Song (Official Video)" contain both parts but score low on ratio alone
+        if title and artist and title.lower() in found and artist.lower() in found:
+            ratio = max(ratio, 0.9)
+        return round(ratio, 3)
+
+    @classmethod
+    def lookup(cls, spotify_id):
+        """Get a trusted, recently verified match for a Spotify track, or None"""
+        if not spotify_id:
+            return None
+        return cls.objects.filter(
+            spotify_id=spotify_id,
+            confidence__gte=settings.SPOTIFY_MATCH_MIN_CONFIDENCE,
+            last_verified_at__gt=timezone.now() - timedelta(days=settings.SPOTIFY_MATCH_MAX_AGE_DAYS)
+        ).first()
+
+    @classmethod
+    def build(cls, spotify_id, youtube_id, title=None, artist=None, youtube_title=None):
+        """Build (but don't save) a match from a successful download, or None if ids are missing"""
+        if not spotify_id or not youtube_id:
+            return None
+        return cls(
+            spotify_id=spotify_id[:50],
+            youtube_id=youtube_id[:20],
+            youtube_title=(youtube_title or '')[:255],
+            # Without a video title there is nothing to score; trust the search at the threshold
+            confidence=cls.score(title, artist, youtube_title) if youtube_title else settings.SPOTIFY_MATCH_MIN_CONFIDENCE,
+            last_verified_at=timezone.now()
+        )
+
+    @classmethod
+    def remember(cls, matches):
+        """Upsert matches built with build(), skipping any that are None"""
+        matches = [m for m in matches if m is not None]
+        if not matches:
+            return 0
+        try:
+            cls.objects.bulk_create(
+                matches,
+                update_conflicts=True,
+                unique_fields=['spotify_id'],
+                update_fields=['youtube_id', 'youtube_title', 'confidence', 'last_verified_at']
+            )
+        except Exception as e:
+            logger.warning(f"Error saving Spotify matches: {e}")
+            return 0
+        return len(matches)
+
+    @classmethod
+    def forget(cls, spotify_id):
+        """Drop a match whose video can no longer be downloaded"""
+        cls.objects.filter(spotify_id=spotify_id).delete()
+
+class MediaFileIndex(models.Model):
+    """
+    Maps a track's canonical source key (see utils.canonical_key) to a file
+    under MEDIA_ROOT that was verified to exist. Written whenever a download
+    stores a file and repaired by the reconcile_media_index task, so finding a
+    song's file never needs a directory scan.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    file_path = models.CharField(max_length=500)
+    file_size = models.PositiveBigIntegerField(default=0)
+    verified_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.key} -> {self.file_path}"
+
+    @classmethod
+    def record(cls, entries):
+        """
+        Upsert (key, rel_path) pairs for files that were just written.
+        Pairs with no key or a missing file are skipped.
+        """
+        now = timezone.now()
+        rows = {}
+        for key, rel_path in entries:
+            if not key or not rel_path:
+                continue
+            try:
+                size = os.path.getsize(os.path.join(settings.MEDIA_ROOT, rel_path))
+            except OSError:
+                continue
+            rows[key] = cls(key=key, file_path=rel_path, file_size=size, verified_at=now)
+        if not rows:
+            return 0
+        try:
+            cls.objects.bulk_create(
+                list(rows.values()),
+                update_conflicts=True,
+                unique_fields=['key'],
+                update_fields=['file_path', 'file_size', 'verified_at']
+            )
+        except Exception as e:
+            logger.warning(f"Error updating media file index: {e}")
+            return 0
+        return len(rows)
+
+    @classmethod
+    def record_songs(cls, songs):
+        """Index the files of freshly saved songs"""
+        from .utils import canonical_key
+        return cls.record(
+            (canonical_key(song.song_url), song.file.name)
+            for song in songs if song.file
+        )
+
+    @classmethod
+    def resolve(cls, keys):
+        """
+        Look up files for many keys with one query. Each hit costs a single stat;
+        entries whose file has gone are left for the reconciler.
+
+        Returns:
+            Dict mapping key to absolute file path
+        """
+        keys = [k for k in keys if k]
+        if not keys:
+            return {}
+        resolved = {}
+        for key, rel_path in cls.objects.filter(key__in=keys).values_list('key', 'file_path'):
+            path = os.path.join(settings.MEDIA_ROOT, rel_path)
+            if os.path.isfile(path):
+                resolved[key] = path
+        return resolved
+
+    @classmethod
+    def resolve_songs(cls, songs):
+        """
+        Map songs to their audio files without guessing paths or scanning directories:
+        the stored path is used if it exists, otherwise the index entry for the song's
+        source (one query for all of them). Stale paths are repaired in the background
+        by the reconcile_media_index task.
+
+        Returns:
+            Dict of song id -> absolute path, or a storage.ColdFile for songs only
+            in the cold tier, for the songs that were found
+        """
+        from .storage import cold_file
+        from .utils import canonical_key
+
+        paths = {}
+        unresolved = {}
+        for song in songs:
+            if song.file:
+                # Cold files are read from the cold tier; rebalance() decides when to bring them back
+                path = os.path.join(settings.MEDIA_ROOT, song.file.name)
+                source = path if os.path.isfile(path) else cold_file(path)
+                if source:
+                    paths[song.id] = source
+                    continue
+            key = canonical_key(song.song_url)
+            if key:
+                unresolved.setdefault(key, []).append(song.id)
+
+        if unresolved:
+            for key, path in cls.resolve(list(unresolved)).items():
+                for song_id in unresolved[key]:
+                    paths[song_id] = path
+        return paths
+
+class PlaylistArchive(models.Model):
+    """
+    A prebuilt ZIP of a playlist's songs. The key hashes the ordered list of
+    (name in archive, file identity) entries, so it changes whenever membership,
+    order or a song file changes, and an archive with a given key always has the
+    same bytes; the key is used as the archive's strong ETag.
+    """
+    playlist = models.ForeignKey(Playlist, on_delete=models.CASCADE, related_name='archives')
+    key = models.CharField(max_length=64)
+    manifest = models.JSONField(default=list)  # [[arcname, file identity], ...] in archive order
+    file_path = models.CharField(max_length=500)
+    file_size = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('playlist', 'key')
+
+    def __str__(self):
+        return f"{self.playlist_id}: {self.key[:12]} ({len(self.manifest)} songs)"
+
+    @property
+    def full_path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.file_path)
+
+    @property
+    def etag(self):
+        return f'"{self.key}"'
+
+    @staticmethod
+    def playlist_songs(playlist):
+        """
+        The playlist's songs in the order they were added, so songs added later
+        come last and a rebuild can append them to the previous archive
+        """
+        song_ids = list(
+            Playlist.songs.through.objects.filter(playlist=playlist).order_by('id').values_list('song_id', flat=True)
+        )
+        songs = Song.objects.in_bulk(song_ids)
+        return [songs[song_id] for song_id in song_ids if song_id in songs]
+
+    @staticmethod
+    def collect_files(songs):
+        """
+        The (arcname, path or storage.ColdFile) pairs of a playlist archive, in the order of songs
+
+        Returns:
+            Tuple of (files, list of songs whose file wasn't found)
+        """
+        from .utils import sanitize_filename
+
+        paths = MediaFileIndex.resolve_songs(songs)
+        files = []
+        missing = []
+        for song in songs:
+            if song.id in paths:
+                files.append((sanitize_filename(f"{song.title} - {song.artist}.mp3"), paths[song.id]))
+            else:
+                missing.append(song)
+        return files, missing
+
+    @staticmethod
+    def manifest_for(files):
+        """
+        Build the manifest and key for (arcname, path) pairs. A file's identity is
+        its path, size and mtime, so this costs one stat per song (cold files
+        were already sized when they were resolved).
+
+        Returns:
+            Tuple of (key, manifest)
+        """
+        import hashlib
+        from .storage import ColdFile
+
+        manifest = []
+        for arcname, path in files:
+            if isinstance(path, ColdFile):
+                identity = f"{path.rel_path}:{path.size}:cold:{int(path.mtime)}"
+            else:
+                stat = os.stat(path)
+                identity = f"{os.path.relpath(path, settings.MEDIA_ROOT)}:{stat.st_size}:{stat.st_mtime_ns}"
+            manifest.append([arcname, identity])
+        digest = hashlib.sha256()
+        for arcname, identity in manifest:
+            digest.update(f"{arcname}\0{identity}\n".encode('utf-8'))
+        return digest.hexdigest(), manifest
+
+    @classmethod
+    def current(cls, playlist, key):
+        """The playlist's archive for key if it was built and its file is still there"""
+        archive = cls.objects.filter(playlist=playlist, key=key).first()
+        if archive and os.path.isfile(archive.full_path):
+            return archive
+        return None
+
+    @classmethod
+    def appendable_base(cls, playlist, manifest):
+        """
+        Latest archive of the playlist whose entries are a strict prefix of manifest,
+        which a rebuild can extend instead of rewriting
+        """
+        for archive in cls.objects.filter(playlist=playlist).order_by('-created_at'):
+            count = len(archive.manifest)
+            if 0 < count < len(manifest) and archive.manifest == manifest[:count] and os.path.isfile(archive.full_path):
+                return archive
+        return None
+
+class StoredBlob(models.Model):
+    """
+    Placement of an audio file referenced by a Song or SongCache entry: hot (on
+    local disk under MEDIA_ROOT) or cold (only in the cold storage tier), with
+    the read counts storage.rebalance() uses to move it between tiers. Hard
+    links of one file (a song and its cache/ name) share a cold_name and are
+    counted and moved together.
+    """
+    HOT = 'hot'
+    COLD = 'cold'
+    TIER_CHOICES = [(HOT, 'Hot (local disk)'), (COLD, 'Cold (object store)')]
+
+    path = models.CharField(max_length=500, unique=True)  # Relative to MEDIA_ROOT
+    cold_name = models.CharField(max_length=500, blank=True, db_index=True)  # Name of the cold copy; shared by hard links
+    size = models.PositiveBigIntegerField(default=0)
+    tier = models.CharField(max_length=4, choices=TIER_CHOICES, default=HOT)
+    access_count = models.PositiveIntegerField(default=0)  # Halved on every rebalance
+    last_accessed = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['tier', 'access_count', 'last_accessed'])]
+
+    def __str__(self):
+        return f"{self.path} ({self.tier})"
+
 class SongCache(models.Model):
     """Cache for downloaded songs to avoid repeated downloads"""
     song_url = models.URLField(unique=True)
+    source_key = models.CharField(max_length=255, blank=True, null=True, db_index=True, help_text="utils.canonical_key of song_url")
     file_path = models.CharField(max_length=255)
     file_size = models.PositiveIntegerField(default=0)
     title = models.CharField(max_length=255, blank=True, null=True)
@@ -228,46 +677,195 @@ class SongCache(models.Model):
     accessed_at = models.DateTimeField(auto_now=True)
     expires_at = models.DateTimeField()
     metadata = models.JSONField(default=dict, blank=True, null=True)
+    hit_count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        # Eviction order for the lru and lfu policies (see cache_manager)
+        indexes = [
+            models.Index(fields=['accessed_at']),
+            models.Index(fields=['hit_count', 'accessed_at']),
+        ]
     
     def __str__(self):
         return f"Cache: {self.song_url}"
     
+    @classmethod
+    def _load_unexpired(cls, urls):
+        """
+        Unexpired entries for urls in one query, matched by URL or else by
+        canonical key, so another spelling of a cached track is a hit too
+
+        Returns:
+            Dict mapping each found url to its entry
+        """
+        from .utils import canonical_key
+        keys = {url: canonical_key(url) for url in urls}
+        rows = cls.objects.filter(
+            Q(song_url__in=list(keys)) | Q(source_key__in=[key for key in keys.values() if key]),
+            expires_at__gt=timezone.now()
+        )
+        by_url = {}
+        by_key = {}
+        for row in rows:
+            by_url[row.song_url] = row
+            if row.source_key:
+                by_key.setdefault(row.source_key, row)
+        found = {url: by_url.get(url) or by_key.get(key) for url, key in keys.items()}
+        return {url: entry for url, entry in found.items() if entry is not None}
+
     @classmethod
     def get_cached_song(cls, url):
         """Get a song from cache if it exists and is not expired"""
-        try:
-            cache = cls.objects.get(song_url=url, expires_at__gt=timezone.now())
-            # Update accessed time
-            cache.accessed_at = timezone.now()
-            cache.save(update_fields=['accessed_at'])
-            return cache
-        except cls.DoesNotExist:
-            return None
+        from . import cache_manager
+        # The shared cache holds copies of recently used entries, so most hits skip the database
+        cache = cache_manager.cached_entries([url]).get(url)
+        if cache is None:
+            cache = cls._load_unexpired([url]).get(url)
+            if cache is not None:
+                cache_manager.remember_entries([cache])
+        # Access time and use count are buffered and written in batches
+        if cache is not None:
+            cache_manager.touch([cache.song_url])
+        cache_manager.record_lookup(url, cache)
+        return cache
     
     @classmethod
-    def add_to_cache(cls, url, file_path, title=None, artist=None, expires_days=7):
-        """Add a song to the cache"""
-        try:
-            # Get file size
-            full_path = os.path.join(settings.MEDIA_ROOT, file_path)
-            file_size = os.path.getsize(full_path) if os.path.exists(full_path) else 0
-            
-            # Create or update cache entry
-            cls.objects.update_or_create(
+    def get_cached_songs(cls, urls):
+        """
+        Batch version of get_cached_song: one shared cache round trip for all
+        URLs and one query for those it doesn't have
+
+        Returns:
+            Dict mapping song_url to its unexpired SongCache entry
+        """
+        from . import cache_manager
+        urls = list(urls)
+        entries = cache_manager.cached_entries(urls)
+        missing = [url for url in urls if url not in entries]
+        if missing:
+            loaded = cls._load_unexpired(missing)
+            cache_manager.remember_entries(set(loaded.values()))
+            entries.update(loaded)
+        cache_manager.touch({entry.song_url for entry in entries.values()})
+        for url in urls:
+            cache_manager.record_lookup(url, entries.get(url))
+        return entries
+
+    @classmethod
+    def store(cls, url, **fields):
+        """
+        Create or update the entry for url and keep the cache within its byte
+        budget. The entry may be evicted again straight away by an admission policy.
+
+        Returns:
+            The entry if it was kept, otherwise None
+        """
+        from . import cache_manager
+        from .utils import canonical_key
+        fields.setdefault('source_key', canonical_key(url))
+        previous = cls.objects.filter(song_url=url).values_list('file_size', flat=True).first() or 0
+        entry, _ = cls.objects.update_or_create(song_url=url, defaults=fields)
+        kept = cache_manager.admit([entry], replaced_bytes=previous)
+        if not kept:
+            return None
+        cache_manager.remember_entries(kept)
+        return entry
+
+    @classmethod
+    def store_many(cls, entries):
+        """Batch version of store for unsaved SongCache instances: one upsert for all of them"""
+        from . import cache_manager
+        from .utils import canonical_key
+        entries = list(entries)
+        if not entries:
+            return []
+        for entry in entries:
+            entry.source_key = entry.source_key or canonical_key(entry.song_url)
+        previous = cls.objects.filter(song_url__in=[e.song_url for e in entries]).aggregate(total=Sum('file_size'))['total'] or 0
+        cls.objects.bulk_create(
+            entries,
+            update_conflicts=True,
+            unique_fields=['song_url'],
+            update_fields=['source_key', 'file_path', 'file_size', 'expires_at', 'metadata', 'title', 'artist']
+        )
+        kept = cache_manager.admit(entries, replaced_bytes=previous)
+        # Stale copies of replaced entries; kept ones are cached again on their next lookup
+        cache_manager.forget_entries(e.song_url for e in entries)
+        return kept
+
+    @classmethod
+    def ingest(cls, url, rel_path, metadata, expires_days=None):
+        """
+        Add a finished download to the cache. Every download path comes through
+        here (or ingest_many), so entries look the same whichever path made them.
+
+        Args:
+            url: The source URL the file was downloaded from
+            rel_path: The downloaded file, relative to MEDIA_ROOT
+            metadata: Track metadata; see cache_manager.METADATA_FIELDS
+            expires_days: Days the entry stays valid, SONG_CACHE_EXPIRY_DAYS by default
+
+        Returns:
+            The entry, or None if it couldn't be cached or admission dropped it
+        """
+        kept = cls.ingest_many([(url, rel_path, metadata)], expires_days)
+        return kept[0] if kept else None
+
+    @classmethod
+    def ingest_many(cls, items, expires_days=None):
+        """
+        Batch version of ingest for (url, rel_path, metadata) items. Each file is
+        linked into cache/ first (an atomic rename), then every row, carrying the
+        canonical source key, file size and normalized metadata, is written in
+        one upsert; if that fails the new links are removed again. Never raises:
+        a download that can't be cached is logged and counted, not failed.
+
+        Returns:
+            List of entries kept in the cache
+        """
+        from . import cache_manager
+        from .utils import canonical_key
+
+        items = list(items)
+        expires_at = timezone.now() + timedelta(days=expires_days or settings.SONG_CACHE_EXPIRY_DAYS)
+        entries = {}
+        for url, rel_path, metadata in items:
+            key = canonical_key(url)
+            if not key or not rel_path:
+                logger.warning(f"Not caching download without a source URL or file: {url!r}, {rel_path!r}")
+                continue
+            try:
+                cache_path, file_size = cache_manager.link_blob(rel_path, key)
+            except OSError as e:
+                logger.warning(f"Could not add {rel_path} to the song cache: {e}")
+                continue
+            metadata = cache_manager.cache_metadata(metadata or {})
+            entries[url] = cls(
                 song_url=url,
-                defaults={
-                    'file_path': file_path,
-                    'file_size': file_size,
-                    'title': title,
-                    'artist': artist,
-                    'expires_at': timezone.now() + timedelta(days=expires_days)
-                }
+                source_key=key,
+                file_path=cache_path,
+                file_size=file_size,
+                title=Truncator(metadata['title']).chars(255),
+                artist=Truncator(metadata['artist']).chars(255),
+                metadata=metadata,
+                expires_at=expires_at
             )
-            logger.info(f"Added song to cache: {url}")
-            return True
+
+        kept = []
+        try:
+            kept = cls.store_many(entries.values())
+            logger.info(f"Added {len(kept)} of {len(items)} downloads to the song cache")
         except Exception as e:
-            logger.error(f"Error adding song to cache: {str(e)}", exc_info=True)
-            return False
+            logger.error(f"Error adding downloads to the song cache: {e}", exc_info=True)
+            cache_manager.unlink_blobs(entry.file_path for entry in entries.values())
+            entries = {}
+        cache_manager.record_downloads(len(items), len(entries))
+        return kept
+
+    @classmethod
+    def add_to_cache(cls, url, file_path, title=None, artist=None, expires_days=7):
+        """Add a song to the cache"""
+        return cls.ingest(url, file_path, {'title': title, 'artist': artist}, expires_days) is not None
     
     @classmethod
     def clean_expired(cls):
@@ -286,7 +884,12 @@ class SongCache(models.Model):
                 pass
         
         # Delete database records
+        freed = expired.aggregate(total=Sum('file_size'))['total'] or 0
+        urls = list(expired.values_list('song_url', flat=True))
         expired.delete()
+        from . import cache_manager
+        cache_manager.release_bytes(freed)
+        cache_manager.forget_entries(urls)
         
         # Delete files
         for path in paths_to_delete:
@@ -297,6 +900,86 @@ class SongCache(models.Model):
         
         return count
 
+class TranscodedVariant(models.Model):
+    """
+    A source audio file transcoded to another format/bitrate, kept under
+    MEDIA_ROOT/transcodes so each variant is only converted once. Keyed by the
+    source's content hash, so copies of the same file share their variants.
+    """
+    source_hash = models.CharField(max_length=64)
+    format = models.CharField(max_length=10)
+    bitrate = models.CharField(max_length=10, blank=True, default='')
+    file_path = models.CharField(max_length=255)
+    file_size = models.PositiveBigIntegerField(default=0)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_accessed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        unique_together = ('source_hash', 'format', 'bitrate')
+
+    def __str__(self):
+        return f"{self.source_hash[:12]} -> {self.format}{f' @ {self.bitrate}' if self.bitrate else ''}"
+
+    @property
+    def full_path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.file_path)
+
+    @classmethod
+    def lookup(cls, source_hash, format, bitrate=None):
+        """Get a variant whose file is still on disk and mark it used, or None"""
+        variant = cls.objects.filter(source_hash=source_hash, format=format, bitrate=bitrate or '').first()
+        if variant is None:
+            return None
+        if not os.path.exists(variant.full_path):
+            variant.delete()
+            return None
+        cls.objects.filter(pk=variant.pk).update(last_accessed=timezone.now(), hit_count=F('hit_count') + 1)
+        return variant
+
+    @classmethod
+    def record(cls, source_hash, format, bitrate, file_path):
+        """Register a freshly published variant file and evict old ones if over budget"""
+        full_path = os.path.join(settings.MEDIA_ROOT, file_path)
+        variant, _ = cls.objects.update_or_create(
+            source_hash=source_hash,
+            format=format,
+            bitrate=bitrate or '',
+            defaults={
+                'file_path': file_path,
+                'file_size': os.path.getsize(full_path),
+                'last_accessed': timezone.now(),
+            }
+        )
+        cls.evict()
+        return variant
+
+    @classmethod
+    def evict(cls, max_bytes=None):
+        """Delete least recently used variants until the total size fits max_bytes"""
+        if max_bytes is None:
+            max_bytes = settings.TRANSCODE_CACHE_MAX_BYTES
+        total = cls.objects.aggregate(total=Sum('file_size'))['total'] or 0
+        if total <= max_bytes:
+            return 0
+
+        evicted = 0
+        for variant in cls.objects.order_by('last_accessed').iterator():
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(variant.full_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove transcoded variant {variant.file_path}: {e}")
+                continue
+            variant.delete()
+            total -= variant.file_size
+            evicted += 1
+        logger.info(f"Evicted {evicted} transcoded variants, {total} bytes remain")
+        return evicted
+
 class SongPlay(models.Model):
     """
     Track each time a song is played
@@ -380,6 +1063,22 @@ class UserAnalytics(models.Model):
         analytics.save(update_fields=['songs_downloaded'])
         logger.info(f"[DEBUG] record_download updated analytics: user={user.username} id={user.id} date={today} songs_downloaded={analytics.songs_downloaded}")
         return analytics
+
+    @classmethod
+    def record_downloads(cls, user, count):
+        """Record several downloads in today's analytics with a single F() update"""
+        if count <= 0:
+            return None
+        today = timezone.now().date()
+        analytics, created = cls.objects.get_or_create(
+            user=user,
+            date=today,
+            defaults={
+                'downloads_available': 50 if user.is_subscription_active() else 15,
+            }
+        )
+        cls.objects.filter(pk=analytics.pk).update(songs_downloaded=F('songs_downloaded') + count)
+        return analytics
         
     @classmethod
     def get_user_stats(cls, user, days=30):
@@ -0,0 +1,350 @@
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's input
+_STOP = object()
+
+# Process pool shared by every pipeline in this process when PIPELINE_USE_PROCESSES is on
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def _init_process_worker():
+    """
+    Initializer for CPU-stage worker processes.
+    Workers are spawned rather than forked, so Django has to be set up again and
+    no database connection or lock is ever shared with the parent.
+    """
+    import django
+    django.setup()
+
+
+def _shared_process_pool():
+    """
+    The long-lived CPU-stage process pool, started on first use. Children are
+    spawned and set Django up once, then serve every later pipeline, so no
+    request pays for process startup.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=settings.PIPELINE_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_process_worker
+            )
+        return _process_pool
+
+
+class StageStats:
+    """Counters and timings for one pipeline stage"""
+
+    def __init__(self, name, workers, input_queue=None):
+        self.name = name
+        self.workers = workers
+        self.input_queue = input_queue
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, failed=False):
+        with self._lock:
+            self.busy_seconds += seconds
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+
+    def sample_queue(self):
+        if self.input_queue is not None:
+            depth = self.input_queue.qsize()
+            with self._lock:
+                self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def as_dict(self):
+        handled = self.processed + self.failed
+        return {
+            'workers': self.workers,
+            'processed': self.processed,
+            'failed': self.failed,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'avg_seconds': round(self.busy_seconds / handled, 3) if handled else 0,
+            'queue_depth': self.input_queue.qsize() if self.input_queue is not None else 0,
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+
+class ThrottledProgress:
+    """
+    Pipeline on_progress callback that counts finished items in memory and
+    flushes them at most once every interval seconds, instead of writing a
+    progress row per track.
+
+    Args:
+        flush: Callable(count, label) persisting count newly finished items and
+            the label of the latest one
+        interval: Seconds between flushes, defaults to DOWNLOAD_PROGRESS_FLUSH_INTERVAL
+    """
+
+    def __init__(self, flush, interval=None):
+        self._flush = flush
+        self.interval = interval if interval is not None else settings.DOWNLOAD_PROGRESS_FLUSH_INTERVAL
+        self.done = 0
+        self.succeeded = 0
+        self._pending = 0
+        self._label = None
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, label, succeeded):
+        with self._lock:
+            self.done += 1
+            self.succeeded += int(bool(succeeded))
+            self._pending += 1
+            self._label = label or self._label
+            if time.monotonic() - self._last_flush >= self.interval:
+                self._flush_locked()
+
+    def flush(self):
+        """Write out anything not flushed yet; call once the pipeline has finished"""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        try:
+            self._flush(self._pending, self._label)
+            self._pending = 0
+        except Exception as e:
+            # Keep the count pending and try again on the next flush
+            logger.warning(f"Progress flush failed: {e}")
+        self._last_flush = time.monotonic()
+
+
+class DownloadPipeline:
+    """
+    Staged producer/consumer pipeline for track downloads:
+
+        fetch (I/O threads) -> process (CPU worker threads, or the opt-in process pool) -> persist (single DB writer)
+
+    Stages are joined by bounded queues, so a slow stage applies back-pressure
+    instead of letting downloaded files pile up on disk. Each stage is sized
+    independently.
+
+    Args:
+        fetch: Callable(item) -> payload. Runs in I/O threads (network, disk).
+            May return None to drop the item, or a payload with skip_process=True
+            to send it straight to the writer (e.g. a cache hit).
+        process: Callable(payload) -> payload. Runs in the CPU pool (ffmpeg,
+            tagging, image work). Must be a module-level function taking and
+            returning picklable values, since it may run in another process.
+        persist: Callable(list of payloads) -> list of results. Runs in a single
+            writer thread with batches of up to batch_size payloads.
+        on_progress: Optional callable(label, succeeded) called once per item as
+            it leaves the pipeline, from whichever thread finished it.
+    """
+
+    def __init__(self, fetch, process, persist, on_progress=None,
+                 fetch_workers=None, process_workers=None,
+                 queue_size=None, batch_size=None, batch_timeout=None):
+        self.fetch = fetch
+        self.process = process
+        self.persist = persist
+        self.on_progress = on_progress
+
+        self.fetch_workers = fetch_workers or settings.PIPELINE_FETCH_WORKERS
+        self.process_workers = process_workers or settings.PIPELINE_PROCESS_WORKERS
+        self.batch_size = batch_size or settings.PIPELINE_BATCH_SIZE
+        self.batch_timeout = batch_timeout if batch_timeout is not None else settings.PIPELINE_BATCH_TIMEOUT
+        queue_size = queue_size or settings.PIPELINE_QUEUE_SIZE
+
+        self.fetch_queue = queue.Queue(maxsize=queue_size)
+        self.process_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+
+        self.stages = {
+            'fetch': StageStats('fetch', self.fetch_workers, self.fetch_queue),
+            'process': StageStats('process', self.process_workers, self.process_queue),
+            'persist': StageStats('persist', 1, self.write_queue),
+        }
+        self.results = []
+        self.elapsed = 0.0
+
+    def _put(self, stage_name, q, payload):
+        q.put(payload)
+        self.stages[stage_name].sample_queue()
+
+    def _finish_item(self, payload, succeeded):
+        if not self.on_progress:
+            return
+        try:
+            label = payload.get('label') if isinstance(payload, dict) else None
+            self.on_progress(label, succeeded)
+        except Exception as e:
+            logger.warning(f"Pipeline progress callback failed: {e}")
+
+    def _make_cpu_executor(self):
+        """
+        Executor for the process stage, and whether this pipeline owns it.
+        The stage's heavy work is ffmpeg, already a process of its own, so
+        threads are the default. The shared process pool is opt-in, and never
+        used in daemonic processes (e.g. Celery prefork workers), which may not
+        have children.
+        """
+        if settings.PIPELINE_USE_PROCESSES and not multiprocessing.current_process().daemon:
+            return _shared_process_pool(), False
+        return ThreadPoolExecutor(max_workers=self.process_workers, thread_name_prefix='pipeline-cpu'), True
+
+    def _fetch_worker(self):
+        from django.db import connection
+
+        try:
+            while True:
+                item = self.fetch_queue.get()
+                if item is _STOP:
+                    break
+
+                started = time.monotonic()
+                try:
+                    payload = self.fetch(item)
+                except Exception as e:
+                    logger.error(f"Pipeline fetch failed for {item}: {e}", exc_info=True)
+                    payload = None
+                self.stages['fetch'].record(time.monotonic() - started, failed=payload is None)
+
+                if payload is None:
+                    self._finish_item({'label': str(item)}, False)
+                elif payload.get('skip_process'):
+                    self._put('persist', self.write_queue, payload)
+                else:
+                    self._put('process', self.process_queue, payload)
+        finally:
+            connection.close()
+
+    def _process_worker(self, executor):
+        from django.db import connection
+
+        try:
+            while True:
+                payload = self.process_queue.get()
+                if payload is _STOP:
+                    break
+
+                started = time.monotonic()
+                try:
+                    result = executor.submit(self.process, payload).result()
+                except Exception as e:
+                    logger.error(f"Pipeline processing failed for {payload.get('label')}: {e}", exc_info=True)
+                    result = None
+                self.stages['process'].record(time.monotonic() - started, failed=result is None)
+
+                if result is None:
+                    self._finish_item(payload, False)
+                else:
+                    self._put('persist', self.write_queue, result)
+        finally:
+            # Progress callbacks may have touched the database from this thread
+            connection.close()
+
+    def _write_batch(self, batch):
+        started = time.monotonic()
+        try:
+            results = self.persist(batch) or []
+            failed = False
+        except Exception as e:
+            logger.error(f"Pipeline persist failed for a batch of {len(batch)}: {e}", exc_info=True)
+            results, failed = [], True
+        self.stages['persist'].record(time.monotonic() - started, failed=failed)
+
+        self.results.extend(r for r in results if r is not None)
+        for payload in batch:
+            self._finish_item(payload, not failed)
+
+    def _writer(self):
+        from django.db import connection
+
+        try:
+            batch = []
+            deadline = None
+            while True:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                try:
+                    payload = self.write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    payload = None
+
+                if payload is not None and payload is not _STOP:
+                    batch.append(payload)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.batch_timeout
+
+                # Flush when the batch is full, has waited long enough, or input ended
+                if batch and (payload is None or payload is _STOP or len(batch) >= self.batch_size):
+                    self._write_batch(batch)
+                    batch = []
+                    deadline = None
+
+                if payload is _STOP:
+                    break
+        finally:
+            connection.close()
+
+    def run(self, items):
+        """
+        Push items through every stage and wait for the pipeline to drain.
+
+        Returns:
+            List of non-None results returned by persist, in completion order
+        """
+        started = time.monotonic()
+        executor, owns_executor = self._make_cpu_executor()
+
+        fetchers = [threading.Thread(target=self._fetch_worker, name=f'pipeline-fetch-{i}', daemon=True)
+                    for i in range(self.fetch_workers)]
+        processors = [threading.Thread(target=self._process_worker, args=(executor,), name=f'pipeline-process-{i}', daemon=True)
+                      for i in range(self.process_workers)]
+        writer = threading.Thread(target=self._writer, name='pipeline-writer', daemon=True)
+
+        for thread in fetchers + processors + [writer]:
+            thread.start()
+
+        try:
+            for item in items:
+                self._put('fetch', self.fetch_queue, item)
+
+            # Shut the stages down in order so nothing in flight is lost
+            for _ in fetchers:
+                self.fetch_queue.put(_STOP)
+            for thread in fetchers:
+                thread.join()
+
+            for _ in processors:
+                self.process_queue.put(_STOP)
+            for thread in processors:
+                thread.join()
+
+            self.write_queue.put(_STOP)
+            writer.join()
+        finally:
+            if owns_executor:
+                executor.shutdown(wait=True)
+            self.elapsed = time.monotonic() - started
+
+        logger.info(f"Pipeline finished in {self.elapsed:.1f}s: {self.stats()}")
+        return self.results
+
+    def stats(self):
+        """Per-stage counters, timings and queue depths; safe to call while running"""
+        stats = {name: stage.as_dict() for name, stage in self.stages.items()}
+        stats['elapsed_seconds'] = round(self.elapsed, 3)
+        return stats
@@ -1,8 +1,8 @@
 from rest_framework import serializers
 from .models import Song, Playlist, UserMusicProfile, Genre, DownloadProgress, SongPlay
 from .utils import extract_youtube_video_id
+from .signing import sign_media_path
 from django.conf import settings
-import os
 
 class GenreSerializer(serializers.ModelSerializer):
     class Meta:
@@ -57,42 +57,25 @@ class SongSerializer(serializers.ModelSerializer):
 
     def get_file_url(self, obj):
         """
-        Builds the absolute URL for the song file.
+        Builds a signed, expiring absolute URL for the song file.
+        The URL is verified by SignedMediaMiddleware without any database access.
         """
         request = self.context.get('request')
-        if obj.file and hasattr(obj.file, 'url') and request:
+        if not obj.file or not isinstance(obj.file.name, str):
+            # Handle cases where file might be missing or stored differently
+            return None
+
+        file_path = sign_media_path(obj.file.name)
+        if request:
             try:
-                return request.build_absolute_uri(obj.file.url)
+                return request.build_absolute_uri(file_path)
             except Exception as e:
-                 print(f"Error building absolute URI for file {obj.file.url}: {e}")
-                 # Fallback for file URL
-                 site_url = getattr(settings, 'SITE_URL', None)
-                 if site_url:
-                     return f"{site_url.rstrip('/')}{obj.file.url}"
-                 else:
-                     return obj.file.url # Return relative path as last resort
-        # Handle cases where file might be missing or stored differently
-        elif obj.file and isinstance(obj.file.name, str):
-             # Handle simple string path case if needed
-             file_path = os.path.join(settings.MEDIA_URL, obj.file.name)
-             if request:
-                 try:
-                     return request.build_absolute_uri(file_path)
-                 except Exception as e:
-                     print(f"Error building absolute URI for file path {file_path}: {e}")
-                     site_url = getattr(settings, 'SITE_URL', None)
-                     if site_url:
-                         return f"{site_url.rstrip('/')}{file_path}"
-                     else:
-                         return file_path
-             else:
-                 # Fallback if request context is missing
-                 site_url = getattr(settings, 'SITE_URL', None)
-                 if site_url:
-                     return f"{site_url.rstrip('/')}{file_path}"
-                 else:
-                     return file_path # Return relative path
-        return None
+                print(f"Error building absolute URI for file path {file_path}: {e}")
+        # Fallback if request context is missing
+        site_url = getattr(settings, 'SITE_URL', None)
+        if site_url:
+            return f"{site_url.rstrip('/')}{file_path}"
+        return file_path # Return relative path as last resort
 
 class ArtistSerializer(serializers.Serializer):
     artist = serializers.CharField()
@@ -0,0 +1,62 @@
+import os
+import time
+import posixpath
+from urllib.parse import quote, urlencode
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+SALT = 'songs.signing.media'
+
+
+def _signature(rel_path, expires):
+    return salted_hmac(SALT, f"{rel_path}:{expires}", algorithm='sha256').hexdigest()[:32]
+
+
+def normalize_media_path(rel_path):
+    """
+    Clean a MEDIA_ROOT-relative path, or return None if it escapes MEDIA_ROOT
+    """
+    rel_path = posixpath.normpath(rel_path.replace('\\', '/')).lstrip('/')
+    if rel_path in ('', '.') or rel_path == '..' or rel_path.startswith('../'):
+        return None
+    return rel_path
+
+
+def sign_media_path(rel_path, ttl=None):
+    """
+    Build a signed, expiring URL path for a file under MEDIA_ROOT.
+    Expiry is rounded up to SIGNED_MEDIA_URL_BUCKET seconds so repeated calls
+    return the same URL for a while and clients can cache the file.
+
+    Args:
+        rel_path: Path relative to MEDIA_ROOT, e.g. Song.file.name
+        ttl: Minimum lifetime in seconds, defaults to SIGNED_MEDIA_URL_TTL
+
+    Returns:
+        Relative URL such as /signed-media/songs/x.mp3?expires=...&sig=...
+    """
+    rel_path = normalize_media_path(rel_path)
+    if rel_path is None:
+        raise ValueError("Path must be inside MEDIA_ROOT")
+    ttl = ttl if ttl is not None else settings.SIGNED_MEDIA_URL_TTL
+    bucket = settings.SIGNED_MEDIA_URL_BUCKET
+    expires = int(time.time()) + ttl
+    expires += -expires % bucket
+    query = urlencode({'expires': expires, 'sig': _signature(rel_path, expires)})
+    return f"{settings.SIGNED_MEDIA_URL}{quote(rel_path)}?{query}"
+
+
+def verify_media_signature(rel_path, expires, signature):
+    """Check a signature made by sign_media_path and that it hasn't expired"""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < time.time() or not signature:
+        return False
+    return constant_time_compare(_signature(rel_path, expires), signature)
+
+
+def media_file_path(rel_path):
+    """Absolute path of a normalized MEDIA_ROOT-relative path"""
+    return os.path.join(settings.MEDIA_ROOT, *rel_path.split('/'))
@@ -0,0 +1,467 @@
+import os
+import queue
+import shutil
+import logging
+import threading
+from functools import lru_cache
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.module_loading import import_string
+
+from .cache_manager import AccessBuffer
+
+logger = logging.getLogger(__name__)
+
+# Reads of MEDIA_ROOT files, applied to StoredBlob by rebalance()
+_blob_accesses = AccessBuffer('media_blobs')
+
+
+@lru_cache(maxsize=1)
+def _cold_storage(backend, options):
+    return import_string(backend)(**dict(options))
+
+
+def cold_storage():
+    """
+    The cold tier: any Django storage (MEDIA_COLD_STORAGE), e.g. a second
+    directory or an S3-compatible object store such as MinIO via django-storages
+    """
+    config = settings.MEDIA_COLD_STORAGE
+    return _cold_storage(config['BACKEND'], tuple(sorted(config.get('OPTIONS', {}).items())))
+
+
+def _rel_name(name):
+    return name.replace(os.sep, '/')
+
+
+def _local_path(rel_path):
+    return os.path.join(settings.MEDIA_ROOT, *rel_path.split('/'))
+
+
+def _cold_name(rel_path):
+    """Name of the cold copy holding a MEDIA_ROOT file's bytes; hard links of one file share it"""
+    from .models import StoredBlob
+
+    rel_path = _rel_name(rel_path)
+    return StoredBlob.objects.filter(path=rel_path).values_list('cold_name', flat=True).first() or rel_path
+
+
+class ReadAheadFile:
+    """
+    File-like reader that fetches the next chunks of a (slow, remote) file in a
+    background thread while the caller sends the current one, so cold reads
+    stream at the store's throughput instead of stalling on each request.
+
+    Args:
+        f: Open binary file object from the cold storage
+        chunk_size: Bytes per background read
+        depth: Chunks read ahead of the caller
+    """
+
+    def __init__(self, f, chunk_size=None, depth=None):
+        self._file = f
+        self._chunks = queue.Queue(maxsize=depth or settings.MEDIA_COLD_READ_AHEAD_CHUNKS)
+        self._chunk_size = chunk_size or settings.MEDIA_COLD_READ_CHUNK_SIZE
+        self._buffer = b''
+        self._eof = False
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._closed.is_set():
+                chunk = self._file.read(self._chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            item = self._chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                break
+            self._buffer += item
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._closed.set()
+        self._thread.join(timeout=5)
+        self._file.close()
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self._chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class TieredStorage(FileSystemStorage):
+    """
+    Storage for audio blobs: MEDIA_ROOT is the hot tier and cold_storage() the
+    cold one. Files are written hot; rebalance() moves rarely read ones to the
+    cold tier and brings frequently read ones back. Reading a cold file streams
+    it through with read-ahead rather than copying it back first.
+    """
+
+    def _open(self, name, mode='rb'):
+        if super().exists(name) or 'r' not in mode or not settings.MEDIA_TIERING_ENABLED:
+            return super()._open(name, mode)
+        record_access(name)
+        return File(ReadAheadFile(cold_storage().open(_cold_name(name), 'rb')), name=name)
+
+    def exists(self, name):
+        if super().exists(name):
+            return True
+        return settings.MEDIA_TIERING_ENABLED and cold_storage().exists(_cold_name(name))
+
+    def size(self, name):
+        if super().exists(name) or not settings.MEDIA_TIERING_ENABLED:
+            return super().size(name)
+        return cold_storage().size(_cold_name(name))
+
+    def delete(self, name):
+        from .models import StoredBlob
+
+        super().delete(name)
+        if settings.MEDIA_TIERING_ENABLED:
+            rel_path = _rel_name(name)
+            cold_name = _cold_name(rel_path)
+            # Other names of the same file still need the cold copy
+            if not StoredBlob.objects.filter(cold_name=cold_name).exclude(path=rel_path).exists():
+                cold_storage().delete(cold_name)
+
+
+def tiered_storage():
+    """Storage callable for Song.file"""
+    return TieredStorage()
+
+
+def record_access(rel_path):
+    """Count a read of a MEDIA_ROOT file towards its tier placement"""
+    if settings.MEDIA_TIERING_ENABLED and rel_path:
+        if _blob_accesses.add([_rel_name(rel_path)], settings.MEDIA_TIER_ACCESS_FLUSH_SECONDS):
+            _flush_blob_accesses()
+
+
+def media_rel_path(path):
+    """Path relative to MEDIA_ROOT (with / separators), or None if path is outside it"""
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+    path = os.path.abspath(path)
+    if not path.startswith(media_root + os.sep):
+        return None
+    return _rel_name(os.path.relpath(path, media_root))
+
+
+def open_cold(rel_path):
+    """
+    Open a file that is only in the cold tier for streaming.
+
+    Returns:
+        Tuple of (ReadAheadFile, size), or None if the cold tier doesn't have it
+    """
+    if not settings.MEDIA_TIERING_ENABLED:
+        return None
+    storage = cold_storage()
+    rel_path = _rel_name(rel_path)
+    cold_name = _cold_name(rel_path)
+    if not storage.exists(cold_name):
+        return None
+    record_access(rel_path)
+    return ReadAheadFile(storage.open(cold_name, 'rb')), storage.size(cold_name)
+
+
+def promote(rel_path):
+    """
+    Copy a cold file back to MEDIA_ROOT. Every name the file had is restored,
+    as hard links of the one downloaded copy. The cold copy is kept, so
+    demoting the file again later only removes the local names.
+
+    Returns:
+        Absolute local path of rel_path
+    """
+    from .models import StoredBlob
+    from .utils import link_or_copy, make_staging_dir, publish_file
+
+    rel_path = _rel_name(rel_path)
+    cold_name = _cold_name(rel_path)
+    names = [rel_path] + [name for name in StoredBlob.objects.filter(cold_name=cold_name).values_list('path', flat=True)
+                          if name != rel_path]
+    dest = _local_path(rel_path)
+    staging_dir = make_staging_dir()
+    try:
+        part_path = os.path.join(staging_dir, 'blob')
+        reader = ReadAheadFile(cold_storage().open(cold_name, 'rb'))
+        try:
+            with open(part_path, 'wb') as out:
+                shutil.copyfileobj(reader, out, settings.MEDIA_COLD_READ_CHUNK_SIZE)
+        finally:
+            reader.close()
+        publish_file(part_path, dest)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    for name in names[1:]:
+        link_or_copy(dest, _local_path(name))
+    StoredBlob.objects.filter(path__in=names).update(tier=StoredBlob.HOT)
+    logger.info(f"Promoted {rel_path} to the hot tier")
+    return dest
+
+
+class ColdFile:
+    """
+    A MEDIA_ROOT file that is only in the cold tier, for readers that take a
+    path or an openable source (ZipStream): size and mtime come from the cold
+    storage and open() streams it with read-ahead, so reading it doesn't copy
+    it back to local disk.
+    """
+
+    def __init__(self, rel_path, cold_name):
+        storage = cold_storage()
+        self.rel_path = rel_path
+        self.cold_name = cold_name
+        self.size = storage.size(cold_name)
+        try:
+            self.mtime = storage.get_modified_time(cold_name).timestamp()
+        except (NotImplementedError, OSError):
+            self.mtime = 0
+
+    def open(self):
+        record_access(self.rel_path)
+        return ReadAheadFile(cold_storage().open(self.cold_name, 'rb'))
+
+    def __str__(self):
+        return f"{self.rel_path} (cold)"
+
+
+def cold_file(path):
+    """
+    ColdFile for a MEDIA_ROOT file that is only in the cold tier
+
+    Returns:
+        The ColdFile, or None if tiering is off or the cold tier doesn't have it
+    """
+    rel_path = media_rel_path(path)
+    if rel_path is None or not settings.MEDIA_TIERING_ENABLED:
+        return None
+    cold_name = _cold_name(rel_path)
+    if not cold_storage().exists(cold_name):
+        return None
+    return ColdFile(rel_path, cold_name)
+
+
+def ensure_local(path):
+    """
+    Local path of a MEDIA_ROOT file, copying it back from the cold tier if needed,
+    for code that hands paths to ffmpeg, zip writers and the like.
+
+    Returns:
+        The absolute path, or None if neither tier has the file
+    """
+    if os.path.isfile(path):
+        return path
+    rel_path = media_rel_path(path)
+    if rel_path is None or not settings.MEDIA_TIERING_ENABLED or not cold_storage().exists(_cold_name(rel_path)):
+        return None
+    return promote(rel_path)
+
+
+def demote(blob):
+    """
+    Move a hot blob to the cold tier: upload it once unless a verified copy is
+    already there, then remove the local file under every name it has (hard
+    links share a cold_name). Returns bytes freed locally.
+    """
+    from .models import StoredBlob
+
+    cold_name = blob.cold_name or blob.path
+    names = set(StoredBlob.objects.filter(cold_name=cold_name).values_list('path', flat=True)) | {blob.path}
+    local_paths = [_local_path(name) for name in names if os.path.isfile(_local_path(name))]
+    if not local_paths:
+        StoredBlob.objects.filter(path__in=names).update(tier=StoredBlob.COLD)
+        return 0
+    size = os.path.getsize(local_paths[0])
+
+    storage = cold_storage()
+    if not storage.exists(cold_name) or storage.size(cold_name) != size:
+        if storage.exists(cold_name):
+            storage.delete(cold_name)
+        with open(local_paths[0], 'rb') as f:
+            saved_name = storage.save(cold_name, File(f))
+        if saved_name != cold_name or storage.size(cold_name) != size:
+            raise IOError(f"Cold copy of {cold_name} could not be verified")
+
+    for local_path in local_paths:
+        os.remove(local_path)
+    StoredBlob.objects.filter(path__in=names).update(tier=StoredBlob.COLD, size=size)
+    return size
+
+
+def _flush_blob_accesses(batch_size=500):
+    """Apply buffered reads to StoredBlob rows"""
+    from datetime import datetime, timezone as dt_timezone
+    from django.db.models import Case, F, IntegerField, Value, When
+    from .models import StoredBlob
+
+    accesses, hits = _blob_accesses.drain()
+    paths = list(accesses)
+    for i in range(0, len(paths), batch_size):
+        batch = paths[i:i + batch_size]
+        StoredBlob.objects.filter(path__in=batch).update(
+            last_accessed=Case(*[
+                When(path=path, then=Value(datetime.fromtimestamp(accesses[path], tz=dt_timezone.utc)))
+                for path in batch
+            ]),
+            access_count=F('access_count') + Case(
+                *[When(path=path, then=Value(hits.get(path, 0))) for path in batch],
+                default=Value(0), output_field=IntegerField()
+            ),
+        )
+    return len(paths)
+
+
+def _register_blobs(batch_size=500):
+    """
+    Add StoredBlob rows for audio files referenced by songs and cache entries.
+    A new name for a file that already has a row (a song hard-linked to its
+    cache/ entry) joins that row's cold_name, so the file is counted and
+    moved once.
+    """
+    from django.db.models import F
+    from .models import Song, SongCache, StoredBlob
+
+    StoredBlob.objects.filter(cold_name='').update(cold_name=F('path'))
+    known = set(StoredBlob.objects.values_list('path', flat=True))
+    referenced = set(Song.objects.exclude(file='').exclude(file__isnull=True).values_list('file', flat=True))
+    referenced |= set(SongCache.objects.values_list('file_path', flat=True))
+    new_paths = {_rel_name(p) for p in referenced} - known
+
+    by_inode = {}
+    if new_paths:
+        for rel_path, cold_name in StoredBlob.objects.filter(tier=StoredBlob.HOT).values_list('path', 'cold_name'):
+            try:
+                st = os.stat(_local_path(rel_path))
+            except OSError:
+                continue
+            by_inode.setdefault((st.st_dev, st.st_ino), cold_name)
+    new_blobs = []
+    for rel_path in sorted(new_paths):
+        try:
+            st = os.stat(_local_path(rel_path))
+        except OSError:
+            continue
+        cold_name = by_inode.setdefault((st.st_dev, st.st_ino), rel_path)
+        new_blobs.append(StoredBlob(path=rel_path, size=st.st_size, cold_name=cold_name))
+    StoredBlob.objects.bulk_create(new_blobs, batch_size=batch_size, ignore_conflicts=True)
+
+    # Blobs nothing refers to any more are dropped, and their cold copies too
+    # once no other name of the file is left
+    unreferenced = list(known - {_rel_name(p) for p in referenced})
+    for i in range(0, len(unreferenced), batch_size):
+        batch = StoredBlob.objects.filter(path__in=unreferenced[i:i + batch_size])
+        cold_names = set(batch.filter(tier=StoredBlob.COLD).values_list('cold_name', flat=True))
+        batch.delete()
+        still_used = set(StoredBlob.objects.filter(cold_name__in=cold_names).values_list('cold_name', flat=True))
+        for cold_name in cold_names - still_used:
+            cold_storage().delete(cold_name)
+    return len(new_blobs)
+
+
+def _hot_bytes():
+    """Local bytes used by hot blobs, counting each file once however many names it has"""
+    from .models import StoredBlob
+
+    return sum(dict(StoredBlob.objects.filter(tier=StoredBlob.HOT).values_list('cold_name', 'size')).values())
+
+
+def _blob_groups(tier):
+    """
+    Files in a tier with their reads summed over all their names,
+    as (cold_name, size, reads, last_accessed) rows
+    """
+    from django.db.models import Max, Sum
+    from .models import StoredBlob
+
+    return StoredBlob.objects.filter(tier=tier).values('cold_name').annotate(
+        file_size=Max('size'), reads=Sum('access_count'), last_read=Max('last_accessed')
+    ).values_list('cold_name', 'file_size', 'reads', 'last_read')
+
+
+def rebalance():
+    """
+    Place blobs by how often they are read. Access counts are halved every run
+    so placement follows recent popularity. Cold blobs read at least
+    MEDIA_PROMOTE_MIN_READS times come back to the hot tier while there is room;
+    then the least read hot blobs are demoted until local audio fits in
+    MEDIA_HOT_MAX_BYTES. Nothing is deleted: demoted files stay readable from
+    the cold tier.
+
+    Returns:
+        Dict with promoted, demoted and hot_bytes
+    """
+    from django.db.models import F
+    from .models import StoredBlob
+
+    stats = {'registered': 0, 'promoted': 0, 'demoted': 0, 'hot_bytes': 0}
+    if not settings.MEDIA_TIERING_ENABLED:
+        return stats
+
+    stats['registered'] = _register_blobs()
+    _flush_blob_accesses()
+
+    # Placement is per file: hard-linked names are read, counted and moved together
+    budget = settings.MEDIA_HOT_MAX_BYTES
+    hot_bytes = _hot_bytes()
+
+    hot_candidates = sorted(
+        (group for group in _blob_groups(StoredBlob.COLD) if group[2] >= settings.MEDIA_PROMOTE_MIN_READS),
+        key=lambda group: -group[2]
+    )
+    for cold_name, size, reads, last_read in hot_candidates:
+        if hot_bytes + size > budget * settings.MEDIA_HOT_FILL_TO:
+            break
+        try:
+            promote(StoredBlob.objects.filter(cold_name=cold_name).values_list('path', flat=True).first())
+            hot_bytes += size
+            stats['promoted'] += 1
+        except Exception as e:
+            logger.error(f"Could not promote {cold_name}: {e}")
+
+    if hot_bytes > budget:
+        target = budget * settings.MEDIA_HOT_FILL_TO
+        for cold_name, size, reads, last_read in sorted(_blob_groups(StoredBlob.HOT), key=lambda group: (group[2], group[3])):
+            if hot_bytes <= target:
+                break
+            try:
+                hot_bytes -= demote(StoredBlob.objects.filter(cold_name=cold_name).first())
+                stats['demoted'] += 1
+            except Exception as e:
+                logger.error(f"Could not demote {cold_name}: {e}")
+
+    # Age the counts so a burst of plays long ago doesn't pin a file forever
+    StoredBlob.objects.filter(access_count__gt=0).update(access_count=F('access_count') / 2)
+
+    stats['hot_bytes'] = hot_bytes
+    logger.info(f"Storage tiers rebalanced: {stats}")
+    return stats
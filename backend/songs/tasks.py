@@ -1,5 +1,5 @@
 import os
-import tempfile
+import shutil
 from celery import shared_task
 from celery import shared_task
 from django.conf import settings
@@ -7,14 +7,18 @@ from django.contrib.auth import get_user_model
 from datetime import datetime
 import yt_dlp
 import logging
-from .models import Song, Playlist, DownloadProgress, UserMusicProfile, SongCache
+from .models import Song, Playlist, DownloadProgress, UserMusicProfile, SongCache, SpotifyMatch, MediaFileIndex
 from .spotify_api import get_playlist_tracks, get_track_info
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
-def download_audio(query, output_path, task_id, is_url=False):
-    """Helper function to download audio using yt-dlp"""
+def download_audio(query, output_path, task_id, is_url=False, extract_audio=True):
+    """
+    Helper function to download audio using yt-dlp.
+    With extract_audio=False the best audio stream is saved as-is, leaving the
+    ffmpeg transcode to the caller.
+    """
     logger.info(f"Downloading audio: {query} to {output_path}")
     
     # Create a progress hook that updates the DownloadProgress object
@@ -54,7 +58,7 @@ def download_audio(query, output_path, task_id, is_url=False):
             'key': 'FFmpegExtractAudio',
             'preferredcodec': 'mp3',
             'preferredquality': '192',
-        }],
+        }] if extract_audio else [],
         'outtmpl': output_path,
         'default_search': 'ytsearch' if not is_url else None,
         'progress_hooks': [progress_hook],
@@ -90,6 +94,207 @@ def download_audio(query, output_path, task_id, is_url=False):
             logger.error(f"Error in download_audio: {e}", exc_info=True)
             raise
 
+def _downloaded_audio_path(info, temp_dir):
+    """Find the audio file yt-dlp wrote, skipping the thumbnail written next to it"""
+    for download in (info or {}).get('requested_downloads') or []:
+        if download.get('filepath') and os.path.exists(download['filepath']):
+            return download['filepath']
+
+    for name in sorted(os.listdir(temp_dir)):
+        if name.startswith('source.') and os.path.splitext(name)[1].lower() not in ('.jpg', '.png', '.webp'):
+            return os.path.join(temp_dir, name)
+
+    raise FileNotFoundError(f"No audio file was downloaded to {temp_dir}")
+
+def track_source_url(track_info):
+    """The URL a track is cached and negative-cached under: its video URL, or the Spotify track a search stands in for"""
+    if track_info.get('url'):
+        return track_info['url']
+    if track_info.get('spotify_id'):
+        return f"https://open.spotify.com/track/{track_info['spotify_id']}"
+    return None
+
+def track_cache_item(payload):
+    """The (url, rel_path, metadata) SongCache.ingest item for a transcoded track"""
+    track_info = payload['track_info']
+    return (track_source_url(track_info), payload['rel_path'], {
+        'title': track_info.get('title'),
+        'artist': track_info.get('artist'),
+        'album': track_info.get('album', 'Unknown'),
+        'thumbnail_url': payload.get('thumbnail_url'),
+        'source': 'spotify' if 'spotify_id' in track_info else 'youtube',
+        'spotify_id': track_info.get('spotify_id'),
+        'id': payload.get('youtube_id'),
+    })
+
+def fetch_track_source(track_info, task_id=None):
+    """
+    Fetch stage: download the best audio stream for a track into a new temp dir.
+    No transcoding happens here so network workers never wait on ffmpeg.
+    """
+    from .utils import wait_for_upstream, make_staging_dir, check_source, source_guard
+
+    source_url = track_source_url(track_info)
+    check_source(source_url)
+    wait_for_upstream('youtube')
+    temp_dir = make_staging_dir()
+    output_path = os.path.join(temp_dir, 'source.%(ext)s')
+    try:
+        logger.info(f"download_song: Starting audio download for: {track_info['title']}")
+        info = None
+
+        # Spotify tracks we've resolved before go straight to the remembered video
+        match = None if 'url' in track_info else SpotifyMatch.lookup(track_info.get('spotify_id'))
+        if match:
+            try:
+                logger.info(f"download_song: Using remembered YouTube match {match.youtube_id}")
+                info = download_audio(match.youtube_url, output_path, task_id, is_url=True, extract_audio=False)
+            except Exception as e:
+                logger.warning(f"download_song: Remembered match {match.youtube_id} failed, searching instead: {e}")
+                SpotifyMatch.forget(match.spotify_id)
+
+        if info is None:
+            with source_guard(source_url):
+                info = download_audio(
+                    track_info['url'] if 'url' in track_info else f"{track_info['title']} {track_info['artist']}",
+                    output_path,
+                    task_id,
+                    is_url='url' in track_info,
+                    extract_audio=False
+                )
+        source_path = _downloaded_audio_path(info, temp_dir)
+        logger.info(f"download_song: Audio download complete for: {track_info['title']}")
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    # Get thumbnail URL - first try from track_info, then from YouTube info
+    thumbnail_url = track_info.get('image_url')
+
+    # If we have a local thumbnail file, use that
+    if info and 'local_thumbnail' in info:
+        # Create a relative path for the thumbnail
+        rel_thumbnail_path = os.path.relpath(info['local_thumbnail'], settings.MEDIA_ROOT)
+        thumbnail_url = f"/media/{rel_thumbnail_path}"
+        logger.info(f"download_song: Using local thumbnail: {thumbnail_url}")
+    # Otherwise try to get thumbnail from YouTube info
+    elif not thumbnail_url and info:
+        for key in ['thumbnail', 'thumbnails']:
+            if key in info and info[key]:
+                if isinstance(info[key], list) and len(info[key]) > 0:
+                    thumbnail_url = info[key][0].get('url')
+                else:
+                    thumbnail_url = info[key]
+                logger.info(f"download_song: Using YouTube thumbnail: {thumbnail_url}")
+                break
+
+    return {
+        'track_info': track_info,
+        'temp_dir': temp_dir,
+        'source_path': source_path,
+        'thumbnail_url': thumbnail_url,
+        'youtube_id': info.get('id') if info else None,
+        'youtube_title': info.get('title') if info else None,
+        'label': track_info.get('title'),
+    }
+
+def build_track_match(payload):
+    """Build the SpotifyMatch for a fetched Spotify track, or None for YouTube tracks"""
+    track_info = payload['track_info']
+    return SpotifyMatch.build(
+        track_info.get('spotify_id'),
+        payload.get('youtube_id'),
+        title=track_info.get('title'),
+        artist=track_info.get('artist'),
+        youtube_title=payload.get('youtube_title')
+    )
+
+def transcode_track(payload):
+    """
+    Process stage: transcode a fetched track to mp3 and move it into media/songs.
+    Runs in the pipeline's CPU pool, so it only deals in plain dicts, and it always
+    removes the fetch stage's temp dir.
+    """
+    from .utils import convert_audio_format, publish_file
+
+    temp_dir = payload['temp_dir']
+    try:
+        track_info = payload['track_info']
+        source_path = payload['source_path']
+        if not source_path.lower().endswith('.mp3'):
+            source_path = convert_audio_format(source_path, 'mp3', bitrate='192k')
+
+        filename = f"{track_info['title']} - {track_info['artist']}.mp3"
+        safe_filename = "".join(c for c in filename if c.isalnum() or c in (' ', '-', '.'))
+        media_path = os.path.join(settings.MEDIA_ROOT, 'songs', safe_filename)
+
+        # Staging is on the media volume, so this is a single atomic rename
+        logger.info(f"download_song: Publishing {source_path} to {media_path}")
+        publish_file(source_path, media_path)
+
+        payload = dict(payload, rel_path=os.path.join('songs', safe_filename))
+        payload.pop('temp_dir')
+        return payload
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def build_track_song(user, payload):
+    """Build (but don't save) the Song for a transcoded track"""
+    track_info = payload['track_info']
+    return Song(
+        user=user,
+        title=track_info['title'],
+        artist=track_info['artist'],
+        album=track_info.get('album', 'Unknown'),
+        source='spotify' if 'spotify_id' in track_info else 'youtube',
+        spotify_id=track_info.get('spotify_id'),
+        thumbnail_url=payload.get('thumbnail_url'),
+        song_url=track_info.get('url'),
+        # Set the file field relative to MEDIA_ROOT
+        file=payload['rel_path']
+    )
+
+def record_track(user, payload, playlist_id=None):
+    """Persist stage for a single track: create the Song and record the download"""
+    track_info = payload['track_info']
+
+    # Create the song object
+    logger.info(f"download_song: Creating song record for: {track_info['title']}")
+    song = build_track_song(user, payload)
+    song.save()
+    logger.info(f"download_song: Created song record with ID: {song.id}, file: {song.file.name}")
+    SpotifyMatch.remember([build_track_match(payload)])
+    MediaFileIndex.record_songs([song])
+    SongCache.ingest(*track_cache_item(payload))
+
+    # Add to playlist if needed
+    if playlist_id:
+        try:
+            logger.info(f"download_song: Adding song to playlist {playlist_id}")
+            playlist = Playlist.objects.get(id=playlist_id, user=user)
+            playlist.songs.add(song)
+            schedule_playlist_archive(playlist.id)
+        except Playlist.DoesNotExist:
+            logger.error(f"download_song: Playlist {playlist_id} not found")
+
+    # Update user's music profile
+    try:
+        profile, created = UserMusicProfile.objects.get_or_create(user=user)
+        profile.update_profile(song)
+        logger.info(f"download_song: Updated user profile for song: {song.id}")
+    except Exception as profile_error:
+        logger.warning(f"download_song: Error updating user profile: {profile_error}")
+
+    # Record download in analytics
+    try:
+        from .models import UserAnalytics
+        UserAnalytics.record_download(user)
+        logger.info(f"download_song: Recorded download in analytics for song: {song.id}")
+    except Exception as analytics_error:
+        logger.warning(f"download_song: Error recording download in analytics: {analytics_error}")
+
+    return song
+
 def download_song_direct(song_info, user_id, playlist_id=None, parent_task_id=None):
     """Direct download function (not a Celery task) for single songs"""
     progress = None
@@ -125,121 +330,21 @@ def download_song_direct(song_info, user_id, playlist_id=None, parent_task_id=No
                 current_file=f"{track_info['title']} - {track_info['artist']}"
             )
 
-        # Create temporary directory for download
-        logger.info(f"download_song: Creating temporary directory for download")
-        with tempfile.TemporaryDirectory() as temp_dir:
-            filename = f"{track_info['title']} - {track_info['artist']}.mp3"
-            safe_filename = "".join(c for c in filename if c.isalnum() or c in (' ', '-', '.'))
-            
-            # Create paths
-            temp_path = os.path.join(temp_dir, safe_filename)
-            media_path = os.path.join(settings.MEDIA_ROOT, 'songs', safe_filename)
-            logger.info(f"download_song: Temp path: {temp_path}")
-            logger.info(f"download_song: Final media path: {media_path}")
-
-            # Download audio
-            logger.info(f"download_song: Starting audio download for: {track_info['title']}")
-            info = download_audio(
-                track_info['url'] if 'url' in track_info else f"{track_info['title']} {track_info['artist']}", 
-                temp_path,
-                task_id,
-                is_url='url' in track_info
-            )
-            logger.info(f"download_song: Audio download complete for: {track_info['title']}")
-            
-            # Get thumbnail URL - first try from track_info, then from YouTube info
-            thumbnail_url = track_info.get('image_url')
-            logger.info(f"download_song: Initial thumbnail URL from track_info: {thumbnail_url}")
-            
-            # If we have a local thumbnail file, use that
-            if info and 'local_thumbnail' in info:
-                # Create a relative path for the thumbnail
-                rel_thumbnail_path = os.path.relpath(info['local_thumbnail'], settings.MEDIA_ROOT)
-                thumbnail_url = f"/media/{rel_thumbnail_path}"
-                logger.info(f"download_song: Using local thumbnail: {thumbnail_url}")
-            # Otherwise try to get thumbnail from YouTube info
-            elif not thumbnail_url and info:
-                for key in ['thumbnail', 'thumbnails']:
-                    if key in info and info[key]:
-                        if isinstance(info[key], list) and len(info[key]) > 0:
-                            thumbnail_url = info[key][0].get('url')
-                        else:
-                            thumbnail_url = info[key]
-                        logger.info(f"download_song: Using YouTube thumbnail: {thumbnail_url}")
-                        break
-
-            # Create the song object
-            logger.info(f"download_song: Creating song record for: {track_info['title']}")
-            song = Song.objects.create(
-                user=user,
-                title=track_info['title'],
-                artist=track_info['artist'],
-                album=track_info.get('album', 'Unknown'),
-                source='spotify' if 'spotify_id' in track_info else 'youtube',
-                spotify_id=track_info.get('spotify_id'),
-                thumbnail_url=thumbnail_url,
-                song_url=track_info.get('url')
-            )
-            logger.info(f"download_song: Created song record with ID: {song.id}")
-
-            # Save the file directly to the media directory
-            logger.info(f"download_song: Saving file to media directory: {safe_filename}")
-            
-            # The actual file has .mp3 extension added by the postprocessor
-            source_file = temp_path + '.mp3'
-            
-            # Ensure the songs directory exists
-            os.makedirs(os.path.dirname(media_path), exist_ok=True)
-            
-            # Copy the file to media directory
-            import shutil
-            logger.info(f"download_song: Copying from {source_file} to {media_path}")
-            shutil.copy2(source_file, media_path)
-            
-            # Set the file field relative to MEDIA_ROOT
-            rel_path = os.path.join('songs', safe_filename)
-            song.file = rel_path
-            song.save()
-            
-            logger.info(f"download_song: File saved to: {song.file.name}")
+        # Same stages as the playlist pipeline, run one after another
+        payload = fetch_track_source(track_info, task_id)
+        payload = transcode_track(payload)
+        song = record_track(user, payload, playlist_id)
 
-            # Add to playlist if needed
-            if playlist_id:
-                try:
-                    logger.info(f"download_song: Adding song to playlist {playlist_id}")
-                    playlist = Playlist.objects.get(id=playlist_id, user=user)
-                    playlist.songs.add(song)
-                    logger.info(f"download_song: Added song to playlist {playlist_id}")
-                except Playlist.DoesNotExist:
-                    logger.error(f"download_song: Playlist {playlist_id} not found")
-            
-            # Update user's music profile
-            try:
-                logger.info(f"download_song: Updating user profile for song: {song.id}")
-                profile, created = UserMusicProfile.objects.get_or_create(user=user)
-                profile.update_profile(song)
-                logger.info(f"download_song: Updated user profile for song: {song.id}")
-            except Exception as profile_error:
-                logger.warning(f"download_song: Error updating user profile: {profile_error}")
-
-            # Record download in analytics
-            try:
-                from .models import UserAnalytics
-                UserAnalytics.record_download(user)
-                logger.info(f"download_song: Recorded download in analytics for song: {song.id}")
-            except Exception as analytics_error:
-                logger.warning(f"download_song: Error recording download in analytics: {analytics_error}")
-
-            # Update progress to 100% if this is a standalone task
-            if not parent_task_id and progress:
-                logger.info(f"download_song: Marking task as complete")
-                progress.current_progress = 100
-                progress.current_file = "Complete"
-                progress.save()
-                logger.info(f"download_song: Download complete for song: {song.id}")
+        # Update progress to 100% if this is a standalone task
+        if not parent_task_id and progress:
+            logger.info(f"download_song: Marking task as complete")
+            progress.current_progress = 100
+            progress.current_file = "Complete"
+            progress.save()
+            logger.info(f"download_song: Download complete for song: {song.id}")
 
-            logger.info(f"download_song: Returning song ID: {song.id}")
-            return song.id
+        logger.info(f"download_song: Returning song ID: {song.id}")
+        return song.id
 
     except Exception as e:
         logger.error(f"download_song: Error downloading song: {str(e)}", exc_info=True)
@@ -299,12 +404,13 @@ def download_song(self, url, user_id):
                     title=metadata.get('title', 'Unknown Title'),
                     artist=metadata.get('artist', 'Unknown Artist'),
                     album=metadata.get('album', 'Unknown'),
-                    file=cached_song.local_path,  # Use the cached file
+                    file=cached_song.file_path,  # Use the cached file
                     source=metadata.get('source', 'cache'),
                     spotify_id=metadata.get('spotify_id'),
                     thumbnail_url=metadata.get('thumbnail_url'),
                     song_url=url
                 )
+                MediaFileIndex.record_songs([song])
                 
                 # Increment the user's download count
                 user.increment_download_count()
@@ -376,12 +482,7 @@ def download_song(self, url, user_id):
                     song_url=url,
                     thumbnail_url=result.get('thumbnail')
                 )
-                
-                # Get the file size
-                try:
-                    file_size = os.path.getsize(file_path)
-                except:
-                    file_size = 0
+                MediaFileIndex.record_songs([song])
                 
                 # Increment the user's download count
                 user.increment_download_count()
@@ -395,23 +496,14 @@ def download_song(self, url, user_id):
                     logger.warning(f"Error recording download in analytics: {analytics_error}")
                 
                 # Cache the song for future use
-                try:
-                    metadata = {
-                        'title': song_title,
-                        'artist': artist,
-                        'album': result.get('album', 'Unknown'),
-                        'source': 'youtube',
-                        'thumbnail_url': result.get('thumbnail')
-                    }
-                    
-                    SongCache.objects.create(
-                        song_url=url,
-                        local_path=rel_path,
-                        file_size=file_size,
-                        metadata=metadata
-                    )
-                except Exception as e:
-                    logger.error(f"Error caching song: {e}", exc_info=True)
+                SongCache.ingest(url, rel_path, {
+                    'title': song_title,
+                    'artist': artist,
+                    'album': result.get('album', 'Unknown'),
+                    'source': 'youtube',
+                    'thumbnail_url': result.get('thumbnail'),
+                    'id': result.get('id')
+                })
                 
                 # Update progress
                 progress.status = 'completed'
@@ -460,32 +552,15 @@ def download_song(self, url, user_id):
                 song_data = download_spotify_track(track, user)
                 
                 if song_data:
-                    # Get the file size
-                    file_path = os.path.join(settings.MEDIA_ROOT, song_data['file_path'])
-                    try:
-                        file_size = os.path.getsize(file_path)
-                    except:
-                        file_size = 0
-                    
                     # Cache the song for future use
-                    try:
-                        metadata = {
-                            'title': song_data['title'],
-                            'artist': song_data['artist'],
-                            'album': song_data['album'],
-                            'source': 'spotify',
-                            'spotify_id': spotify_id,
-                            'thumbnail_url': song_data['thumbnail_url']
-                        }
-                        
-                        SongCache.objects.create(
-                            song_url=url,
-                            local_path=song_data['file_path'],
-                            file_size=file_size,
-                            metadata=metadata
-                        )
-                    except Exception as e:
-                        logger.error(f"Error caching Spotify song: {e}", exc_info=True)
+                    SongCache.ingest(url, song_data['file_path'], {
+                        'title': song_data['title'],
+                        'artist': song_data['artist'],
+                        'album': song_data['album'],
+                        'source': 'spotify',
+                        'spotify_id': spotify_id,
+                        'thumbnail_url': song_data['thumbnail_url']
+                    })
                     
                     # Update progress
                     progress.status = 'completed'
@@ -523,222 +598,394 @@ def download_song(self, url, user_id):
             progress.save()
         return f"Error: {str(e)}"
 
-def download_youtube_playlist_direct(url, user_id):
-    """Direct download function (not a Celery task) for YouTube playlists"""
-    logger.info(f"Starting direct YouTube playlist download: {url} for user {user_id}")
-    
-    task_id = f"direct-{datetime.now().timestamp()}"
-    progress = None
-    
+@shared_task(bind=True, acks_late=True)
+def process_download_job(self, job_id):
+    """
+    Run a queued DownloadJob: fetch, convert, tag and persist the track,
+    recording progress on the job so clients can poll or stream it
+    """
+    from django.utils import timezone
+    from .models import DownloadJob
+    from .download_helper import fetch_youtube_track, fetch_spotify_track
+
     try:
-        user = User.objects.get(id=user_id)
-        
-        # Get playlist info
-        logger.info(f"Extracting playlist info from: {url}")
+        job = DownloadJob.objects.select_related('user').get(id=job_id)
+    except DownloadJob.DoesNotExist:
+        logger.error(f"process_download_job: Job {job_id} not found")
+        return None
+
+    if job.is_finished:
+        logger.info(f"process_download_job: Job {job_id} already {job.status}, skipping")
+        return job.status
+
+    job.status = 'running'
+    job.stage = 'Starting'
+    job.save(update_fields=['status', 'stage', 'updated_at'])
+
+    try:
+        # Other jobs may have used up the quota since this one was queued
+        if not job.user.can_download():
+            raise ValueError('Daily download limit reached')
+
+        if 'spotify.com' in job.url:
+            result = fetch_spotify_track(job.user, job.url, job.output_format, progress=job.update_progress)
+        elif 'youtube.com' in job.url or 'youtu.be' in job.url:
+            result = fetch_youtube_track(job.user, job.url, job.output_format, progress=job.update_progress)
+        else:
+            raise ValueError('Unsupported URL. Only YouTube and Spotify URLs are supported.')
+
+        job.status = 'completed'
+        job.progress = 100
+        job.stage = 'Complete'
+        job.song_id = result.get('song_id')
+        job.file_path = os.path.relpath(result['path'], settings.MEDIA_ROOT)
+        job.filename = result['filename']
+        job.content_type = result['content_type']
+        job.finished_at = timezone.now()
+        job.save()
+        logger.info(f"process_download_job: Job {job_id} completed: {job.file_path}")
+        return job.status
+
+    except Exception as e:
+        logger.error(f"process_download_job: Job {job_id} failed: {e}", exc_info=True)
+        job.status = 'failed'
+        job.stage = 'Failed'
+        job.error = str(e)
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'stage', 'error', 'finished_at', 'updated_at'])
+        return job.status
+
+def _extract_youtube_playlist(url):
+    """
+    Fetch a YouTube playlist's title and entries without downloading anything
+
+    Returns:
+        Tuple of (playlist title, list of track_info dicts for download_song_direct)
+    """
+    logger.info(f"Extracting playlist info from: {url}")
+    try:
+        with yt_dlp.YoutubeDL({'quiet': False, 'no_warnings': False}) as ydl:
+            info = ydl.extract_info(url, download=False)
+
+        if not info or not info.get('entries'):
+            logger.error(f"No videos found in playlist: {url}")
+            raise ValueError(f"No videos found in playlist: {url}")
+
+        logger.info(f"Found playlist: {info.get('title')} with {len(info.get('entries', []))} entries")
+    except Exception as e:
+        logger.error(f"Error extracting playlist info: {str(e)}", exc_info=True)
+        raise ValueError(f"Could not extract playlist info: {str(e)}")
+
+    tracks = []
+    for i, entry in enumerate(info.get('entries', [])):
+        if entry is None:
+            logger.warning(f"Skipping None entry at position {i}")
+            continue
+        tracks.append({
+            'title': entry.get('title', f"Track {i+1}"),
+            'artist': entry.get('uploader', 'Unknown Artist'),
+            'album': entry.get('album', 'Unknown'),
+            'image_url': entry.get('thumbnail'),
+            'url': entry.get('webpage_url')
+        })
+
+    return info.get('title', 'YouTube Playlist'), tracks
+
+def _extract_spotify_playlist(playlist_url):
+    """
+    Fetch a Spotify playlist's tracks
+
+    Returns:
+        Tuple of (playlist name, list of track_info dicts for download_song_direct)
+    """
+    logger.info(f"Fetching tracks from Spotify playlist: {playlist_url}")
+    try:
+        playlist_tracks = get_playlist_tracks(playlist_url)
+
+        if not playlist_tracks:
+            logger.error(f"No tracks found in Spotify playlist: {playlist_url}")
+            raise ValueError(f"No tracks found in Spotify playlist: {playlist_url}")
+
+        logger.info(f"Found {len(playlist_tracks)} tracks in Spotify playlist")
+    except Exception as e:
+        logger.error(f"Error extracting Spotify playlist info: {str(e)}", exc_info=True)
+        raise ValueError(f"Could not extract playlist info: {str(e)}")
+
+    return f"Spotify Playlist {playlist_url.split('/')[-1].split('?')[0]}", playlist_tracks
+
+def _record_playlist_batch(user, playlist_id, batch):
+    """
+    Pipeline writer for playlist tracks: bulk create the batch's songs, add
+    them to the playlist and bump the profile and analytics counters once
+    """
+    from django.db import transaction
+    from .models import UserAnalytics
+
+    songs = []
+    for payload in batch:
         try:
-            with yt_dlp.YoutubeDL({'quiet': False, 'no_warnings': False}) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-            if not info or not info.get('entries'):
-                logger.error(f"No videos found in playlist: {url}")
-                raise ValueError(f"No videos found in playlist: {url}")
-                
-            logger.info(f"Found playlist: {info.get('title')} with {len(info.get('entries', []))} entries")
+            song = build_track_song(user, payload)
+            # bulk_create skips save(), so truncate explicitly
+            song.truncate_fields()
+            songs.append(song)
         except Exception as e:
-            logger.error(f"Error extracting playlist info: {str(e)}", exc_info=True)
-            raise ValueError(f"Could not extract playlist info: {str(e)}")
-            
-        # Create playlist
-        playlist = Playlist.objects.create(
-            user=user,
-            name=info.get('title', 'YouTube Playlist'),
-            source="youtube",
-            source_url=url
-        )
-        logger.info(f"Created playlist with ID: {playlist.id}")
+            logger.error(f"Error preparing track {payload.get('label')}: {e}", exc_info=True)
+
+    if not songs:
+        return []
+
+    with transaction.atomic():
+        songs = Song.objects.bulk_create(songs)
+        playlist = Playlist.objects.get(id=playlist_id, user=user)
+        playlist.songs.add(*songs)
+        logger.info(f"Added {len(songs)} songs to playlist {playlist_id}")
+
+    SpotifyMatch.remember([build_track_match(payload) for payload in batch])
+    MediaFileIndex.record_songs(songs)
+    SongCache.ingest_many(track_cache_item(payload) for payload in batch)
+    schedule_playlist_archive(playlist_id)
+
+    try:
+        UserMusicProfile.record_downloads(user, songs)
+        UserAnalytics.record_downloads(user, len(songs))
+    except Exception as analytics_error:
+        logger.warning(f"Error recording downloads in analytics: {analytics_error}")
+
+    return [song.id for song in songs]
+
+def _run_playlist_pipeline(tracks, user, playlist_id, progress_task_id):
+    """Push playlist tracks through the fetch -> transcode -> persist pipeline"""
+    from .pipeline import DownloadPipeline, ThrottledProgress
+
+    # Several chunk tasks may share the progress row, so flush deltas on a timer
+    progress = ThrottledProgress(
+        lambda count, label: DownloadProgress.add_completed(progress_task_id, count, label)
+    )
+    pipeline = DownloadPipeline(
+        fetch=fetch_track_source,
+        process=transcode_track,
+        persist=lambda batch: _record_playlist_batch(user, playlist_id, batch),
+        on_progress=progress
+    )
+    song_ids = pipeline.run(tracks)
+    progress.flush()
+    return song_ids, pipeline.stats()
+
+def _download_playlist_in_process(playlist, tracks, user):
+    """
+    Download playlist tracks through the pipeline in the current process.
+    Used by the *_direct functions when no worker fleet is involved.
+    """
+    task_id = f"direct-{datetime.now().timestamp()}"
+    total_tracks = len(tracks)
+    progress = DownloadProgress.objects.create(
+        task_id=task_id,
+        total_items=total_tracks,
+        current_progress=0,
+        current_file="Initializing..."
+    )
+
+    try:
+        successful_songs, stats = _run_playlist_pipeline(tracks, user, playlist.id, task_id)
+        progress.refresh_from_db()
 
-        # Initialize progress tracking
-        total_entries = len(info.get('entries', []))
-        progress = DownloadProgress.objects.create(
-            task_id=task_id,
-            total_items=total_entries,
-            current_progress=0,
-            current_file="Initializing..."
-        )
-        
-        # Process each video using the download_song function
-        successful_songs = []
-        
-        for i, entry in enumerate(info.get('entries', [])):
-            if entry is None:
-                logger.warning(f"Skipping None entry at position {i}")
-                continue
-                
-            logger.info(f"Processing entry {i+1}/{total_entries}: {entry.get('title')}")
-            
-            try:
-                # Update progress
-                progress.current_progress = int((i / total_entries) * 100)
-                progress.current_file = entry.get('title', f"Track {i+1}")
-                progress.save()
-                
-                # Prepare track info
-                track_info = {
-                    'title': entry.get('title', f"Track {i+1}"),
-                    'artist': entry.get('uploader', 'Unknown Artist'),
-                    'album': entry.get('album', 'Unknown'),
-                    'image_url': entry.get('thumbnail'),
-                    'url': entry.get('webpage_url')
-                }
-                
-                # Call download_song directly
-                song_id = download_song_direct(track_info, user_id, playlist.id, parent_task_id=task_id)
-                
-                if song_id:
-                    successful_songs.append(song_id)
-                    logger.info(f"Successfully downloaded: {track_info['title']}")
-            
-            except Exception as song_error:
-                logger.error(f"Error downloading song {entry.get('title')}: {str(song_error)}", exc_info=True)
-        
         # Check if any songs were successfully downloaded
         if not successful_songs:
             logger.error("No songs were successfully downloaded")
-            
-            # If progress exists, update it to show failure
-            if progress:
-                progress.current_progress = 100
-                progress.current_file = "Failed - No songs downloaded"
-                progress.save()
-                
+            progress.current_progress = 100
+            progress.current_file = "Failed - No songs downloaded"
+            progress.save()
+
             # Delete the empty playlist
             playlist.delete()
-            
+
             raise ValueError("Failed to download any songs from the playlist")
-        else:
-            # At least some songs were downloaded successfully
-            logger.info(f"Playlist download complete. Downloaded {len(successful_songs)}/{total_entries} songs")
-        
+
         # Update final progress
         progress.current_progress = 100
         progress.current_file = f"Complete - {len(successful_songs)} songs downloaded"
         progress.save()
-        
+
+        logger.info(f"Playlist download complete. Downloaded {len(successful_songs)}/{total_tracks} songs")
         return playlist.id
 
+    except Exception:
+        progress.delete()
+        raise
+
+def download_youtube_playlist_direct(url, user_id):
+    """Direct download function (not a Celery task) for YouTube playlists"""
+    logger.info(f"Starting direct YouTube playlist download: {url} for user {user_id}")
+
+    try:
+        user = User.objects.get(id=user_id)
+        name, tracks = _extract_youtube_playlist(url)
+
+        # Create playlist
+        playlist = Playlist.objects.create(
+            user=user,
+            name=name,
+            source="youtube",
+            source_url=url
+        )
+        logger.info(f"Created playlist with ID: {playlist.id}")
+
+        return _download_playlist_in_process(playlist, tracks, user)
+
     except Exception as e:
         logger.error(f"Error downloading YouTube playlist: {str(e)}", exc_info=True)
-        # Clean up progress object if it exists
-        if progress:
-            progress.delete()
         raise
 
-@shared_task(bind=True)
-def download_youtube_playlist(self, url, user_id):
-    """Celery task wrapper for YouTube playlist download"""
-    logger.info(f"Celery task for YouTube playlist download: {url} for user {user_id}")
-    return download_youtube_playlist_direct(url, user_id)
-
 def download_spotify_playlist_direct(playlist_url, user_id):
     """Direct download function (not a Celery task) for Spotify playlists"""
     logger.info(f"Starting direct Spotify playlist download: {playlist_url} for user {user_id}")
-    
-    task_id = f"direct-{datetime.now().timestamp()}"
-    progress = None
-    
+
     try:
         user = User.objects.get(id=user_id)
-        
-        # Get playlist tracks
-        logger.info(f"Fetching tracks from Spotify playlist: {playlist_url}")
-        try:
-            playlist_tracks = get_playlist_tracks(playlist_url)
-            
-            if not playlist_tracks:
-                logger.error(f"No tracks found in Spotify playlist: {playlist_url}")
-                raise ValueError(f"No tracks found in Spotify playlist: {playlist_url}")
-                
-            logger.info(f"Found {len(playlist_tracks)} tracks in Spotify playlist")
-        except Exception as e:
-            logger.error(f"Error extracting Spotify playlist info: {str(e)}", exc_info=True)
-            raise ValueError(f"Could not extract playlist info: {str(e)}")
-        
+        name, tracks = _extract_spotify_playlist(playlist_url)
+
         # Create playlist
         playlist = Playlist.objects.create(
             user=user,
-            name=f"Spotify Playlist {playlist_url.split('/')[-1].split('?')[0]}",
+            name=name,
             source="spotify",
             source_url=playlist_url
         )
         logger.info(f"Created playlist with ID: {playlist.id}")
 
-        # Initialize progress tracking
-        total_tracks = len(playlist_tracks)
-        progress = DownloadProgress.objects.create(
-            task_id=task_id,
-            total_items=total_tracks,
-            current_progress=0,
-            current_file="Initializing..."
+        return _download_playlist_in_process(playlist, tracks, user)
+
+    except Exception as e:
+        logger.error(f"Error downloading Spotify playlist: {str(e)}", exc_info=True)
+        raise
+
+def _fan_out_playlist(task, playlist, tracks, user_id):
+    """
+    Replace a playlist task with a chord of subtasks, each running a chunk of
+    PLAYLIST_TRACKS_PER_TASK tracks through the download pipeline.
+
+    Chunks are dealt round-robin into PLAYLIST_MAX_PARALLEL_TASKS lanes; each lane
+    is a chain, so at most that many chunks of one playlist run at once while the
+    lanes themselves spread across the worker fleet. The chord callback assembles
+    the result once every lane has finished, and because the task is replaced,
+    its own task id (the one handed to the client) resolves to that result.
+    """
+    from celery import chain, chord
+
+    progress_task_id = task.request.id
+    total_tracks = len(tracks)
+    DownloadProgress.objects.create(
+        task_id=progress_task_id,
+        total_items=total_tracks,
+        current_progress=0,
+        current_file="Queued"
+    )
+
+    chunk_size = max(1, settings.PLAYLIST_TRACKS_PER_TASK)
+    chunks = [tracks[i:i + chunk_size] for i in range(0, total_tracks, chunk_size)]
+    lane_count = max(1, min(settings.PLAYLIST_MAX_PARALLEL_TASKS, len(chunks)))
+    lanes = [[] for _ in range(lane_count)]
+    for position, chunk in enumerate(chunks):
+        lanes[position % lane_count].append(
+            download_playlist_tracks.si(chunk, user_id, playlist.id, progress_task_id)
         )
 
-        # Process each track using the download_song function
-        successful_songs = []
-        
-        for i, track_info in enumerate(playlist_tracks):
-            logger.info(f"Processing track {i+1}/{total_tracks}: {track_info.get('title')}")
-            
-            try:
-                # Update progress
-                progress.current_progress = int((i / total_tracks) * 100)
-                progress.current_file = track_info.get('title', f"Track {i+1}")
-                progress.save()
-                
-                # Call download_song directly
-                song_id = download_song_direct(track_info, user_id, playlist.id, parent_task_id=task_id)
-                
-                if song_id:
-                    successful_songs.append(song_id)
-                    logger.info(f"Successfully downloaded: {track_info['title']}")
-            
-            except Exception as song_error:
-                logger.error(f"Error downloading song {track_info.get('title')}: {str(song_error)}", exc_info=True)
-        
-        # Check if any songs were successfully downloaded
-        if not successful_songs:
-            logger.error("No songs were successfully downloaded")
-            
-            # If progress exists, update it to show failure
-            if progress:
-                progress.current_progress = 100
-                progress.current_file = "Failed - No songs downloaded"
-                progress.save()
-                
-            # Delete the empty playlist
-            playlist.delete()
-            
-            raise ValueError("Failed to download any songs from the playlist")
-        
-        # Update final progress
-        progress.current_progress = 100
-        progress.current_file = f"Complete - {len(successful_songs)} songs downloaded"
-        progress.save()
-        
-        logger.info(f"Playlist download complete. Downloaded {len(successful_songs)}/{total_tracks} songs")
-        
-        return playlist.id
+    logger.info(f"Fanning out {total_tracks} tracks of playlist {playlist.id} as {len(chunks)} subtasks over {lane_count} lanes")
+    callback = finalize_playlist_download.s(playlist.id, progress_task_id, total_tracks)
+    return task.replace(chord([chain(*lane) for lane in lanes], callback))
 
+@shared_task(bind=True, acks_late=True)
+def download_playlist_tracks(self, tracks, user_id, playlist_id, progress_task_id):
+    """
+    Download a chunk of a fanned-out playlist through the download pipeline.
+
+    Track failures are counted and logged by the pipeline rather than raised, so
+    one bad track doesn't fail the chord and skip the playlist callback.
+    """
+    try:
+        user = User.objects.get(id=user_id)
+        song_ids, stats = _run_playlist_pipeline(tracks, user, playlist_id, progress_task_id)
     except Exception as e:
-        logger.error(f"Error downloading Spotify playlist: {str(e)}", exc_info=True)
-        # Clean up progress object if it exists
+        logger.error(f"download_playlist_tracks: Chunk of playlist {playlist_id} failed: {e}", exc_info=True)
+        return {'song_ids': [], 'error': str(e)}
+
+    logger.info(f"download_playlist_tracks: Downloaded {len(song_ids)}/{len(tracks)} tracks for playlist {playlist_id}")
+    return {'song_ids': song_ids, 'pipeline': stats}
+
+@shared_task(bind=True)
+def finalize_playlist_download(self, results, playlist_id, progress_task_id, total_tracks):
+    """
+    Chord callback for a fanned-out playlist download.
+    Counts what actually landed in the playlist rather than trusting lane results,
+    since each lane only reports its last chunk.
+    """
+    progress = DownloadProgress.objects.filter(task_id=progress_task_id).first()
+
+    try:
+        playlist = Playlist.objects.get(id=playlist_id)
+    except Playlist.DoesNotExist:
+        logger.error(f"finalize_playlist_download: Playlist {playlist_id} not found")
+        return {'success': False, 'error': 'Playlist not found'}
+
+    song_count = playlist.songs.count()
+    if not song_count:
+        logger.error(f"finalize_playlist_download: No songs were downloaded for playlist {playlist_id}")
         if progress:
-            progress.delete()
-        raise
+            progress.current_progress = 100
+            progress.current_file = "Failed - No songs downloaded"
+            progress.save()
+
+        # Delete the empty playlist
+        playlist.delete()
+        return {'success': False, 'error': 'Failed to download any songs from the playlist'}
+
+    if progress:
+        progress.current_progress = 100
+        progress.current_file = f"Complete - {song_count} songs downloaded"
+        progress.save()
+
+    logger.info(f"Playlist download complete. Downloaded {song_count}/{total_tracks} songs")
+    return {
+        'success': True,
+        'playlist_id': playlist.id,
+        'playlist_name': playlist.name,
+        'song_count': song_count,
+        'total_tracks': total_tracks,
+    }
+
+@shared_task(bind=True)
+def download_youtube_playlist(self, url, user_id):
+    """Celery task for YouTube playlist download; tracks run as parallel pipeline subtasks"""
+    logger.info(f"Celery task for YouTube playlist download: {url} for user {user_id}")
+    user = User.objects.get(id=user_id)
+    name, tracks = _extract_youtube_playlist(url)
+
+    playlist = Playlist.objects.create(
+        user=user,
+        name=name,
+        source="youtube",
+        source_url=url
+    )
+    logger.info(f"Created playlist with ID: {playlist.id}")
+
+    return _fan_out_playlist(self, playlist, tracks, user_id)
 
 @shared_task(bind=True)
 def download_spotify_playlist(self, playlist_url, user_id):
-    """Celery task wrapper for Spotify playlist download"""
+    """Celery task for Spotify playlist download; tracks run as parallel pipeline subtasks"""
     logger.info(f"Celery task for Spotify playlist download: {playlist_url} for user {user_id}")
-    return download_spotify_playlist_direct(playlist_url, user_id)
+    user = User.objects.get(id=user_id)
+    name, tracks = _extract_spotify_playlist(playlist_url)
+
+    playlist = Playlist.objects.create(
+        user=user,
+        name=name,
+        source="spotify",
+        source_url=playlist_url
+    )
+    logger.info(f"Created playlist with ID: {playlist.id}")
+
+    return _fan_out_playlist(self, playlist, tracks, user_id)
 
 @shared_task
 def cleanup_cache():
@@ -751,8 +998,207 @@ def cleanup_cache():
     # Clean up entries older than 2 days and unused entries
     call_command('cleanup_cache', '--days=2', '--unused')
     
+    # Remove staging directories left behind by crashed or killed downloads
+    from .utils import clean_staging
+    clean_staging()
+    
+    # Correct any drift in the running byte total, then enforce the budget
+    from . import cache_manager
+    if cache_manager.sync_bytes() > settings.SONG_CACHE_MAX_BYTES:
+        cache_manager.evict()
+    
     logger.info("Cache cleanup task completed")
 
+@shared_task
+def flush_cache_accesses():
+    """Write buffered SongCache hits (last access times and counts) to the database"""
+    from . import cache_manager
+    return cache_manager.flush_accesses()
+
+@shared_task
+def warm_song_cache():
+    """
+    Off-peak prefetch of trending and recommended tracks into the SongCache.
+    Queues one warm_cached_track per track at SONG_CACHE_WARM_PRIORITY (the
+    lowest), so workers only pick them up when no user download is waiting.
+    """
+    from . import cache_warmer
+
+    if not cache_warmer.is_off_peak():
+        return 0
+    logger.info(f"Cache warming report for yesterday: {cache_warmer.warm_report()}")
+    urls = cache_warmer.plan()
+    for url in urls:
+        warm_cached_track.apply_async(args=[url], priority=settings.SONG_CACHE_WARM_PRIORITY, expires=3600)
+    logger.info(f"Queued {len(urls)} tracks for cache warming")
+    return len(urls)
+
+@shared_task(acks_late=True)
+def warm_cached_track(url):
+    """Download one track into the SongCache for warm_song_cache"""
+    from . import cache_warmer
+    return cache_warmer.warm_track(url)
+
+@shared_task
+def rebalance_storage_tiers():
+    """Move audio files between local disk and the cold tier by how often they are read"""
+    from . import storage
+    return storage.rebalance()
+
+@shared_task
+def reconcile_media_index():
+    """
+    Scheduled repair of the MediaFileIndex: drop entries whose file is gone,
+    index songs whose stored file exists, and find files for songs whose stored
+    path is stale with one walk of the media tree. This is the only place the
+    tree is scanned, so request paths never have to.
+    """
+    from .utils import canonical_key, sanitize_filename
+
+    batch_size = settings.MEDIA_INDEX_RECONCILE_BATCH_SIZE
+    media_root = settings.MEDIA_ROOT
+    stats = {'pruned': 0, 'indexed': 0, 'repaired': 0, 'unresolved': 0}
+
+    # 1. Prune entries pointing at missing files
+    stale_ids = [
+        entry_id
+        for entry_id, rel_path in MediaFileIndex.objects.values_list('id', 'file_path').iterator(chunk_size=batch_size)
+        if not os.path.isfile(os.path.join(media_root, rel_path))
+    ]
+    for i in range(0, len(stale_ids), batch_size):
+        MediaFileIndex.objects.filter(id__in=stale_ids[i:i + batch_size]).delete()
+    stats['pruned'] = len(stale_ids)
+
+    # 2. Index songs whose own file exists; remember the rest
+    indexed = set(MediaFileIndex.objects.values_list('key', flat=True))
+    found = []
+    missing = {}
+    songs = Song.objects.exclude(song_url__isnull=True).exclude(song_url='').values_list('song_url', 'file', 'title', 'artist')
+    for song_url, rel_path, title, artist in songs.iterator(chunk_size=batch_size):
+        key = canonical_key(song_url)
+        if not key or key in indexed:
+            continue
+        if rel_path and os.path.isfile(os.path.join(media_root, rel_path)):
+            found.append((key, rel_path))
+            indexed.add(key)
+            missing.pop(key, None)
+        else:
+            missing[key] = (title or '', artist or '')
+        if len(found) >= batch_size:
+            stats['indexed'] += MediaFileIndex.record(found)
+            found = []
+    stats['indexed'] += MediaFileIndex.record(found)
+
+    # 3. One walk of the media tree to find files for the remaining songs
+    if missing:
+        skip_dirs = {settings.MEDIA_STAGING_DIR, settings.TRANSCODE_CACHE_DIR}
+        files = {}
+        for root, dirs, names in os.walk(media_root):
+            if root == media_root:
+                dirs[:] = [d for d in dirs if d not in skip_dirs]
+            for name in names:
+                if name.lower().endswith('.mp3'):
+                    files.setdefault(name.lower(), os.path.relpath(os.path.join(root, name), media_root))
+
+        repaired = []
+        for key, (title, artist) in missing.items():
+            base = f"{title} - {artist}"
+            candidates = [
+                sanitize_filename(f"{base}{suffix}.mp3").lower()
+                for suffix in ('', ' Official Music Video', ' Official Lyric Video')
+            ]
+            rel_path = next((files[c] for c in candidates if c in files), None)
+            if rel_path is None and title and artist:
+                title_l, artist_l = title.lower(), artist.lower()
+                rel_path = next((path for name, path in files.items() if title_l in name and artist_l in name), None)
+            if rel_path:
+                repaired.append((key, rel_path))
+            else:
+                stats['unresolved'] += 1
+        stats['repaired'] = MediaFileIndex.record(repaired)
+
+    logger.info(f"Media index reconciled: {stats}")
+    return stats
+
+def _archive_pending_key(playlist_id):
+    return f"playlist_archive_pending:{playlist_id}"
+
+def schedule_playlist_archive(playlist_id):
+    """
+    Queue a rebuild of a playlist's prebuilt ZIP after a membership change.
+    The build waits PLAYLIST_ARCHIVE_BUILD_DELAY seconds and only one is queued
+    per playlist at a time, so an import adding many batches builds once.
+    """
+    from django.core.cache import cache
+
+    delay = settings.PLAYLIST_ARCHIVE_BUILD_DELAY
+    if not cache.add(_archive_pending_key(playlist_id), True, delay + 60):
+        return
+    try:
+        build_playlist_archive.apply_async(args=[playlist_id], countdown=delay)
+    except Exception as e:
+        cache.delete(_archive_pending_key(playlist_id))
+        logger.error(f"Failed to schedule archive build for playlist {playlist_id}: {e}")
+
+@shared_task
+def build_playlist_archive(playlist_id):
+    """
+    Build the prebuilt ZIP for a playlist's current songs. If an earlier archive
+    holds the first songs of the new list (songs were only appended), its entries
+    are copied as-is and only the new songs are added. Older archives of the
+    playlist are removed once the new one is in place.
+    """
+    from django.core.cache import cache
+    from .models import PlaylistArchive
+    from .utils import make_staging_dir, publish_file
+    from .zipstream import write_archive
+
+    # Changes from here on schedule another build
+    cache.delete(_archive_pending_key(playlist_id))
+
+    playlist = Playlist.objects.filter(id=playlist_id).first()
+    if playlist is None:
+        return None
+
+    files, missing = PlaylistArchive.collect_files(PlaylistArchive.playlist_songs(playlist))
+    if not files:
+        logger.info(f"No song files to archive for playlist {playlist_id}")
+        return None
+
+    key, manifest = PlaylistArchive.manifest_for(files)
+    archive = PlaylistArchive.current(playlist, key)
+    if archive is None:
+        base = PlaylistArchive.appendable_base(playlist, manifest)
+        rel_path = os.path.join(settings.PLAYLIST_ARCHIVE_DIR, str(playlist_id), f"{key}.zip")
+        staging_dir = make_staging_dir()
+        try:
+            part_path = os.path.join(staging_dir, 'archive.zip')
+            if base:
+                size = write_archive(part_path, files[len(base.manifest):], base_path=base.full_path)
+            else:
+                size = write_archive(part_path, files)
+            publish_file(part_path, os.path.join(settings.MEDIA_ROOT, rel_path))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        archive, _ = PlaylistArchive.objects.update_or_create(
+            playlist=playlist, key=key,
+            defaults={'manifest': manifest, 'file_path': rel_path, 'file_size': size}
+        )
+        appended = len(files) - len(base.manifest) if base else len(files)
+        logger.info(f"Built archive {key[:12]} for playlist {playlist_id}: {len(files)} songs, "
+                    f"{appended} written, {len(missing)} missing, {size} bytes")
+
+    # Only the current archive is kept; open downloads of older ones keep their file handle
+    for old in PlaylistArchive.objects.filter(playlist=playlist).exclude(id=archive.id):
+        try:
+            os.remove(old.full_path)
+        except OSError:
+            pass
+        old.delete()
+
+    return key
+
 @shared_task
 def update_user_recommendations_async(user_id):
     """
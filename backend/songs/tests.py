@@ -1,7 +1,8 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.utils import timezone
+from django.conf import settings
 from rest_framework.test import APITestCase, APIClient
 from rest_framework.authtoken.models import Token
 from rest_framework import status
@@ -11,7 +12,7 @@ import os
 from datetime import timedelta
 import json
 
-from .models import Song, Playlist, UserMusicProfile, SongCache, SongPlay, UserAnalytics, Genre
+from .models import Song, Playlist, UserMusicProfile, SongCache, SongPlay, UserAnalytics, Genre, DownloadJob, SpotifyMatch, TranscodedVariant, MediaFileIndex
 from .utils import YouTubeAPIError, SpotifyAPIError
 
 User = get_user_model()
@@ -129,6 +130,329 @@ class ModelTests(TestCase):
         self.assertEqual(analytics.songs_played, 2)
         self.assertEqual(analytics.listening_time, 300)
         
+    def test_batched_playlist_persistence(self):
+        """Test the playlist writer saves a batch with bulk queries and counter updates"""
+        from songs.download_helper import _persist_playlist_tracks
+
+        batch = [
+            {'kind': 'existing', 'song_id': self.song.id, 'track_url': self.song.song_url},
+            {
+                'kind': 'cached',
+                'track_url': 'https://youtube.com/watch?v=cached',
+                'rel_path': 'cache/cached.mp3',
+                'metadata': {'title': 'Cached Song', 'artist': 'Cache Artist'},
+            },
+            {
+                'kind': 'downloaded',
+                'track_url': 'https://youtube.com/watch?v=new',
+                'rel_path': 'songs/new.mp3',
+                'source': 'youtube',
+                'info_dict': {'title': 'New Song', 'id': 'new'},
+                'metadata': {
+                    'title': 'New Song' + 'x' * 150, 'artist': 'New Artist', 'album': 'Unknown',
+                    'spotify_id': None, 'thumbnail_url': None,
+                },
+            },
+        ]
+        playlist = Playlist.objects.create(user=self.user, name='Batch', source='youtube', source_url='')
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            os.makedirs(os.path.join(media_root, 'songs'))
+            with open(os.path.join(media_root, 'songs', 'new.mp3'), 'wb') as f:
+                f.write(b'\0' * 1024)
+            song_ids = _persist_playlist_tracks(self.user, playlist, batch)
+            # The writer links the new file into the cache
+            self.assertTrue(os.path.samefile(os.path.join(media_root, 'songs', 'new.mp3'),
+                                             os.path.join(media_root, 'cache', 'new.mp3')))
+
+        self.assertEqual(len(song_ids), 3)
+        self.assertEqual(playlist.songs.count(), 3)
+        # Fields are still truncated even though bulk_create skips save()
+        new_song = Song.objects.get(song_url='https://youtube.com/watch?v=new')
+        self.assertLessEqual(len(new_song.title), 98)
+        self.assertTrue(SongCache.objects.filter(song_url='https://youtube.com/watch?v=new', file_size=1024).exists())
+
+        # Only the two newly created songs count as downloads
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.total_songs_downloaded, 2)
+        analytics = UserAnalytics.objects.get(user=self.user, date=timezone.now().date())
+        self.assertEqual(analytics.songs_downloaded, 2)
+
+    @patch('songs.download_helper.download_from_huggingface')
+    def test_spotify_match_cache(self, mock_download):
+        """Test remembered Spotify -> YouTube matches replace the search"""
+        from songs.download_helper import download_spotify_source
+        from songs.utils import ExternalAPIError
+
+        track = {'spotify_id': 'sp123', 'title': 'Song', 'artist': 'Band'}
+        mock_download.return_value = {'filepath': '/tmp/x.mp3', 'id': None, 'source_title': 'Band - Song (Official Video)'}
+
+        # No match yet: search by title and artist
+        download_spotify_source(track, '/tmp')
+        self.assertIn('search_query=Song+Band', mock_download.call_args[0][0])
+
+        # Remember the video it resolved to
+        SpotifyMatch.remember([SpotifyMatch.build('sp123', 'yt456', 'Song', 'Band', 'Band - Song (Official Video)')])
+        match = SpotifyMatch.lookup('sp123')
+        self.assertEqual(match.youtube_id, 'yt456')
+        self.assertGreaterEqual(match.confidence, 0.9)
+
+        # Next download goes straight to the video
+        info = download_spotify_source(track, '/tmp')
+        self.assertEqual(mock_download.call_args[0][0], 'https://www.youtube.com/watch?v=yt456')
+        self.assertEqual(info['id'], 'yt456')
+
+        # Poor matches are kept but never trusted
+        SpotifyMatch.remember([SpotifyMatch.build('sp123', 'yt789', 'Song', 'Band', 'Completely different')])
+        self.assertIsNone(SpotifyMatch.lookup('sp123'))
+
+        # A timeout or throttling says nothing about the video: the error is raised and the match kept
+        SpotifyMatch.remember([SpotifyMatch.build('sp123', 'yt456', 'Song', 'Band', 'Band - Song')])
+        mock_download.reset_mock()
+        mock_download.side_effect = [ExternalAPIError('Download API timed out', status_code=503)]
+        with self.assertRaises(ExternalAPIError):
+            download_spotify_source(track, '/tmp')
+        self.assertEqual(mock_download.call_count, 1)
+        self.assertIsNotNone(SpotifyMatch.lookup('sp123'))
+
+        # A match whose video is unavailable is forgotten and the search is used instead
+        mock_download.side_effect = [Exception("ERROR: [youtube] yt456: Private video. Sign in if you've been granted access"),
+                                     {'filepath': '/tmp/x.mp3', 'id': None}]
+        download_spotify_source(track, '/tmp')
+        self.assertIn('search_query=', mock_download.call_args[0][0])
+        self.assertFalse(SpotifyMatch.objects.filter(spotify_id='sp123').exists())
+
+    def test_song_cache_budget(self):
+        """Test the song cache stays within its byte budget and reports hit ratios"""
+        from django.core.cache import cache
+        from songs import cache_manager
+        
+        cache.clear()
+        expires = timezone.now() + timedelta(days=7)
+        with override_settings(SONG_CACHE_MAX_BYTES=250, SONG_CACHE_POLICY='lru'):
+            for name in ('a', 'b'):
+                SongCache.store(f'https://youtube.com/watch?v={name}', file_path=f'cache/{name}.mp3', file_size=100, expires_at=expires)
+            self.assertIsNotNone(SongCache.get_cached_song('https://youtube.com/watch?v=a'))
+            self.assertIsNone(SongCache.get_cached_song('https://youtube.com/watch?v=c'))
+            
+            # Over budget: the least recently used entry goes, down to 90% of the budget
+            SongCache.store('https://youtube.com/watch?v=c', file_path='cache/c.mp3', file_size=100, expires_at=expires)
+            self.assertEqual(set(SongCache.objects.values_list('song_url', flat=True)),
+                             {'https://youtube.com/watch?v=a', 'https://youtube.com/watch?v=c'})
+            
+            stats = cache_manager.stats()
+            self.assertEqual((stats['used_bytes'], stats['evictions'], stats['hit_ratio']), (200, 1, 0.5))
+            self.assertEqual(stats['byte_hit_ratio'], round(100 / 400, 4))
+        
+        with override_settings(SONG_CACHE_MAX_BYTES=250, SONG_CACHE_POLICY='tinylfu'):
+            for _ in range(3):
+                SongCache.get_cached_song('https://youtube.com/watch?v=c')
+            SongCache.get_cached_song('https://youtube.com/watch?v=a')
+            # A one-off track doesn't displace entries that are looked up more often
+            self.assertIsNone(SongCache.store('https://youtube.com/watch?v=d', file_path='cache/d.mp3', file_size=100, expires_at=expires))
+            self.assertEqual(SongCache.objects.count(), 2)
+            self.assertEqual(cache_manager.stats()['rejections'], 1)
+
+    def test_buffered_cache_access(self):
+        """Test cache hits are read-only and their access times are written in batches"""
+        from songs import cache_manager
+        
+        url = 'https://youtube.com/watch?v=hot'
+        entry = SongCache.store(url, file_path='cache/hot.mp3', file_size=100, expires_at=timezone.now() + timedelta(days=7))
+        SongCache.objects.filter(pk=entry.pk).update(accessed_at=timezone.now() - timedelta(days=1))
+        
+        with override_settings(SONG_CACHE_ACCESS_FLUSH_SECONDS=3600):
+            for _ in range(3):
+                with self.assertNumQueries(0):
+                    self.assertIsNotNone(SongCache.get_cached_song(url))
+        
+        self.assertEqual(cache_manager.flush_accesses(), 1)
+        entry.refresh_from_db()
+        self.assertEqual(entry.hit_count, 3)
+        self.assertGreater(entry.accessed_at, timezone.now() - timedelta(minutes=1))
+        self.assertEqual(cache_manager.flush_accesses(), 0)
+
+    def test_song_cache_metadata_layer(self):
+        """Test cache lookups are answered from the shared cache and kept coherent"""
+        from django.core.cache import cache
+        from songs import cache_manager
+        
+        cache.clear()
+        expires = timezone.now() + timedelta(days=7)
+        urls = [f'https://www.youtube.com/watch?v=abcdefghij{n}' for n in range(3)]
+        for url in urls[:2]:
+            SongCache.objects.create(song_url=url, file_path='cache/x.mp3', file_size=10, expires_at=expires, metadata={'title': url})
+        
+        # First batch lookup goes to the database, then only misses do
+        with self.assertNumQueries(1):
+            self.assertEqual(set(SongCache.get_cached_songs(urls)), set(urls[:2]))
+        with self.assertNumQueries(0):
+            entries = SongCache.get_cached_songs(urls[:2])
+        self.assertEqual(entries[urls[0]].metadata, {'title': urls[0]})
+        self.assertEqual(entries[urls[0]].pk, SongCache.objects.get(song_url=urls[0]).pk)
+        
+        # Evicting an entry drops its copy
+        cache_manager.evict(target_bytes=10)
+        self.assertEqual(len(SongCache.get_cached_songs(urls)), 1)
+
+    def test_cleanup_cache_command(self):
+        """Test cache cleanup deletes in batches, resumes from its checkpoint and removes orphans"""
+        import io
+        from django.core.cache import cache
+        from django.core.management import call_command
+        
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            for rel_path in ('cache/a.mp3', 'cache/b.mp3', 'songs/test.mp3', 'songs/orphan.mp3'):
+                os.makedirs(os.path.join(media_root, os.path.dirname(rel_path)), exist_ok=True)
+                with open(os.path.join(media_root, rel_path), 'wb') as f:
+                    f.write(b'audio')
+            # A path that can't be removed is logged and its entry still deleted
+            os.makedirs(os.path.join(media_root, 'cache', 'c.mp3'))
+            expires = timezone.now() + timedelta(days=7)
+            a = SongCache.objects.create(song_url='https://youtube.com/watch?v=a', file_path='cache/a.mp3', file_size=5, expires_at=expires)
+            SongCache.objects.create(song_url='https://youtube.com/watch?v=b', file_path='cache/b.mp3', file_size=5, expires_at=expires)
+            SongCache.objects.create(song_url='https://youtube.com/watch?v=c', file_path='cache/c.mp3', file_size=5, expires_at=expires)
+            SongCache.objects.update(created_at=timezone.now() - timedelta(days=10))
+            
+            # An interrupted run already got past entry a
+            cache.set('cleanup_cache:checkpoint:entries', a.id, None)
+            call_command('cleanup_cache', '--days=2', '--unused', '--orphan-age-hours=0', '--rate=0',
+                         '--batch-size=1', stdout=io.StringIO())
+            
+            self.assertEqual(list(SongCache.objects.values_list('song_url', flat=True)), ['https://youtube.com/watch?v=a'])
+            self.assertEqual(sorted(os.listdir(os.path.join(media_root, 'cache'))), ['a.mp3', 'c.mp3'])
+            # Files used by a Song or a cache entry stay; the orphan goes
+            self.assertEqual(os.listdir(os.path.join(media_root, 'songs')), ['test.mp3'])
+            self.assertIsNone(cache.get('cleanup_cache:checkpoint:entries'))
+
+    @override_settings(PLAYLIST_TRACKS_PER_TASK=10, PLAYLIST_MAX_PARALLEL_TASKS=2)
+    def test_playlist_fan_out(self):
+        """Test playlist tracks are chunked into lanes of chained subtasks under one chord callback"""
+        from songs.models import DownloadProgress
+        from songs.tasks import _fan_out_playlist, download_playlist_tracks, finalize_playlist_download
+        
+        playlist = Playlist.objects.create(user=self.user, name='Fan Out')
+        tracks = [{'n': n} for n in range(25)]
+        task = MagicMock()
+        task.request.id = 'fanout-task'
+        with patch.object(download_playlist_tracks, 'si', side_effect=lambda chunk, *args: ([t['n'] for t in chunk], args)), \
+                patch('celery.chain', side_effect=lambda *subtasks: list(subtasks)) as mock_chain, \
+                patch('celery.chord') as mock_chord:
+            result = _fan_out_playlist(task, playlist, tracks, self.user.id)
+        
+        # 25 tracks make chunks of 10, 10 and 5, dealt round-robin into 2 lanes
+        lanes, callback = mock_chord.call_args[0]
+        self.assertEqual(mock_chain.call_count, 2)
+        self.assertEqual([[chunk for chunk, args in lane] for lane in lanes],
+                         [[list(range(0, 10)), list(range(20, 25))], [list(range(10, 20))]])
+        self.assertEqual(lanes[0][0][1], (self.user.id, playlist.id, 'fanout-task'))
+        self.assertEqual(callback.task, finalize_playlist_download.name)
+        self.assertEqual(tuple(callback.args), (playlist.id, 'fanout-task', 25))
+        task.replace.assert_called_once_with(mock_chord.return_value)
+        self.assertEqual(result, task.replace.return_value)
+        self.assertEqual(DownloadProgress.objects.get(task_id='fanout-task').total_items, 25)
+        
+        # The callback reports what landed in the playlist, whatever the lanes returned
+        playlist.songs.add(self.song)
+        summary = finalize_playlist_download([{'song_ids': []}, {'song_ids': []}], playlist.id, 'fanout-task', 25)
+        self.assertEqual((summary['success'], summary['song_count'], summary['total_tracks']), (True, 1, 25))
+        self.assertEqual(DownloadProgress.objects.get(task_id='fanout-task').current_progress, 100)
+        
+        # A playlist nothing was downloaded into is removed
+        playlist.songs.clear()
+        summary = finalize_playlist_download([], playlist.id, 'fanout-task', 25)
+        self.assertFalse(summary['success'])
+        self.assertFalse(Playlist.objects.filter(id=playlist.id).exists())
+
+    def test_cache_warming(self):
+        """Test the warmer prefetches trending and recommended tracks within its budgets"""
+        from django.core.cache import cache
+        from songs import cache_manager, cache_warmer
+
+        cache.clear()
+        trending = 'https://www.youtube.com/watch?v=trendingvid'
+        for url in (trending, trending, 'https://youtu.be/trendingvid'):
+            DownloadJob.objects.create(user=self.user, url=url)
+        self.profile.cached_recommendations = [{'spotify_id': 'rec1', 'title': 'Rec'}]
+        self.profile.save()
+
+        candidates = cache_warmer.candidates()
+        self.assertEqual(candidates[0], trending)
+        self.assertIn('https://open.spotify.com/track/rec1', candidates)
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+                MEDIA_ROOT=media_root, SONG_CACHE_WARM_HOURS='*', SONG_CACHE_WARM_MAX_CALLS_PER_HOUR=1):
+            os.makedirs(os.path.join(media_root, 'songs'))
+            with open(os.path.join(media_root, 'songs/Trending.mp3'), 'wb') as f:
+                f.write(b'audio')
+            self.assertEqual(cache_warmer.plan(), [trending])
+
+            payload = {'rel_path': 'songs/Trending.mp3',
+                       'metadata': {'title': 'Trending', 'artist': 'Artist', 'source': 'youtube', 'id': 'trendingvid'}}
+            with patch('songs.download_helper.download_track_file', return_value=payload):
+                self.assertEqual(cache_warmer.warm_track(trending), 'warmed')
+                # The hour's call budget is spent
+                self.assertEqual(cache_warmer.warm_track('https://open.spotify.com/track/rec1'), 'skipped')
+            # Only the cache's link to the file is kept
+            self.assertFalse(os.path.exists(os.path.join(media_root, 'songs/Trending.mp3')))
+            self.assertTrue(os.path.exists(os.path.join(media_root, 'cache/Trending.mp3')))
+
+        self.assertIsNotNone(SongCache.get_cached_song(trending))
+        stats = cache_manager.stats()
+        self.assertEqual((stats['warmed'], stats['warmed_hits']), (1, 1))
+        # The report only reads what the scheduled flush has written
+        self.assertEqual(cache_warmer.warm_report(timezone.localdate())['hits'], 0)
+        cache_manager.flush_accesses()
+        report = cache_warmer.warm_report(timezone.localdate())
+        self.assertEqual((report['warmed'], report['used'], report['hits']), (1, 1, 1))
+
+    @patch('songs.download_helper.get_transcoded_file')
+    @patch('songs.download_helper.embed_metadata')
+    @patch('songs.download_helper.download_from_huggingface')
+    def test_fresh_download_keeps_mp3_source(self, mock_download, mock_embed, mock_transcode):
+        """Test a fresh download in another format stores the mp3 and transcodes from it"""
+        from songs.download_helper import fetch_youtube_track
+
+        def fake_download(url, temp_dir, **kwargs):
+            path = os.path.join(temp_dir, 'track.mp3')
+            with open(path, 'wb') as f:
+                f.write(b'mp3 audio')
+            return {'filepath': path, 'title': 'Fresh', 'artist': 'Band', 'id': 'freshvideo1'}
+        mock_download.side_effect = fake_download
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            mock_transcode.return_value = os.path.join(media_root, 'transcodes', 'x.aac')
+            result = fetch_youtube_track(self.user, 'https://www.youtube.com/watch?v=freshvideo1', 'aac')
+
+            song = Song.objects.get(id=result['song_id'])
+            self.assertEqual(song.file.name, 'songs/Fresh - Band.mp3')
+            self.assertTrue(SongCache.get_cached_song('https://youtu.be/freshvideo1').file_path.endswith('.mp3'))
+            self.assertEqual(mock_transcode.call_args[0], (os.path.join(media_root, 'songs', 'Fresh - Band.mp3'), 'aac'))
+            self.assertEqual((result['path'], result['filename']), (mock_transcode.return_value, 'Fresh - Band.aac'))
+
+    def test_cache_ingest(self):
+        """Test downloads enter the cache through one path with a canonical key and full metadata"""
+        from django.core.cache import cache
+        from songs import cache_manager
+
+        cache.clear()
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            os.makedirs(os.path.join(media_root, 'songs'))
+            with open(os.path.join(media_root, 'songs/x.mp3'), 'wb') as f:
+                f.write(b'audio')
+
+            entry = SongCache.ingest('https://youtu.be/abcdefghijk', 'songs/x.mp3', {'title': 'X'})
+            self.assertEqual((entry.file_path, entry.source_key, entry.file_size), ('cache/x.mp3', 'youtube:abcdefghijk', 5))
+            self.assertTrue(os.path.exists(os.path.join(media_root, 'cache/x.mp3')))
+            self.assertEqual(set(entry.metadata), set(cache_manager.METADATA_FIELDS))
+            # A file that isn't there is counted as a download that couldn't be cached
+            self.assertIsNone(SongCache.ingest('https://youtu.be/missingfile', 'songs/missing.mp3', {}))
+
+        # Other spellings of the same track find the entry
+        self.assertEqual(SongCache.get_cached_song('https://www.youtube.com/watch?v=abcdefghijk').pk, entry.pk)
+        stats = cache_manager.stats()
+        self.assertEqual((stats['downloads'], stats['cacheable'], stats['cacheable_ratio']), (2, 1, 0.5))
+
 class APITests(APITestCase):
     """Test the API endpoints"""
     
@@ -209,7 +533,43 @@ class APITests(APITestCase):
             # Verify user download count was incremented
             self.user.refresh_from_db()
             self.assertEqual(self.user.daily_downloads, 1)
-    
+
+    @patch('songs.download_helper.download_from_huggingface')
+    def test_negative_cached_source(self, mock_download):
+        """Test a source that failed for good fails fast with Retry-After"""
+        from django.core.cache import cache
+        from .utils import YouTubeAPIError
+
+        cache.clear()
+        mock_download.side_effect = YouTubeAPIError('ERROR: [youtube] privatevid1: Private video')
+        url = reverse('song-download')
+        data = {'url': 'https://www.youtube.com/watch?v=privatevid1', 'format': 'mp3'}
+
+        for _ in range(2):
+            response = self.client.post(url, data)
+            self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+            self.assertEqual(response.data['error_class'], 'unavailable')
+            self.assertGreater(int(response['Retry-After']), 0)
+        # Only the first attempt reached the download API, and a different spelling hits too
+        self.assertEqual(mock_download.call_count, 1)
+        response = self.client.post(url, {'url': 'https://youtu.be/privatevid1', 'format': 'mp3'})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(mock_download.call_count, 1)
+
+    def test_source_error_classification(self):
+        """Test only errors about the source itself are negative-cached"""
+        from .utils import classify_source_error
+
+        for message in ('ERROR: [youtube] abc: Private video. Sign in if you\'ve been granted access',
+                        'ERROR: [youtube] abc: Video unavailable. This video has been removed by the uploader',
+                        'ERROR: [youtube] abc: This video is no longer available due to a copyright claim'):
+            self.assertEqual(classify_source_error(YouTubeAPIError(message)), 'unavailable', message)
+        # Throttling and format extraction failures clear up by themselves
+        for message in ('ERROR: [youtube] abc: Requested format is not available',
+                        "ERROR: [youtube] abc: Video unavailable. This content isn't available, try again later.",
+                        'ERROR: [youtube] abc: Video unavailable. This content isn\u2019t available, try again later.'):
+            self.assertIsNone(classify_source_error(YouTubeAPIError(message)), message)
+
     def test_song_play_recording(self):
         """Test recording a song play"""
         url = reverse('record-play')
@@ -284,6 +644,431 @@ class APITests(APITestCase):
         self.assertIn('error', response.json())
         self.assertEqual(response.json()['error'], 'Daily download limit reached')
 
+    @patch('songs.tasks.process_download_job.apply_async')
+    def test_submit_download_job(self, mock_apply_async):
+        """Test queueing a download job and polling its status"""
+        mock_apply_async.return_value = MagicMock(id='celery-task-id')
+        
+        response = self.client.post(reverse('song-jobs'), {
+            'url': 'https://youtube.com/watch?v=test',
+            'format': 'mp3'
+        })
+        
+        # Submitting returns immediately with a job id
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = DownloadJob.objects.get(id=response.json()['job_id'])
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.task_id, 'celery-task-id')
+        
+        # Free users are queued with the free-tier priority
+        self.assertEqual(
+            mock_apply_async.call_args.kwargs['priority'],
+            settings.DOWNLOAD_JOB_PRIORITIES['free']
+        )
+        
+        # Status can be polled by the owner
+        status_response = self.client.get(reverse('song-job-status', kwargs={'job_id': job.id}))
+        self.assertEqual(status_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(status_response.json()['status'], 'queued')
+        self.assertEqual(status_response['Retry-After'], str(settings.DOWNLOAD_JOB_POLL_SECONDS))
+
+        # The events stream gives the worker back after a short wait instead of following the whole job
+        with override_settings(DOWNLOAD_JOB_EVENT_INTERVAL=0.01, DOWNLOAD_JOB_EVENT_TIMEOUT=0.05):
+            events_response = self.client.get(reverse('song-job-events', kwargs={'job_id': job.id}))
+            events = b''.join(events_response.streaming_content).decode()
+        self.assertIn('event: timeout', events)
+        self.assertIn(f'retry: {settings.DOWNLOAD_JOB_POLL_SECONDS * 1000}', events)
+        
+        # The file is not available until the job completes
+        file_response = self.client.get(reverse('song-job-file', kwargs={'job_id': job.id}))
+        self.assertEqual(file_response.status_code, status.HTTP_409_CONFLICT)
+
+    @patch('songs.tasks.process_download_job.apply_async')
+    def test_download_job_quota(self, mock_apply_async):
+        """Test queued jobs count against the daily limit and a job over it fails without downloading"""
+        from songs.tasks import process_download_job
+        
+        mock_apply_async.return_value = MagicMock(id='celery-task-id')
+        self.user.daily_downloads = 14
+        self.user.save()
+        
+        # The one download left can be queued once, not once per request
+        data = {'url': 'https://youtube.com/watch?v=test', 'format': 'mp3'}
+        self.assertEqual(self.client.post(reverse('song-jobs'), data).status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.client.post(reverse('song-jobs'), data).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(DownloadJob.objects.count(), 1)
+        
+        # If the quota is gone by the time the job runs, it fails before fetching
+        self.user.daily_downloads = 15
+        self.user.save()
+        with patch('songs.download_helper.fetch_youtube_track') as mock_fetch:
+            self.assertEqual(process_download_job(str(DownloadJob.objects.get().id)), 'failed')
+        mock_fetch.assert_not_called()
+        self.assertEqual(DownloadJob.objects.get().error, 'Daily download limit reached')
+
+    def test_file_range_and_conditional_get(self):
+        """Test song files honour Range, If-None-Match and If-Range"""
+        with override_settings(MEDIA_ROOT=self.temp_dir.name):
+            os.makedirs(os.path.join(self.temp_dir.name, 'songs'))
+            os.replace(self.temp_file, os.path.join(self.temp_dir.name, 'songs', 'test.mp3'))
+            url = reverse('song-download-file', kwargs={'pk': self.song.id})
+            
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            etag = response['ETag']
+            self.assertIn('Last-Modified', response)
+            self.assertEqual(b''.join(response.streaming_content), b'test content')
+            
+            # Seeking fetches only the requested bytes
+            response = self.client.get(url, HTTP_RANGE='bytes=5-')
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join(response.streaming_content), b'content')
+            self.assertEqual(response['Content-Range'], 'bytes 5-11/12')
+            
+            # A stale If-Range falls back to the whole file
+            response = self.client.get(url, HTTP_RANGE='bytes=0-3', HTTP_IF_RANGE='"stale"')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), b'test content')
+            
+            response = self.client.get(url, HTTP_RANGE='bytes=50-')
+            self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.assertEqual(response['Content-Range'], 'bytes */12')
+            
+            # Revalidating an unchanged file costs no body
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_signed_media_url(self):
+        """Test serialized file URLs are signed and served without database queries"""
+        with override_settings(MEDIA_ROOT=self.temp_dir.name):
+            os.makedirs(os.path.join(self.temp_dir.name, 'songs'))
+            os.replace(self.temp_file, os.path.join(self.temp_dir.name, 'songs', 'test.mp3'))
+            
+            response = self.client.get(reverse('song-detail', kwargs={'pk': self.song.id}))
+            file_url = response.json()['file_url']
+            self.assertIn(settings.SIGNED_MEDIA_URL, file_url)
+            
+            anonymous = APIClient()
+            with self.assertNumQueries(0):
+                response = anonymous.get(file_url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), b'test content')
+            
+            # Tampered or expired links are refused
+            self.assertEqual(anonymous.get(file_url.replace('test.mp3', 'other.mp3')).status_code, status.HTTP_403_FORBIDDEN)
+            with override_settings(SIGNED_MEDIA_URL_TTL=-600, SIGNED_MEDIA_URL_BUCKET=1):
+                from songs.signing import sign_media_path
+                expired_url = sign_media_path('songs/test.mp3')
+            self.assertEqual(anonymous.get(expired_url).status_code, status.HTTP_403_FORBIDDEN)
+            
+            # Names containing %xx are decoded once, like any other
+            with open(os.path.join(self.temp_dir.name, 'songs', '100%25 Hits.mp3'), 'wb') as f:
+                f.write(b'hits')
+            response = anonymous.get(sign_media_path('songs/100%25 Hits.mp3'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), b'hits')
+
+    def test_storage_tiers(self):
+        """Test rarely read files move to the cold tier, stream from it and come back when popular"""
+        from songs import storage
+        from songs.models import StoredBlob
+        from songs.signing import sign_media_path
+        
+        cold_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cold_dir.cleanup)
+        with override_settings(MEDIA_ROOT=self.temp_dir.name, MEDIA_TIERING_ENABLED=True, MEDIA_HOT_MAX_BYTES=5,
+                               MEDIA_COLD_STORAGE={'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                                                   'OPTIONS': {'location': cold_dir.name}},
+                               MEDIA_PROMOTE_MIN_READS=2, MEDIA_HOT_FILL_TO=1):
+            local_path = os.path.join(self.temp_dir.name, 'songs', 'test.mp3')
+            os.makedirs(os.path.dirname(local_path))
+            os.replace(self.temp_file, local_path)
+            
+            # Over the local budget: the file is demoted but stays readable
+            self.assertEqual(storage.rebalance()['demoted'], 1)
+            self.assertFalse(os.path.exists(local_path))
+            self.assertEqual(StoredBlob.objects.get().tier, StoredBlob.COLD)
+            with self.song.file.open('rb') as f:
+                self.assertEqual(f.read(), b'test content')
+            response = APIClient().get(sign_media_path('songs/test.mp3'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Content-Length'], '12')
+            self.assertEqual(b''.join(response.streaming_content), b'test content')
+            
+            # Read often enough and with room again, it comes back to local disk
+            with override_settings(MEDIA_HOT_MAX_BYTES=1024):
+                self.assertEqual(storage.rebalance()['promoted'], 1)
+            with open(local_path, 'rb') as f:
+                self.assertEqual(f.read(), b'test content')
+            self.assertEqual(StoredBlob.objects.get().tier, StoredBlob.HOT)
+
+    def test_storage_tiers_hard_links(self):
+        """Test a song and its hard-linked cache entry are counted, uploaded and moved as one file"""
+        from songs import storage
+        from songs.models import StoredBlob
+        
+        cold_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cold_dir.cleanup)
+        with override_settings(MEDIA_ROOT=self.temp_dir.name, MEDIA_TIERING_ENABLED=True, MEDIA_HOT_MAX_BYTES=20,
+                               MEDIA_COLD_STORAGE={'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                                                   'OPTIONS': {'location': cold_dir.name}},
+                               MEDIA_PROMOTE_MIN_READS=2, MEDIA_HOT_FILL_TO=1):
+            local_path = os.path.join(self.temp_dir.name, 'songs', 'test.mp3')
+            cache_path = os.path.join(self.temp_dir.name, 'cache', 'test.mp3')
+            os.makedirs(os.path.dirname(local_path))
+            os.makedirs(os.path.dirname(cache_path))
+            os.replace(self.temp_file, local_path)
+            os.link(local_path, cache_path)
+            SongCache.objects.create(song_url='https://www.youtube.com/watch?v=test123', file_path='cache/test.mp3',
+                                     expires_at=timezone.now() + timedelta(days=1))
+            
+            # 12 bytes under two names fit a 20 byte budget
+            stats = storage.rebalance()
+            self.assertEqual((stats['registered'], stats['demoted'], stats['hot_bytes']), (2, 0, 12))
+            self.assertEqual(StoredBlob.objects.values('cold_name').distinct().count(), 1)
+            
+            # Demoting either name uploads once and frees both
+            with override_settings(MEDIA_HOT_MAX_BYTES=5):
+                stats = storage.rebalance()
+            self.assertEqual((stats['demoted'], stats['hot_bytes']), (1, 0))
+            self.assertFalse(os.path.exists(local_path) or os.path.exists(cache_path))
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(cold_dir.name)), 1)
+            with storage.tiered_storage().open('cache/test.mp3') as f:
+                self.assertEqual(f.read(), b'test content')
+            with self.song.file.open('rb') as f:
+                self.assertEqual(f.read(), b'test content')
+            
+            # Reads under both names add up; promotion restores both as one file
+            with override_settings(MEDIA_HOT_MAX_BYTES=1024):
+                self.assertEqual(storage.rebalance()['promoted'], 1)
+            self.assertTrue(os.path.samefile(local_path, cache_path))
+            self.assertEqual(set(StoredBlob.objects.values_list('tier', flat=True)), {StoredBlob.HOT})
+
+    def test_download_demoted_song(self):
+        """Test a song demoted to the cold tier is still served by download_file and playlist ZIPs"""
+        from songs import storage
+        from songs.models import StoredBlob
+        
+        cold_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cold_dir.cleanup)
+        with override_settings(MEDIA_ROOT=self.temp_dir.name, MEDIA_TIERING_ENABLED=True,
+                               MEDIA_COLD_STORAGE={'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                                                   'OPTIONS': {'location': cold_dir.name}}):
+            local_path = os.path.join(self.temp_dir.name, 'songs', 'test.mp3')
+            os.makedirs(os.path.dirname(local_path))
+            os.replace(self.temp_file, local_path)
+            storage._register_blobs()
+            storage.demote(StoredBlob.objects.get(path='songs/test.mp3'))
+            self.assertFalse(os.path.exists(local_path))
+            
+            response = self.client.get(reverse('song-download-file', kwargs={'pk': self.song.id}))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), b'test content')
+            self.assertEqual(response['x-song-title'], 'Test Song')
+            
+            # Playlist ZIPs stream it from the cold tier instead of copying it back
+            import io
+            import zipfile
+            playlist = Playlist.objects.create(user=self.user, name='Road Trip')
+            playlist.songs.add(self.song)
+            with patch('songs.views.schedule_playlist_archive'):
+                response = self.client.get(reverse('playlist-download-all', kwargs={'pk': playlist.id}))
+            content = b''.join(response.streaming_content)
+            self.assertEqual(int(response['Content-Length']), len(content))
+            self.assertEqual(zipfile.ZipFile(io.BytesIO(content)).read('Test Song - Test Artist.mp3'), b'test content')
+            self.assertFalse(os.path.exists(local_path))
+            
+            # Gone from both tiers it's a 404, not a server error
+            storage.cold_storage().delete('songs/test.mp3')
+            response = self.client.get(reverse('song-download-file', kwargs={'pk': self.song.id}))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_playlist_zip_stream(self):
+        """Test playlist ZIPs are streamed with an exact Content-Length"""
+        import io
+        import zipfile
+        
+        playlist = Playlist.objects.create(user=self.user, name='Road Trip')
+        playlist.songs.add(self.song)
+        with override_settings(MEDIA_ROOT=self.temp_dir.name):
+            os.makedirs(os.path.join(self.temp_dir.name, 'songs'))
+            os.replace(self.temp_file, os.path.join(self.temp_dir.name, 'songs', 'test.mp3'))
+            
+            response = self.client.get(reverse('playlist-download-all', kwargs={'pk': playlist.id}))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content)
+            self.assertEqual(int(response['Content-Length']), len(content))
+            
+            archive = zipfile.ZipFile(io.BytesIO(content))
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('Test Song - Test Artist.mp3'), b'test content')
+            self.assertEqual(archive.infolist()[0].compress_type, zipfile.ZIP_STORED)
+
+    @patch('songs.views.schedule_playlist_archive')
+    def test_prebuilt_playlist_archive(self, mock_schedule):
+        """Test playlist ZIPs are prebuilt on change, served with their key as ETag and extended in place"""
+        from songs import zipstream
+        from songs.models import PlaylistArchive
+        from songs.tasks import build_playlist_archive
+        
+        playlist = Playlist.objects.create(user=self.user, name='Road Trip')
+        with override_settings(MEDIA_ROOT=self.temp_dir.name):
+            os.makedirs(os.path.join(self.temp_dir.name, 'songs'))
+            os.replace(self.temp_file, os.path.join(self.temp_dir.name, 'songs', 'test.mp3'))
+            
+            response = self.client.post(reverse('playlist-add-song', kwargs={'pk': playlist.id}), {'song_id': self.song.id})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            mock_schedule.assert_called_once_with(playlist.id)
+            first_key = build_playlist_archive(playlist.id)
+            
+            url = reverse('playlist-download-all', kwargs={'pk': playlist.id})
+            response = self.client.get(url)
+            self.assertEqual(response['ETag'], f'"{first_key}"')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, status.HTTP_304_NOT_MODIFIED)
+            
+            # A song added later is appended to the existing archive
+            with open(os.path.join(self.temp_dir.name, 'songs', 'second.mp3'), 'wb') as f:
+                f.write(b'second song')
+            second = Song.objects.create(user=self.user, title='Second', artist='Test Artist', file='songs/second.mp3',
+                                         source='youtube', song_url='https://youtube.com/watch?v=second')
+            playlist.songs.add(second)
+            with patch('songs.zipstream.write_archive', wraps=zipstream.write_archive) as mock_write:
+                second_key = build_playlist_archive(playlist.id)
+            self.assertEqual(len(mock_write.call_args.args[1]), 1)
+            self.assertTrue(mock_write.call_args.kwargs['base_path'].endswith(f'{first_key}.zip'))
+            
+            archive = PlaylistArchive.objects.get()
+            self.assertEqual(archive.key, second_key)
+            with open(archive.full_path, 'rb') as f:
+                self.assertEqual(f.read(), b''.join(zipstream.ZipStream(PlaylistArchive.collect_files([self.song, second])[0])))
+            self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name, 'archives', str(playlist.id), f'{first_key}.zip')))
+
+    def test_media_index_resolution(self):
+        """Test playlist downloads find moved files through the reconciled media index"""
+        from songs.tasks import reconcile_media_index
+        
+        playlist = Playlist.objects.create(user=self.user, name='Road Trip')
+        playlist.songs.add(self.song)
+        with override_settings(MEDIA_ROOT=self.temp_dir.name):
+            # The stored path is stale; the file lives under an older download name
+            os.makedirs(os.path.join(self.temp_dir.name, 'cache'))
+            os.replace(self.temp_file, os.path.join(self.temp_dir.name, 'cache', 'Test Song - Test Artist Official Music Video.mp3'))
+            url = reverse('playlist-download-all', kwargs={'pk': playlist.id})
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+            
+            stats = reconcile_media_index()
+            self.assertEqual(stats['repaired'], 1)
+            self.assertEqual(MediaFileIndex.objects.get().file_path, os.path.join('cache', 'Test Song - Test Artist Official Music Video.mp3'))
+            
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(int(response['Content-Length']), len(b''.join(response.streaming_content)))
+            
+            # Entries whose file disappears are pruned
+            os.remove(os.path.join(self.temp_dir.name, 'cache', 'Test Song - Test Artist Official Music Video.mp3'))
+            self.assertEqual(reconcile_media_index()['pruned'], 1)
+            self.assertFalse(MediaFileIndex.objects.exists())
+
+    def test_offloaded_file_delivery(self):
+        """Test the nginx backend hands the file to the front-end server"""
+        with override_settings(MEDIA_ROOT=self.temp_dir.name, MEDIA_DELIVERY_BACKEND='nginx',
+                               MEDIA_ACCEL_REDIRECT_LOCATION='/protected-media/'):
+            os.makedirs(os.path.join(self.temp_dir.name, 'songs'))
+            os.replace(self.temp_file, os.path.join(self.temp_dir.name, 'songs', 'test.mp3'))
+            
+            response = self.client.get(reverse('song-download-file', kwargs={'pk': self.song.id}), HTTP_RANGE='bytes=0-3')
+            
+            # nginx applies the range itself; Django sends headers only
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['X-Accel-Redirect'], '/protected-media/songs/test.mp3')
+            self.assertEqual(response.content, b'')
+            self.assertIn('attachment', response['Content-Disposition'])
+            self.assertIn('ETag', response)
+
+    @patch('songs.ffmpeg.stream')
+    def test_streaming_transcode(self, mock_stream):
+        """Test uncached transcodes stream to the client and land in the transcode cache"""
+        class FakeStream:
+            closed = False
+            def __iter__(self):
+                yield b'aac '
+                yield b'audio'
+            def close(self):
+                self.closed = True
+        mock_stream.side_effect = lambda command: FakeStream()
+        
+        with override_settings(MEDIA_ROOT=self.temp_dir.name, TRANSCODE_STREAMING=True):
+            os.makedirs(os.path.join(self.temp_dir.name, 'songs'))
+            os.replace(self.temp_file, os.path.join(self.temp_dir.name, 'songs', 'test.mp3'))
+            url = reverse('song-download-file', kwargs={'pk': self.song.id})
+            
+            # First request streams ffmpeg output with the right container
+            response = self.client.get(url, {'audio_format': 'aac'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.streaming)
+            self.assertEqual(b''.join(response.streaming_content), b'aac audio')
+            command = mock_stream.call_args[0][0]
+            self.assertEqual(command[command.index('-f') + 1], 'adts')
+            self.assertEqual(command[-1], 'pipe:1')
+            
+            # The streamed bytes were cached, so the next request is a plain file
+            variant = TranscodedVariant.objects.get(format='aac')
+            self.assertEqual(variant.file_size, len(b'aac audio'))
+            response = self.client.get(url, {'audio_format': 'aac'})
+            self.assertEqual(b''.join(response.streaming_content), b'aac audio')
+            self.assertEqual(mock_stream.call_count, 1)
+
+    @patch('songs.ffmpeg.stream')
+    def test_unstarted_transcode_stream_closes(self, mock_stream):
+        """Test closing a streamed transcode before its first chunk still stops ffmpeg and cleans up"""
+        from songs.utils import stream_transcoded_file
+        
+        output = MagicMock()
+        mock_stream.return_value = output
+        with override_settings(MEDIA_ROOT=self.temp_dir.name):
+            chunks = stream_transcoded_file(self.temp_file, 'aac')
+            staging_root = os.path.join(self.temp_dir.name, settings.MEDIA_STAGING_DIR)
+            self.assertEqual(len(os.listdir(staging_root)), 1)
+            
+            chunks.close()
+            output.close.assert_called_once()
+            self.assertEqual(os.listdir(staging_root), [])
+            self.assertFalse(TranscodedVariant.objects.exists())
+
+    @patch('requests.get')
+    def test_cover_art_store(self, mock_get):
+        """Test artwork is fetched and resized once, then shared by every song that uses it"""
+        from io import BytesIO
+        from PIL import Image
+        from mutagen.id3 import ID3
+        from songs.utils import embed_metadata
+
+        art = BytesIO()
+        Image.new('RGB', (1000, 800), 'red').save(art, format='PNG')
+        mock_get.return_value = MagicMock(status_code=200, content=art.getvalue())
+        thumbnail_url = 'https://i.scdn.co/image/shared'
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            for name in ('one', 'two'):
+                mp3_path = os.path.join(media_root, f'{name}.mp3')
+                with open(mp3_path, 'wb') as f:
+                    f.write(b'\0' * 256)
+                self.assertTrue(embed_metadata(mp3_path, name, 'Band', thumbnail_url=thumbnail_url))
+                cover = Image.open(BytesIO(ID3(mp3_path)['APIC:Cover'].data))
+                self.assertEqual((cover.format, cover.size), ('JPEG', (500, 400)))
+            self.assertEqual(mock_get.call_count, 1)
+
+            # The UI gets the small variant from the same store
+            self.song.thumbnail_url = thumbnail_url
+            self.song.save()
+            response = self.client.get(reverse('song-cover', kwargs={'pk': self.song.pk}), {'size': 'small'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Image.open(BytesIO(b''.join(response.streaming_content))).size, (64, 51))
+            self.assertEqual(mock_get.call_count, 1)
+
 class UtilityTests(TestCase):
     """Test utility functions"""
     
@@ -308,6 +1093,180 @@ class UtilityTests(TestCase):
         # Should have succeeded on the last attempt
         self.assertEqual(result['title'], 'Success')
         
+    @override_settings(UPSTREAM_RATE_LIMITS={'test-upstream': (2, 60)})
+    def test_upstream_rate_limit(self):
+        """Test the shared per-host rate limit used by playlist track tasks"""
+        from django.core.cache import cache
+        from songs.utils import upstream_rate_limit_wait
+
+        cache.clear()
+
+        # The first two calls in the window go through
+        self.assertEqual(upstream_rate_limit_wait('test-upstream'), 0)
+        self.assertEqual(upstream_rate_limit_wait('test-upstream'), 0)
+
+        # The third has to wait for the next window
+        wait = upstream_rate_limit_wait('test-upstream')
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 61)
+
+        # Hosts without a configured limit are never throttled
+        self.assertEqual(upstream_rate_limit_wait('unlimited-upstream'), 0)
+
+    @override_settings(PIPELINE_USE_PROCESSES=False)
+    def test_download_pipeline(self):
+        """Test items flow through fetch, process and batched persist stages"""
+        from songs.pipeline import DownloadPipeline
+
+        def fetch(n):
+            if n == 3:
+                return None  # Dropped by the fetch stage
+            return {'n': n, 'label': f"Track {n}", 'skip_process': n == 4}
+
+        batches = []
+        finished = []
+        pipeline = DownloadPipeline(
+            fetch=fetch,
+            process=lambda payload: dict(payload, processed=True),
+            persist=lambda batch: batches.append(batch) or [p['n'] for p in batch],
+            on_progress=lambda label, succeeded: finished.append(succeeded),
+            fetch_workers=2, process_workers=2, batch_size=2, batch_timeout=0.1
+        )
+        results = pipeline.run(range(6))
+
+        self.assertEqual(sorted(results), [0, 1, 2, 4, 5])
+        self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        # Cache-hit style payloads skip the process stage
+        persisted = {p['n']: p for batch in batches for p in batch}
+        self.assertNotIn('processed', persisted[4])
+        self.assertTrue(persisted[0]['processed'])
+        # Every item is reported once, including the dropped one
+        self.assertEqual(len(finished), 6)
+        self.assertEqual(finished.count(False), 1)
+
+        stats = pipeline.stats()
+        self.assertEqual(stats['fetch']['failed'], 1)
+        self.assertEqual(stats['process']['processed'], 4)
+        self.assertIn('max_queue_depth', stats['persist'])
+
+    def test_staged_publish(self):
+        """Test staged files are renamed into media and hard-linked into the cache"""
+        from songs.utils import make_staging_dir, publish_file, link_or_copy, clean_staging
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            staging_dir = make_staging_dir()
+            self.assertTrue(staging_dir.startswith(os.path.join(media_root, settings.MEDIA_STAGING_DIR)))
+
+            staged = os.path.join(staging_dir, 'track.mp3')
+            with open(staged, 'wb') as f:
+                f.write(b'new audio')
+            song_path = os.path.join(media_root, 'songs', 'track.mp3')
+            os.makedirs(os.path.dirname(song_path))
+            with open(song_path, 'wb') as f:
+                f.write(b'old audio')
+
+            publish_file(staged, song_path)
+            self.assertFalse(os.path.exists(staged))
+            with open(song_path, 'rb') as f:
+                self.assertEqual(f.read(), b'new audio')
+
+            cache_path = os.path.join(media_root, 'cache', 'track.mp3')
+            link_or_copy(song_path, cache_path)
+            self.assertEqual(os.stat(cache_path).st_ino, os.stat(song_path).st_ino)
+
+            # Only stale staging directories are swept
+            self.assertEqual(clean_staging(), 0)
+            self.assertEqual(clean_staging(max_age_hours=-1), 1)
+
+    @patch('subprocess.run')
+    def test_transcode_cache(self, mock_run):
+        """Test each format variant is transcoded once and evicted by size"""
+        from songs.utils import get_transcoded_file
+
+        def fake_ffmpeg(command, **kwargs):
+            with open(command[-1], 'wb') as f:
+                f.write(b'x' * 100)
+        mock_run.side_effect = fake_ffmpeg
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            sources = []
+            for name in ('one', 'two'):
+                path = os.path.join(media_root, f'{name}.mp3')
+                with open(path, 'wb') as f:
+                    f.write(name.encode())
+                sources.append(path)
+
+            first = get_transcoded_file(sources[0], 'aac')
+            self.assertEqual(get_transcoded_file(sources[0], 'aac'), first)
+            self.assertEqual(mock_run.call_count, 1)
+            self.assertTrue(first.startswith(os.path.join(media_root, settings.TRANSCODE_CACHE_DIR)))
+            self.assertEqual(TranscodedVariant.objects.get().hit_count, 1)
+
+            # A second variant pushes the cache over budget; the least recently used goes
+            with override_settings(TRANSCODE_CACHE_MAX_BYTES=150):
+                get_transcoded_file(sources[1], 'aac')
+            self.assertEqual(TranscodedVariant.objects.count(), 1)
+            self.assertFalse(os.path.exists(first))
+
+    @patch('songs.ffmpeg.run')
+    def test_cover_art_render(self, mock_run):
+        """Test cover variants are made in memory from one decode, with ffmpeg only for undecodable images"""
+        from io import BytesIO
+        from PIL import Image
+        from songs import cover_art
+
+        source = BytesIO()
+        Image.new('RGB', (2000, 1000), 'blue').save(source, format='JPEG')
+        variants = cover_art.render(source.getvalue())
+        self.assertEqual({name: Image.open(BytesIO(data)).size for name, data in variants.items()},
+                         {'large': (500, 250), 'small': (64, 32)})
+        mock_run.assert_not_called()
+
+        # Pillow can't read it: ffmpeg converts it through pipes, once
+        mock_run.return_value = MagicMock(returncode=0, stdout=source.getvalue())
+        variants = cover_art.render(b'not an image' * 100)
+        self.assertEqual(set(variants), {'large', 'small'})
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(mock_run.call_args.kwargs['input'], b'not an image' * 100)
+
+    def test_ffmpeg_slots(self):
+        """Test the ffmpeg executor caps concurrent jobs and streams output"""
+        import sys
+        import time
+        import shutil
+        import subprocess
+        from songs import ffmpeg
+
+        with tempfile.TemporaryDirectory() as slot_dir, \
+                override_settings(FFMPEG_SLOT_DIR=slot_dir, FFMPEG_MAX_CONCURRENCY=1):
+            with ffmpeg.slot():
+                self.assertEqual(ffmpeg.queue_stats()['running'], 1)
+                with self.assertRaises(ffmpeg.FFmpegBusy):
+                    with ffmpeg.slot(queue_timeout=0.1):
+                        pass
+            self.assertEqual(ffmpeg.queue_stats()['running'], 0)
+
+            # Streamed output arrives in chunks and the slot is released afterwards
+            output = ffmpeg.stream([sys.executable, '-c', 'print("x" * 10, end="")'], chunk_size=4)
+            self.assertEqual(b''.join(output), b'x' * 10)
+            self.assertEqual(output.returncode, 0)
+            self.assertEqual(ffmpeg.queue_stats()['running'], 0)
+
+            # A child that stalls without output is killed by the watchdog
+            stalled = ffmpeg.stream([sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.5)
+            started = time.monotonic()
+            with self.assertRaises(subprocess.TimeoutExpired):
+                b''.join(stalled)
+            self.assertLess(time.monotonic() - started, 10)
+            self.assertEqual(ffmpeg.queue_stats()['running'], 0)
+
+        # Priority and CPU limits come from wrapper commands, not a preexec_fn
+        with override_settings(FFMPEG_NICE=7):
+            command = ffmpeg.limited_command(['ffmpeg', '-version'])
+        self.assertEqual(command[-2:], ['ffmpeg', '-version'])
+        if shutil.which('nice'):
+            self.assertIn('7', command)
+
     @patch('songs.utils.subprocess.run')
     def test_format_conversion(self, mock_run):
         """Test audio format conversion"""
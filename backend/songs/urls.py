@@ -20,6 +20,8 @@ urlpatterns = [
     path('user/favorite-genres/', views.FavoriteGenresDistributionView.as_view(), name='favorite-genres'),
     path('user/top-countries/', views.TopCountriesView.as_view(), name='top-countries'),
     path('record-play/', views.RecordPlayView.as_view(), name='record-play'),
+    path('ffmpeg/stats/', views.FFmpegQueueView.as_view(), name='ffmpeg-stats'),
+    path('cache/stats/', views.SongCacheStatsView.as_view(), name='song-cache-stats'),
     # Add explicit download_all URL pattern
     path('playlists/<int:pk>/download-all/', views.PlaylistViewSet.as_view({'get': 'download_all'}), name='playlist-download-all'),
     # Public download endpoint for unauthorized users
@@ -6,7 +6,8 @@ from io import BytesIO
 from django.conf import settings
 from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TCON, TRCK, TDRC
 import time
-from functools import wraps
+from contextlib import contextmanager
+from functools import wraps, lru_cache
 from retrying import retry
 import sentry_sdk
 import yt_dlp
@@ -53,6 +54,94 @@ def sanitize_filename(filename, max_length=95):
         
     return filename.strip()
 
+# Staging area for downloads
+def make_staging_dir():
+    """
+    Create a private working directory under MEDIA_ROOT's staging area.
+    Staging lives on the same filesystem as media, so finished files are moved
+    into place with a rename instead of a copy.
+    """
+    staging_root = os.path.join(settings.MEDIA_ROOT, settings.MEDIA_STAGING_DIR)
+    os.makedirs(staging_root, exist_ok=True)
+    return tempfile.mkdtemp(dir=staging_root)
+
+def publish_file(src, dest):
+    """
+    Atomically move a finished file to dest, replacing anything already there.
+    Readers see either the old file or the complete new one, never a partial write.
+    Falls back to copying beside dest and renaming if src is on another filesystem.
+    """
+    import errno
+    import shutil
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.replace(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        fd, part_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.part-')
+        os.close(fd)
+        try:
+            shutil.copy2(src, part_path)
+            os.replace(part_path, dest)
+        except Exception:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        os.remove(src)
+    return dest
+
+def link_or_copy(src, dest):
+    """
+    Make dest another name for src's file (a hard link, so no bytes are written).
+    Falls back to an atomic copy where links aren't possible. Leaves an existing
+    dest alone.
+    """
+    import shutil
+
+    if os.path.exists(dest):
+        return dest
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    part_path = os.path.join(os.path.dirname(dest), f".part-{os.getpid()}-{time.time_ns()}")
+    try:
+        os.link(src, part_path)
+    except OSError:
+        shutil.copy2(src, part_path)
+    try:
+        os.replace(part_path, dest)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return dest
+
+def clean_staging(max_age_hours=None):
+    """Remove staging directories left behind by crashed or killed downloads"""
+    import shutil
+
+    if max_age_hours is None:
+        max_age_hours = settings.MEDIA_STAGING_MAX_AGE_HOURS
+    staging_root = os.path.join(settings.MEDIA_ROOT, settings.MEDIA_STAGING_DIR)
+    if not os.path.isdir(staging_root):
+        return 0
+
+    cutoff = time.time() - max_age_hours * 3600
+    removed = 0
+    with os.scandir(staging_root) as entries:
+        for entry in entries:
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.remove(entry.path)
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"Could not remove stale staging entry {entry.path}: {e}")
+    return removed
+
 # External API error handling
 class ExternalAPIError(Exception):
     """Base exception for external API errors"""
@@ -73,6 +162,16 @@ class SpotifyAPIError(ExternalAPIError):
     def __init__(self, message, status_code=None, original_error=None):
         super().__init__(message, service="Spotify", status_code=status_code, original_error=original_error)
 
+class SourceUnavailableError(ExternalAPIError):
+    """
+    Raised without calling upstream for a source that failed recently in a way
+    retrying won't fix (see remember_source_failure)
+    """
+    def __init__(self, message, error_class, retry_after):
+        super().__init__(message, service="NegativeCache")
+        self.error_class = error_class
+        self.retry_after = retry_after
+
 # Retry decorator for external API calls
 def retry_external_api(
     retry_on_exceptions=(Exception,),
@@ -101,6 +200,10 @@ def retry_external_api(
                 try:
                     return func(*args, **kwargs)
                 except retry_on_exceptions as e:
+                    # Private or removed videos stay that way, so don't retry them
+                    if classify_source_error(e) == 'unavailable':
+                        raise
+
                     # Log the error
                     logger.warning(
                         f"Retrying {func.__name__} due to {e.__class__.__name__}: {str(e)}. "
@@ -152,6 +255,166 @@ spotify_api_retry = retry_external_api(
     max_attempts=3
 )
 
+def upstream_rate_limit_wait(host):
+    """
+    Reserve a call against an upstream host's rate limit.
+    Uses a fixed-window counter in the shared cache so every worker counts together.
+
+    Args:
+        host: Key in settings.UPSTREAM_RATE_LIMITS, e.g. 'youtube'
+
+    Returns:
+        0 if the call may go ahead, otherwise seconds until the next window opens
+    """
+    from django.core.cache import cache
+
+    limit = getattr(settings, 'UPSTREAM_RATE_LIMITS', {}).get(host)
+    if not limit:
+        return 0
+
+    max_calls, window = limit
+    now = time.time()
+    window_start = int(now // window) * window
+    key = f"upstream_rate:{host}:{window_start}"
+
+    try:
+        cache.add(key, 0, timeout=window + 1)
+        calls = cache.incr(key)
+    except Exception as e:
+        # Never block downloads because the cache is unavailable
+        logger.warning(f"Upstream rate limit check failed for {host}: {e}")
+        return 0
+
+    if calls <= max_calls:
+        return 0
+    return max(1, int(window_start + window - now) + 1)
+
+def wait_for_upstream(host):
+    """Block until a call against host's rate limit is allowed"""
+    while True:
+        wait = upstream_rate_limit_wait(host)
+        if not wait:
+            return
+        logger.info(f"Upstream rate limit reached for {host}, waiting {wait}s")
+        time.sleep(wait)
+
+# Negative cache: sources that just failed in a way retrying won't fix soon
+SOURCE_FAILURE_KEY = 'source_failure:{}'
+
+# Messages (from yt-dlp or the download API) meaning the video itself can't be had.
+# Kept specific: YouTube words some temporary failures much like these.
+UNAVAILABLE_MARKERS = (
+    'private video', 'video unavailable. this video has been removed',
+    'this video has been removed by the uploader', 'this video is no longer available',
+    'this video is not available in your country', 'join this channel to get access to members-only content',
+    'account associated with this video has been terminated', 'due to a copyright claim',
+    'sign in to confirm your age',
+)
+
+# Messages that look like a source failure but clear up by themselves: YouTube's
+# per-IP throttle ("Video unavailable. This content isn't available, try again
+# later") and failed format extraction
+TRANSIENT_MARKERS = (
+    'try again later', 'requested format is not available', "sign in to confirm you're not a bot",
+)
+
+def classify_source_error(error):
+    """
+    Sort a failed download into a SOURCE_FAILURE_TTLS error class.
+
+    Returns:
+        'unavailable', 'not_found', 'upstream_error', or None for errors that say
+        nothing about the source (network trouble, rate limits, our own bugs)
+    """
+    if isinstance(error, SourceUnavailableError):
+        return None
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError, TimeoutError)):
+        return None
+
+    message = f"{error} {getattr(error, 'original_error', None) or ''}".lower().replace('\u2019', "'")
+    if any(marker in message for marker in TRANSIENT_MARKERS):
+        return None
+    if any(marker in message for marker in UNAVAILABLE_MARKERS):
+        return 'unavailable'
+
+    status_code = getattr(error, 'status_code', None)
+    if isinstance(error, ExternalAPIError) and status_code and status_code != 429:
+        if status_code >= 500:
+            return 'upstream_error'
+        if status_code in (400, 404, 410, 422):
+            # The download API rejected this URL
+            return 'unavailable'
+    if isinstance(error, SpotifyAPIError) and 'failed to get track info' in message:
+        return 'not_found'
+    return None
+
+def check_source(url):
+    """
+    Fail fast for a source in the negative cache, before any upstream call.
+
+    Raises:
+        SourceUnavailableError: With the error class and seconds until it may be retried
+    """
+    from django.core.cache import cache
+
+    key = canonical_key(url)
+    if not key:
+        return
+    try:
+        failure = cache.get(SOURCE_FAILURE_KEY.format(key))
+    except Exception as e:
+        logger.warning(f"Negative cache check failed for {key}: {e}")
+        return
+    if failure:
+        retry_after = max(1, int(failure['expires'] - time.time()))
+        logger.info(f"Negative cache hit for {key} ({failure['error_class']}), retry after {retry_after}s")
+        raise SourceUnavailableError(failure['message'], failure['error_class'], retry_after)
+
+def remember_source_failure(url, error):
+    """
+    Put a source in the negative cache for its error class's TTL, if the error
+    says the source itself is the problem.
+
+    Returns:
+        The error class, or None if nothing was cached
+    """
+    from django.core.cache import cache
+
+    key = canonical_key(url)
+    error_class = classify_source_error(error)
+    ttl = settings.SOURCE_FAILURE_TTLS.get(error_class) if error_class else None
+    if not key or not ttl:
+        return None
+    try:
+        cache.set(SOURCE_FAILURE_KEY.format(key), {
+            'error_class': error_class,
+            'message': str(error)[:500],
+            'expires': time.time() + ttl,
+        }, ttl)
+        logger.info(f"Negative-cached {key} as {error_class} for {ttl}s")
+    except Exception as e:
+        logger.warning(f"Could not negative-cache {key}: {e}")
+    return error_class
+
+@contextmanager
+def source_guard(url):
+    """
+    Wrap the upstream calls for one source: fail fast if it is negative-cached,
+    and negative-cache it if the calls fail because of the source. Such a
+    failure is re-raised as SourceUnavailableError, so callers answer it the
+    same way as the fast failures that follow.
+    """
+    check_source(url)
+    try:
+        yield
+    except SourceUnavailableError:
+        raise
+    except Exception as e:
+        error_class = remember_source_failure(url, e)
+        if error_class:
+            raise SourceUnavailableError(str(e), error_class, settings.SOURCE_FAILURE_TTLS[error_class]) from e
+        raise
+
 # Example usage for handling YouTube API errors
 @youtube_api_retry
 def download_from_youtube(url, output_path, **options):
@@ -198,13 +461,47 @@ def get_format_info(file_path):
         logger.error(f"Error getting format info: {str(e)}", exc_info=True)
         return None
 
-def convert_audio_format(input_path, output_format=None):
+def _ffmpeg_output_args(output_format, bitrate=None):
+    """
+    Encoder and muxer arguments for an ffmpeg output in output_format.
+    The muxer is always given explicitly so the same arguments work for piped output.
+    """
+    if output_format == 'mp3':
+        args = [
+            '-id3v2_version', '3',  # Use ID3v2.3 format for better compatibility
+            '-c:a', 'libmp3lame',
+            '-map', '0',  # Map all streams from input to output
+            '-map_chapters', '0',  # Copy chapters if any
+            '-write_id3v2', '1',  # Force writing ID3v2 tags
+            '-write_xing', '1',  # Write Xing header for mp3
+            '-f', 'mp3',
+        ]
+    elif output_format == 'aac':
+        args = [
+            '-c:a', 'aac',  # Re-encode; copying an mp3 stream into .aac isn't valid AAC
+            '-map', '0:a',  # ADTS carries audio only, so leave out embedded cover art
+            '-f', 'adts',
+        ]
+    else:
+        raise ValueError(f"Unsupported format: {output_format}")
+    if bitrate:
+        args += ['-b:a', bitrate]
+    return args
+
+def convert_audio_format(input_path, output_format=None, bitrate=None, output_path=None):
     """
     Convert audio to specified format using FFmpeg
     Returns the path to the converted file
+
+    Args:
+        input_path: Path to the source audio file
+        output_format: Target format, defaults to DEFAULT_AUDIO_FORMAT
+        bitrate: Optional target bitrate such as '192k' (encoder default otherwise)
+        output_path: Where to write the result, defaults to input_path with the new extension
     """
     import os
     import subprocess
+    from . import ffmpeg
     
     if output_format is None:
         output_format = settings.DEFAULT_AUDIO_FORMAT
@@ -213,31 +510,22 @@ def convert_audio_format(input_path, output_format=None):
         raise ValueError(f"Unsupported format: {output_format}")
         
     # Get the base name without extension
-    base_path = os.path.splitext(input_path)[0]
-    output_path = f"{base_path}.{output_format}"
+    if output_path is None:
+        base_path = os.path.splitext(input_path)[0]
+        output_path = f"{base_path}.{output_format}"
     
     try:
         command = [
             'ffmpeg',
             '-i', input_path,
             '-map_metadata', '0',  # Copy all metadata from input to output
-            '-id3v2_version', '3',  # Use ID3v2.3 format for better compatibility
-            '-c:a', 'libmp3lame' if output_format == 'mp3' else 'copy',  # Use proper codec for the format
-            '-map', '0',  # Map all streams from input to output
-            '-map_chapters', '0',  # Copy chapters if any
-            '-write_id3v2', '1',  # Force writing ID3v2 tags
-            '-write_xing', '1',  # Write Xing header for mp3
+            *_ffmpeg_output_args(output_format, bitrate),
             '-y',  # Overwrite output file if it exists
-            output_path
+            output_path,
         ]
         
-        # Run the conversion
-        subprocess.run(
-            command, 
-            check=True, 
-            stderr=subprocess.PIPE, 
-            stdout=subprocess.PIPE
-        )
+        # Run the conversion once a host-wide ffmpeg slot is free
+        ffmpeg.run(command)
         
         return output_path
     except subprocess.CalledProcessError as e:
@@ -247,6 +535,165 @@ def convert_audio_format(input_path, output_format=None):
         logger.error(f"Error converting audio: {str(e)}", exc_info=True)
         raise
 
+@lru_cache(maxsize=4096)
+def _hash_file(path, size, mtime_ns):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def content_hash(path):
+    """
+    SHA-256 of a file's contents. Memoized on (path, size, mtime), so a file is
+    only read again after it changes.
+    """
+    stat = os.stat(path)
+    return _hash_file(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def get_transcoded_file(source_path, output_format, bitrate=None):
+    """
+    Get source_path converted to output_format, transcoding only the first time.
+    Variants are stored under MEDIA_ROOT/TRANSCODE_CACHE_DIR and tracked by
+    TranscodedVariant, which evicts the least recently used ones by size.
+
+    Args:
+        source_path: Absolute path of the source audio file
+        output_format: Target format, one of SUPPORTED_AUDIO_FORMATS
+        bitrate: Optional target bitrate such as '192k'
+
+    Returns:
+        Absolute path of the variant file
+    """
+    import shutil
+
+    cached_path = get_cached_transcode(source_path, output_format, bitrate)
+    if cached_path:
+        return cached_path
+
+    source_hash = content_hash(source_path)
+    rel_path = _transcode_rel_path(source_hash, output_format, bitrate)
+    staging_dir = make_staging_dir()
+    try:
+        staged_path = convert_audio_format(
+            source_path, output_format, bitrate=bitrate,
+            output_path=os.path.join(staging_dir, os.path.basename(rel_path))
+        )
+        dest = publish_file(staged_path, os.path.join(settings.MEDIA_ROOT, rel_path))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    _record_transcode(source_hash, output_format, bitrate, rel_path)
+    return dest
+
+def stream_transcoded_file(source_path, output_format, bitrate=None):
+    """
+    Transcode source_path and yield the output in chunks as ffmpeg produces it,
+    writing the same bytes to staging. If the whole output is sent, the copy is
+    published to the transcode cache so the next request is served from disk.
+    A client that disconnects early leaves nothing behind.
+
+    ffmpeg is started (and an executor slot taken) before returning, so
+    FFmpegBusy is raised here rather than in the middle of a response.
+
+    Returns:
+        Iterable of bytes chunks; close it (as the response does) to stop ffmpeg
+    """
+    from . import ffmpeg
+
+    source_hash = content_hash(source_path)
+    command = [
+        'ffmpeg',
+        '-i', source_path,
+        '-map_metadata', '0',
+        *_ffmpeg_output_args(output_format, bitrate),
+        'pipe:1',
+    ]
+    output = ffmpeg.stream(command)
+    return _TranscodeTee(output, source_hash, output_format, bitrate)
+
+class _TranscodeTee:
+    """
+    Iterable over ffmpeg output that writes each chunk to staging as it is sent
+    and publishes the copy to the transcode cache once all of it was sent.
+    close() always stops ffmpeg and removes the staging dir, even if iteration
+    never started (a generator's finally wouldn't run in that case).
+    """
+
+    def __init__(self, output, source_hash, output_format, bitrate):
+        self.output = output
+        self.source_hash = source_hash
+        self.output_format = output_format
+        self.bitrate = bitrate
+        self.rel_path = _transcode_rel_path(source_hash, output_format, bitrate)
+        self.staged_file = None
+        self.closed = False
+        try:
+            self.staging_dir = make_staging_dir()
+        except Exception:
+            output.close()
+            raise
+        self.staged_path = os.path.join(self.staging_dir, os.path.basename(self.rel_path))
+
+    def __iter__(self):
+        self.staged_file = open(self.staged_path, 'wb')
+        for chunk in self.output:
+            if self.staged_file:
+                try:
+                    self.staged_file.write(chunk)
+                except OSError as e:
+                    # Keep streaming to the client; this output just won't be cached
+                    logger.warning(f"Stopped caching streamed transcode {self.rel_path}: {e}")
+                    self.staged_file.close()
+                    self.staged_file = None
+            yield chunk
+
+        if self.staged_file:
+            self.staged_file.close()
+            self.staged_file = None
+            try:
+                publish_file(self.staged_path, os.path.join(settings.MEDIA_ROOT, self.rel_path))
+                _record_transcode(self.source_hash, self.output_format, self.bitrate, self.rel_path)
+            except Exception as e:
+                logger.warning(f"Error caching streamed transcode {self.rel_path}: {e}")
+
+    def close(self):
+        import shutil
+
+        if self.closed:
+            return
+        self.closed = True
+        self.output.close()
+        if self.staged_file:
+            self.staged_file.close()
+            self.staged_file = None
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+def get_cached_transcode(source_path, output_format, bitrate=None):
+    """Absolute path of an already transcoded variant of source_path, or None"""
+    from .models import TranscodedVariant
+
+    variant = TranscodedVariant.lookup(content_hash(source_path), output_format, bitrate)
+    if variant:
+        logger.info(f"Serving cached {output_format} variant of {source_path}")
+        return variant.full_path
+    return None
+
+def _transcode_rel_path(source_hash, output_format, bitrate=None):
+    suffix = f"-{bitrate}" if bitrate else ''
+    return os.path.join(settings.TRANSCODE_CACHE_DIR, source_hash[:2], f"{source_hash}{suffix}.{output_format}")
+
+def _record_transcode(source_hash, output_format, bitrate, rel_path):
+    from .models import TranscodedVariant
+
+    try:
+        TranscodedVariant.record(source_hash, output_format, bitrate, rel_path)
+    except Exception as e:
+        # The file is still good for this request; it just won't be reused
+        logger.warning(f"Error recording transcoded variant {rel_path}: {e}")
+
 def embed_metadata(mp3_path, title, artist, album='Unknown', genre='Unknown', thumbnail_url=None, year=None, composer=None, album_artist=None, spotify_id=None, youtube_id=None):
     """
     Embeds metadata into an MP3 file using ID3 tags.
@@ -271,12 +718,8 @@ def embed_metadata(mp3_path, title, artist, album='Unknown', genre='Unknown', th
     import os
     import tempfile
     import shutil
-    from subprocess import call
+    from . import ffmpeg
     from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TCON, TRCK, TDRC, TCOM, TPE2, TYER
-    from PIL import Image
-    from io import BytesIO
-    import imghdr
-    import requests
     
     try:
         # Ensure the file actually exists
@@ -295,9 +738,9 @@ def embed_metadata(mp3_path, title, artist, album='Unknown', genre='Unknown', th
                 silent_mp3 = os.path.join(temp_dir, "silent.mp3")
                 
                 # Generate 1 second of silence
-                call(['ffmpeg', '-f', 'lavfi', '-i', 'anullsrc=r=44100:cl=mono', 
-                      '-t', '1', '-q:a', '9', '-acodec', 'libmp3lame', silent_mp3], 
-                     stdout=tempfile.devnull, stderr=tempfile.devnull)
+                ffmpeg.run(['ffmpeg', '-f', 'lavfi', '-i', 'anullsrc=r=44100:cl=mono', 
+                            '-t', '1', '-q:a', '9', '-acodec', 'libmp3lame', silent_mp3], 
+                           check=False)
                 
                 # Copy the silent MP3 to the destination
                 shutil.copy2(silent_mp3, mp3_path)
@@ -354,7 +797,7 @@ def embed_metadata(mp3_path, title, artist, album='Unknown', genre='Unknown', th
         # Prepare image data
         image_data = None
         
-        # Add album art if thumbnail URL is provided
+        # Look up a better thumbnail URL for the track if one is provided
         if thumbnail_url:
             # First check database for the song if possible
             from django.apps import apps
@@ -429,273 +872,29 @@ def embed_metadata(mp3_path, title, artist, album='Unknown', genre='Unknown', th
                 except Exception as e:
                     logger.warning(f"Error checking Music.csv file: {e}")
                     
-            # Download the thumbnail data
-            if thumbnail_url:
-                if thumbnail_url.startswith('/media/'):
-                    # Local file
-                    thumbnail_path = os.path.join(settings.MEDIA_ROOT, thumbnail_url.replace('/media/', ''))
-                    logger.info(f"Looking for local thumbnail: {thumbnail_path}")
-                    if os.path.exists(thumbnail_path):
-                        with open(thumbnail_path, 'rb') as f:
-                            image_data = f.read()
-                        logger.info(f"Found local thumbnail: {thumbnail_path}")
-                    else:
-                        logger.warning(f"Thumbnail file not found: {thumbnail_path}")
-                else:
-                    # Remote URL
-                    try:
-                        logger.info(f"Downloading thumbnail from URL: {thumbnail_url}")
-                        headers = {
-                            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
-                        }
-                        
-                        # Check if URL is a webp image and try to convert it directly from the source
-                        if 'webp' in thumbnail_url.lower():
-                            logger.info("Detected webp image in URL, will handle special conversion")
-                            
-                            # Download the webp image
-                            response = requests.get(thumbnail_url, timeout=10, headers=headers)
-                            response.raise_for_status()
-                            webp_data = response.content
-                            
-                            # Create a temporary directory for conversion
-                            temp_dir = tempfile.mkdtemp()
-                            webp_path = os.path.join(temp_dir, "image.webp")
-                            jpg_path = os.path.join(temp_dir, "image.jpg")
-                            
-                            # Save the webp image to disk
-                            with open(webp_path, 'wb') as f:
-                                f.write(webp_data)
-                            
-                            # Try conversion with pillow first
-                            try:
-                                img = Image.open(BytesIO(webp_data))
-                                if img.mode != 'RGB':
-                                    img = img.convert('RGB')
-                                img.save(jpg_path, 'JPEG', quality=90)
-                                
-                                # Read the converted JPEG
-                                with open(jpg_path, 'rb') as f:
-                                    image_data = f.read()
-                                    
-                                logger.info(f"Successfully converted webp to JPEG with Pillow: {len(image_data)} bytes")
-                            except Exception as pillow_error:
-                                logger.warning(f"Pillow webp conversion failed: {pillow_error}")
-                                
-                                # Try ffmpeg as fallback
-                                try:
-                                    call(['ffmpeg', '-i', webp_path, '-qscale:v', '2', jpg_path], 
-                                         stdout=tempfile.devnull, stderr=tempfile.devnull)
-                                    
-                                    if os.path.exists(jpg_path):
-                                        with open(jpg_path, 'rb') as f:
-                                            image_data = f.read()
-                                        logger.info(f"Successfully converted webp to JPEG with ffmpeg: {len(image_data)} bytes")
-                                    else:
-                                        logger.warning("FFmpeg webp conversion failed")
-                                        # Fall back to original webp data
-                                        image_data = webp_data
-                                except Exception as ffmpeg_error:
-                                    logger.warning(f"FFmpeg webp conversion failed: {ffmpeg_error}")
-                                    # Fall back to original webp data
-                                    image_data = webp_data
-                            
-                            # Clean up temporary files
-                            shutil.rmtree(temp_dir, ignore_errors=True)
-                        else:
-                            # Regular image download
-                            response = requests.get(thumbnail_url, timeout=10, headers=headers)
-                            response.raise_for_status()
-                            image_data = response.content
-                            
-                        logger.info(f"Downloaded thumbnail: {len(image_data)} bytes")
-                    except requests.exceptions.RequestException as e:
-                        logger.warning(f"Failed to download thumbnail from {thumbnail_url}: {e}")
-        
-        # Add album art if we have image data
-        if image_data:
-            try:
-                # Determine MIME type
-                img_type = imghdr.what(None, h=image_data[:32])
-                logger.info(f"Detected image type: {img_type}")
+        # Artwork comes processed from the shared cover art store, so it is only
+        # downloaded and resized the first time any song uses it
+        if thumbnail_url or youtube_id:
+            from . import cover_art
 
-                # Create a temporary directory for image processing
-                temp_dir = tempfile.mkdtemp()
-                temp_img_path = os.path.join(temp_dir, "temp_img.jpg")
-                
-                # Always convert to JPEG for compatibility
-                try:
-                    # Save the original image data to a temp file
-                    temp_orig = os.path.join(temp_dir, f"orig.{img_type or 'bin'}")
-                    with open(temp_orig, 'wb') as f:
-                        f.write(image_data)
-                    
-                    # Open with Pillow and convert to RGB JPEG
-                    img = Image.open(temp_orig)
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    
-                    # Resize if too large (max 500x500px) while maintaining aspect ratio
-                    if img.width > 500 or img.height > 500:
-                        img.thumbnail((500, 500))
-                    
-                    # Save as high quality JPEG
-                    img.save(temp_img_path, format='JPEG', quality=95)
-                    
-                    # Read the converted image
-                    with open(temp_img_path, 'rb') as f:
-                        image_data = f.read()
-                        
-                    logger.info(f"Successfully converted image to JPEG: {len(image_data)} bytes")
-                    img_type = 'jpeg'
-                except Exception as e:
-                    logger.warning(f"Error processing image with Pillow: {e}")
-                    
-                    # Try ffmpeg as fallback
-                    try:
-                        call(['ffmpeg', '-i', temp_orig, '-q:v', '1', '-pix_fmt', 'yuvj420p', temp_img_path], 
-                             stdout=tempfile.devnull, stderr=tempfile.devnull)
-                        
-                        if os.path.exists(temp_img_path):
-                            with open(temp_img_path, 'rb') as f:
-                                image_data = f.read()
-                            logger.info(f"Successfully converted image with ffmpeg: {len(image_data)} bytes")
-                            img_type = 'jpeg'
-                    except Exception as ffmpeg_error:
-                        logger.warning(f"FFmpeg conversion failed: {ffmpeg_error}")
-                
-                # Clean up
-                try:
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                except:
-                    pass
+            image_data = cover_art.get_cover(thumbnail_url=thumbnail_url, youtube_id=youtube_id)
+            if not image_data and thumbnail_url and youtube_id:
+                # Fall back to the video's own thumbnail
+                image_data = cover_art.get_cover(youtube_id=youtube_id)
 
-                # Use image/jpeg MIME type for Windows compatibility
-                mime_type = "image/jpeg"
-                
-                if image_data:
-                    logger.info(f"Adding album art, MIME type: {mime_type}")
-                    
-                    # Create APIC frame with version 3 encoding for wide compatibility
-                    # Use ID3v2.3 compatible settings
-                    audio['APIC'] = APIC(
-                        encoding=3,           # UTF-8
-                        mime=mime_type,       # Always use image/jpeg
-                        type=3,               # Cover (front)
-                        desc='Cover',
-                        data=image_data
-                    )
-                    logger.info("Successfully added album art to ID3 tags")
-                else:
-                    logger.warning("No image data available after conversion attempts")
-            except Exception as e:
-                logger.warning(f"Error processing image: {e}")
-        
-        # If no image data but we have a YouTube ID, try to get a thumbnail directly from YouTube
-        elif youtube_id:
-            try:
-                # Construct YouTube thumbnail URL
-                yt_thumbnail_url = f"https://img.youtube.com/vi/{youtube_id}/maxresdefault.jpg"
-                logger.info(f"Trying to get thumbnail directly from YouTube: {yt_thumbnail_url}")
-                
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
-                }
-                
-                response = requests.get(yt_thumbnail_url, timeout=10, headers=headers)
-                if response.status_code == 200 and len(response.content) > 1000:  # Ensure it's not a placeholder
-                    image_data = response.content
-                    logger.info(f"Successfully downloaded YouTube thumbnail: {len(image_data)} bytes")
-                    
-                    # Create a temporary directory for image processing
-                    temp_dir = tempfile.mkdtemp()
-                    temp_img_path = os.path.join(temp_dir, "yt_thumb.jpg")
-                    
-                    # Save and optimize the image for Windows compatibility
-                    try:
-                        # Save the original image data
-                        with open(temp_img_path + '.orig', 'wb') as f:
-                            f.write(image_data)
-                        
-                        # Open with Pillow and convert/optimize
-                        img = Image.open(BytesIO(image_data))
-                        if img.mode != 'RGB':
-                            img = img.convert('RGB')
-                        
-                        # Save as high quality JPEG
-                        img.save(temp_img_path, format='JPEG', quality=95)
-                        
-                        # Read the processed image
-                        with open(temp_img_path, 'rb') as f:
-                            image_data = f.read()
-                            
-                        logger.info(f"Successfully processed YouTube thumbnail: {len(image_data)} bytes")
-                    except Exception as e:
-                        logger.warning(f"Error processing YouTube thumbnail: {e}")
-                        # Fall back to original data
-                    
-                    # Clean up
-                    try:
-                        shutil.rmtree(temp_dir, ignore_errors=True)
-                    except:
-                        pass
-                    
-                    # Add the thumbnail to the ID3 tags
-                    audio['APIC'] = APIC(
-                        encoding=3,           # UTF-8
-                        mime="image/jpeg",     # YouTube thumbnails are JPEG
-                        type=3,               # Cover (front)
-                        desc='Cover',
-                        data=image_data
-                    )
-                    logger.info("Successfully added YouTube thumbnail to ID3 tags")
-                else:
-                    # Try alternative thumbnail URL
-                    yt_thumbnail_url = f"https://img.youtube.com/vi/{youtube_id}/hqdefault.jpg"
-                    logger.info(f"Trying alternative YouTube thumbnail: {yt_thumbnail_url}")
-                    
-                    response = requests.get(yt_thumbnail_url, timeout=10, headers=headers)
-                    if response.status_code == 200 and len(response.content) > 1000:
-                        image_data = response.content
-                        logger.info(f"Successfully downloaded alternative YouTube thumbnail: {len(image_data)} bytes")
-                        
-                        # Process thumbnail for Windows compatibility 
-                        temp_dir = tempfile.mkdtemp()
-                        temp_img_path = os.path.join(temp_dir, "yt_thumb_alt.jpg")
-                        
-                        try:
-                            # Process with Pillow
-                            img = Image.open(BytesIO(image_data))
-                            if img.mode != 'RGB':
-                                img = img.convert('RGB')
-                            img.save(temp_img_path, format='JPEG', quality=95)
-                            
-                            # Read the processed image
-                            with open(temp_img_path, 'rb') as f:
-                                image_data = f.read()
-                                
-                            logger.info(f"Successfully processed alternative YouTube thumbnail: {len(image_data)} bytes")
-                        except Exception as e:
-                            logger.warning(f"Error processing alternative YouTube thumbnail: {e}")
-                            # Fall back to original data
-                        
-                        # Clean up
-                        try:
-                            shutil.rmtree(temp_dir, ignore_errors=True)
-                        except:
-                            pass
-                        
-                        # Add the thumbnail to the ID3 tags
-                        audio['APIC'] = APIC(
-                            encoding=3,           # UTF-8
-                            mime="image/jpeg",     # JPEG format for Windows compatibility
-                            type=3,               # Cover (front)
-                            desc='Cover',
-                            data=image_data
-                        )
-                        logger.info("Successfully added alternative YouTube thumbnail to ID3 tags")
-            except Exception as e:
-                logger.warning(f"Error getting YouTube thumbnail: {e}")
+            if image_data:
+                # Create APIC frame with version 3 encoding for wide compatibility
+                # Use ID3v2.3 compatible settings
+                audio['APIC'] = APIC(
+                    encoding=3,           # UTF-8
+                    mime="image/jpeg",     # Always use image/jpeg
+                    type=3,               # Cover (front)
+                    desc='Cover',
+                    data=image_data
+                )
+                logger.info(f"Successfully added album art to ID3 tags: {len(image_data)} bytes")
+            else:
+                logger.warning("No cover art available")
         
         # Save the changes using ID3v2.3 for better compatibility with Windows Explorer
         audio.save(mp3_path, v2_version=3)
@@ -718,17 +917,6 @@ def embed_metadata(mp3_path, title, artist, album='Unknown', genre='Unknown', th
                 
                 logger.info("Attempting to set system thumbnail property directly (Windows only)")
                 
-                # Save thumbnail to a temporary file
-                temp_dir = tempfile.mkdtemp()
-                temp_jpg = os.path.join(temp_dir, "cover.jpg")
-                
-                with open(temp_jpg, 'wb') as f:
-                    f.write(image_data)
-                
-                # Get absolute paths
-                abs_mp3_path = os.path.abspath(mp3_path)
-                abs_jpg_path = os.path.abspath(temp_jpg)
-                
                 # Try to associate the image with the file using a different approach
                 try:
                     # First try to completely wipe existing tags and create fresh ones
@@ -775,12 +963,6 @@ def embed_metadata(mp3_path, title, artist, album='Unknown', genre='Unknown', th
                     
                 except Exception as shell_error:
                     logger.warning(f"Could not set shell thumbnail: {shell_error}")
-                
-                # Clean up
-                try:
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                except:
-                    pass
                     
             except ImportError:
                 logger.info("Win32com not available, skipping direct thumbnail setting")
@@ -1354,4 +1536,20 @@ def extract_youtube_video_id(url):
         match = re.search(pattern, url)
         if match:
             return match.group(1)
-    return None
\ No newline at end of file
+    return None
+
+def canonical_key(url):
+    """
+    Stable identity for a track's source, so different URL spellings of the
+    same video or Spotify track map to one key ('youtube:<id>', 'spotify:<id>').
+    Other URLs are used as-is. Returns None for an empty URL.
+    """
+    if not url:
+        return None
+    video_id = extract_youtube_video_id(url)
+    if video_id:
+        return f"youtube:{video_id}"
+    match = re.search(r'open\.spotify\.com/(?:intl-[a-z]+/)?track/([a-zA-Z0-9]+)', url)
+    if match:
+        return f"spotify:{match.group(1)}"
+    return f"url:{url.strip()}"[:255]
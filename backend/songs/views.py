@@ -2,23 +2,21 @@ import os
 import json
 import logging
 import time
-import tempfile
-import shutil
 import yt_dlp
 import requests  # Add requests for API calls
 from django.conf import settings
-from django.http import FileResponse, HttpResponse
+from django.http import HttpResponse
 from django.utils import timezone
 from datetime import timedelta, datetime
 from django.conf import settings
-from django.http import JsonResponse, FileResponse, HttpResponse, StreamingHttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, status, generics
 from rest_framework.decorators import action, api_view
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from celery.result import AsyncResult
-from .models import Song, Playlist, UserMusicProfile,DownloadProgress, SongCache, SongPlay, UserAnalytics
+from .models import Song, Playlist, UserMusicProfile,DownloadProgress, SongCache, SongPlay, UserAnalytics, DownloadJob, PlaylistArchive
 from .serializers import SongSerializer, PlaylistSerializer, UserMusicProfileSerializer, ArtistSerializer
 from rest_framework.permissions import AllowAny
 from rest_framework.views import APIView
@@ -30,16 +28,28 @@ from django_ratelimit.exceptions import Ratelimited
 from functools import wraps
 from .utils import (
     youtube_api_retry, spotify_api_retry, download_from_youtube, 
-    convert_audio_format, download_youtube_util, sanitize_filename, embed_metadata
+    get_transcoded_file, download_youtube_util, sanitize_filename, embed_metadata,
+    extract_youtube_video_id
 )
 from django.utils.text import Truncator
 import re
-from .download_helper import download_youtube, download_spotify_track, download_playlist, download_by_task
+from .download_helper import (
+    download_youtube, download_spotify_track, download_playlist, download_by_task,
+    submit_download_job, job_accepted_response, build_transcode_response, source_unavailable_response
+)
+from .utils import SourceUnavailableError
+from .delivery import serve_file, serve_media_file
+from .storage import ensure_local
+from .zipstream import ZipStream
+from .tasks import schedule_playlist_archive
 from django.db import models
 
 
 logger = logging.getLogger(__name__)
 
+# Account that public (unauthenticated) downloads are recorded against
+PUBLIC_DOWNLOAD_USERNAME = "testuser"
+
 # Handler for rate limit exceeded
 def ratelimited_error(request, exception):
     """Return a custom response for rate-limited requests"""
@@ -137,6 +147,16 @@ def sanitize_for_db(text, max_length=95):
         
     return sanitized.strip()
 
+def wants_async_download(request):
+    """
+    Whether a download request should be queued as a job instead of running
+    in the request thread. Enabled globally with ASYNC_DOWNLOADS or per request
+    with an `async` flag.
+    """
+    if getattr(settings, 'ASYNC_DOWNLOADS', False):
+        return True
+    return str(request.data.get('async', '')).lower() in ('1', 'true', 'yes')
+
 class SongViewSet(viewsets.ModelViewSet):
     queryset = Song.objects.all()
     serializer_class = SongSerializer
@@ -167,27 +187,21 @@ class SongViewSet(viewsets.ModelViewSet):
             # Get the song by ID without user filter since this is a public endpoint
             song = get_object_or_404(Song, id=pk)
             file_path = os.path.join(settings.MEDIA_ROOT, song.file.name)
-            
-            if not os.path.exists(file_path):
-                logger.warning(f"Public download requested for missing file: {file_path}")
-                return Response(
-                    {'error': 'File not found'}, 
-                    status=status.HTTP_404_NOT_FOUND
-                )
 
             # Log the download attempt with IP for monitoring
             ip_address = request.META.get('REMOTE_ADDR', 'unknown')
             logger.info(f"Public download requested for song {pk} from IP {ip_address}")
             
-            # Serve the file
+            # Serve the file from whichever storage tier has it
             filename = f"{song.title} - {song.artist}.mp3"
             filename = sanitize_filename(filename)
-            response = FileResponse(
-                open(file_path, 'rb'),
-                as_attachment=True,
-                filename=filename
-            )
-            response['Content-Type'] = 'audio/mpeg'
+            response = serve_media_file(request, file_path, filename, 'audio/mpeg')
+            if response is None:
+                logger.warning(f"Public download requested for missing file: {file_path}")
+                return Response(
+                    {'error': 'File not found'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
             # Add song metadata headers
             response['x-song-title'] = song.title
             response['x-song-artist'] = song.artist
@@ -216,7 +230,7 @@ class SongViewSet(viewsets.ModelViewSet):
         self.check_permissions(request)
         from django.contrib.auth import get_user_model
         User = get_user_model()
-        test_user = User.objects.get(username="testuser")
+        test_user = User.objects.get(username=PUBLIC_DOWNLOAD_USERNAME)
         request.user=test_user
         
         url = request.data.get('url')
@@ -248,31 +262,29 @@ class SongViewSet(viewsets.ModelViewSet):
                 # We found the song, serve it
                 file_path = os.path.join(settings.MEDIA_ROOT, existing_song.file.name)
                 
-                if not os.path.exists(file_path):
+                # Check if we need to convert format
+                needs_transcode = output_format != 'mp3' and os.path.splitext(file_path)[1][1:] != output_format
+                if needs_transcode:
+                    # ffmpeg needs a local copy of a demoted song
+                    file_path = ensure_local(file_path)
+                
+                # Serve the file from whichever storage tier has it
+                filename = f"{existing_song.title} - {existing_song.artist}.{output_format}"
+                filename = sanitize_filename(filename)
+                if not file_path:
+                    response = None
+                elif needs_transcode:
+                    logger.info(f"Converting song from {os.path.splitext(file_path)[1][1:]} to {output_format}")
+                    response = serve_file(request, get_transcoded_file(file_path, output_format), filename, f'audio/{output_format}')
+                else:
+                    response = serve_media_file(request, file_path, filename, f'audio/{output_format}')
+                if response is None:
                     # File is missing, need to download again or return error
-                    logger.warning(f"Public download requested for missing file: {file_path}")
+                    logger.warning(f"Public download requested for missing file: {existing_song.file.name}")
                     return Response(
                         {'error': 'File not found'}, 
                         status=status.HTTP_404_NOT_FOUND
                     )
-                
-                # Check if we need to convert format
-                if output_format != 'mp3' and os.path.splitext(file_path)[1][1:] != output_format:
-                    # Convert the format
-                    logger.info(f"Converting song from {os.path.splitext(file_path)[1][1:]} to {output_format}")
-                    final_filename = convert_audio_format(file_path, output_format)
-                else:
-                    final_filename = file_path
-                
-                # Serve the file
-                filename = f"{existing_song.title} - {existing_song.artist}.{output_format}"
-                filename = sanitize_filename(filename)
-                response = FileResponse(
-                    open(final_filename, 'rb'),
-                    as_attachment=True,
-                    filename=filename
-                )
-                response['Content-Type'] = f'audio/{output_format}'
                 # Add song metadata headers
                 response['x-song-title'] = existing_song.title
                 response['x-song-artist'] = existing_song.artist
@@ -304,33 +316,30 @@ class SongViewSet(viewsets.ModelViewSet):
                 title = metadata.get('title', 'Unknown Title')
                 artist = metadata.get('artist', 'Unknown Artist')
                 
-                # Check if file exists
-                if not os.path.exists(cached_file_path):
-                    # File missing from cache, cannot serve
-                    logger.warning(f"Public download cached file not found: {cached_file_path}")
-                    return Response(
-                        {'error': 'File not found'}, 
-                        status=status.HTTP_404_NOT_FOUND
-                    )
-                
                 # Check if we need format conversion
-                if output_format != 'mp3' and os.path.splitext(cached_file_path)[1][1:] != output_format:
-                    # Convert the format
-                    logger.info(f"Converting cached song from {os.path.splitext(cached_file_path)[1][1:]} to {output_format}")
-                    final_filename = convert_audio_format(cached_file_path, output_format)
-                else:
-                    final_filename = cached_file_path
+                needs_transcode = output_format != 'mp3' and os.path.splitext(cached_file_path)[1][1:] != output_format
+                if needs_transcode:
+                    # ffmpeg needs a local copy of a demoted file
+                    cached_file_path = ensure_local(cached_file_path)
                 
-                # Serve the file
+                # Serve the file from whichever storage tier has it
                 formatted_filename = f"{title} - {artist}.{output_format}"
                 formatted_filename = sanitize_filename(formatted_filename)
                 
-                response = FileResponse(
-                    open(final_filename, 'rb'),
-                    as_attachment=True,
-                    filename=formatted_filename
-                )
-                response['Content-Type'] = f'audio/{output_format}'
+                if not cached_file_path:
+                    response = None
+                elif needs_transcode:
+                    logger.info(f"Converting cached song from {os.path.splitext(cached_file_path)[1][1:]} to {output_format}")
+                    response = serve_file(request, get_transcoded_file(cached_file_path, output_format), formatted_filename, f'audio/{output_format}')
+                else:
+                    response = serve_media_file(request, cached_file_path, formatted_filename, f'audio/{output_format}')
+                if response is None:
+                    # File missing from cache, cannot serve
+                    logger.warning(f"Public download cached file not found: {cached_path}")
+                    return Response(
+                        {'error': 'File not found'}, 
+                        status=status.HTTP_404_NOT_FOUND
+                    )
                 # Add song metadata headers
                 response['x-song-title'] = title
                 response['x-song-artist'] = artist
@@ -342,6 +351,10 @@ class SongViewSet(viewsets.ModelViewSet):
             
             # Neither song in database nor cache, need to download
             # For public users, we'll limit this to avoid abuse
+            if wants_async_download(request) and ('spotify.com' in url or 'youtube.com' in url or 'youtu.be' in url):
+                job = submit_download_job(test_user, url, output_format)
+                return job_accepted_response(request, job)
+
             if 'spotify.com' in url:
                 # Handle Spotify URLs
                 result = download_spotify_track(request, url, output_format)
@@ -360,6 +373,8 @@ class SongViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
+        except SourceUnavailableError as e:
+            return source_unavailable_response(e)
         except Exception as e:
             logger.error(f"Error in public_download_by_url: {e}", exc_info=True)
             return Response(
@@ -421,46 +436,25 @@ class SongViewSet(viewsets.ModelViewSet):
             if existing_song:
                 logger.info(f"Found existing song with URL {url}, serving directly")
                 
-                # Check if file exists
+                # Check if file exists in either storage tier
                 file_path = os.path.join(settings.MEDIA_ROOT, existing_song.file.name)
-                if os.path.exists(file_path):
+                if existing_song.file and existing_song.file.storage.exists(existing_song.file.name):
                     # If format matches or no conversion needed
                     if format == 'mp3' or os.path.splitext(file_path)[1][1:] == format:
                         # Serve the existing file directly - let FileResponse manage the file handle
                         filename = f"{existing_song.title} - {existing_song.artist}.{os.path.splitext(file_path)[1][1:]}"
                         filename = sanitize_filename(filename)
-                        response = FileResponse(
-                            open(file_path, 'rb'),
-                            as_attachment=True,
-                            filename=filename
-                        )
-                        response['Content-Type'] = f'audio/{os.path.splitext(file_path)[1][1:]}'
-                        return response
+                        response = serve_media_file(request, file_path, filename, f'audio/{os.path.splitext(file_path)[1][1:]}')
+                        if response is not None:
+                            return response
                     else:
-                        # Need to convert the format
-                        logger.info(f"Converting existing song from {os.path.splitext(file_path)[1][1:]} to {format}")
-                        converted_path = convert_audio_format(file_path, format)
-                        
-                        # Update the song's file path if it doesn't already exist
-                        new_filename = f"{existing_song.title} - {existing_song.artist}.{format}"
-                        new_filename = sanitize_filename(new_filename)
-                        new_relative_path = os.path.join('songs', new_filename)
-                        new_absolute_path = os.path.join(settings.MEDIA_ROOT, new_relative_path)
-                        
-                        # Copy the converted file to the media directory if needed
-                        if not os.path.exists(new_absolute_path):
-                            import shutil
-                            os.makedirs(os.path.dirname(new_absolute_path), exist_ok=True)
-                            shutil.copy2(converted_path, new_absolute_path)
-                        
-                        # Serve the converted file
-                        response = FileResponse(
-                            open(new_absolute_path, 'rb'),
-                            as_attachment=True,
-                            filename=new_filename
-                        )
-                        response['Content-Type'] = f'audio/{format}'
-                        return response
+                        # Need to convert the format; ffmpeg needs a local copy of a demoted song
+                        local_path = ensure_local(file_path)
+                        if local_path:
+                            logger.info(f"Converting existing song from {os.path.splitext(file_path)[1][1:]} to {format}")
+                            new_filename = f"{existing_song.title} - {existing_song.artist}.{format}"
+                            new_filename = sanitize_filename(new_filename)
+                            return build_transcode_response(request, local_path, format, new_filename)
                         
             # If we get here, the song doesn't exist yet or the file is missing
             # Apply rate limiting for external services
@@ -476,6 +470,11 @@ class SongViewSet(viewsets.ModelViewSet):
                 logger.warning(f"Rate limit exceeded for {request.path} from {request.META.get('REMOTE_ADDR')}")
                 return HttpResponse("Rate limit exceeded. Please try again later.", status=429)
                 
+            # Queue the download instead of holding this worker if requested
+            if wants_async_download(request) and ('youtube.com' in url or 'youtu.be' in url or 'spotify.com' in url):
+                job = submit_download_job(request.user, url, format)
+                return job_accepted_response(request, job)
+
             # Determine source based on URL and download
             if 'youtube.com' in url or 'youtu.be' in url:
                 return download_youtube(request, url, format)
@@ -486,6 +485,8 @@ class SongViewSet(viewsets.ModelViewSet):
                     {'error': 'Unsupported URL. Only YouTube and Spotify URLs are supported.'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
+        except SourceUnavailableError as e:
+            return source_unavailable_response(e)
         except Exception as e:
             logger.error(f"Download error: {e}", exc_info=True)
             return Response(
@@ -502,24 +503,41 @@ class SongViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def download_file(self, request, pk=None):
         """
-        Download a specific song file
+        Download a specific song file, optionally in another format (?audio_format=aac)
         """
         song = self.get_object()
         file_path = os.path.join(settings.MEDIA_ROOT, song.file.name)
+        output_format = request.query_params.get('audio_format')
         
-        if not os.path.exists(file_path):
+        # Checks both storage tiers, so demoted songs are still found
+        if not song.file or not song.file.storage.exists(song.file.name):
             return Response(
                 {'error': 'File not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        try:
-            response = FileResponse(
-                open(file_path, 'rb'),
-                as_attachment=True,
-                filename=f"{song.title} - {song.artist}.mp3"
+        if output_format and output_format not in settings.SUPPORTED_AUDIO_FORMATS:
+            return Response(
+                {'error': f'Unsupported format. Supported formats: {", ".join(settings.SUPPORTED_AUDIO_FORMATS)}'}, 
+                status=status.HTTP_400_BAD_REQUEST
             )
-            response['Content-Type'] = 'audio/mpeg'
+
+        try:
+            if output_format and os.path.splitext(file_path)[1][1:] != output_format:
+                filename = sanitize_filename(f"{song.title} - {song.artist}.{output_format}")
+                # ffmpeg needs a local copy of a demoted song
+                local_path = ensure_local(file_path)
+                if local_path:
+                    return build_transcode_response(request, local_path, output_format, filename, song=song)
+                response = None
+            else:
+                response = serve_media_file(request, file_path, f"{song.title} - {song.artist}.mp3", 'audio/mpeg')
+            if response is None:
+                # Removed from both tiers since the check above
+                return Response(
+                    {'error': 'File not found'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
             # Add song metadata headers
             response['x-song-title'] = song.title
             response['x-song-artist'] = song.artist
@@ -535,6 +553,32 @@ class SongViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=True, methods=['get'])
+    def cover(self, request, pk=None):
+        """
+        The song's cover art as a JPEG from the shared cover art store
+        (?size=small for the 64px variant used in lists, large by default)
+        """
+        from django.utils.cache import patch_cache_control
+        from . import cover_art
+
+        song = self.get_object()
+        size = request.query_params.get('size', 'large')
+        if size not in settings.COVER_ART_SIZES:
+            return Response(
+                {'error': f'Unsupported size. Supported sizes: {", ".join(settings.COVER_ART_SIZES)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        youtube_id = extract_youtube_video_id(song.song_url)
+        if not cover_art.get_cover(thumbnail_url=song.thumbnail_url, youtube_id=youtube_id, size=size):
+            return Response({'error': 'No cover art'}, status=status.HTTP_404_NOT_FOUND)
+
+        key = cover_art.cover_key(song.thumbnail_url, youtube_id)
+        response = serve_file(request, cover_art.cover_path(key, size), 'cover.jpg', 'image/jpeg', as_attachment=False)
+        patch_cache_control(response, private=True, max_age=86400)
+        return response
+
     @action(detail=False, methods=['get'])
     def download_by_task(self, request):
         """
@@ -542,6 +586,160 @@ class SongViewSet(viewsets.ModelViewSet):
         """
         return download_by_task(request)
 
+    @custom_ratelimit(group='download', key='ip', rate='30/hour', method='ALL')
+    @action(detail=False, methods=['post'], url_path='jobs', url_name='jobs')
+    def submit_job(self, request):
+        """
+        Queue a song download and return a job id immediately.
+        Poll the status URL (honouring its Retry-After) until the job finishes,
+        then fetch the file URL.
+        """
+        url = request.data.get('url')
+        format = request.data.get('format', settings.DEFAULT_AUDIO_FORMAT)
+
+        if not url:
+            return Response(
+                {'error': 'URL is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Validate format
+        if format not in settings.SUPPORTED_AUDIO_FORMATS:
+            return Response(
+                {'error': f'Unsupported format. Supported formats: {", ".join(settings.SUPPORTED_AUDIO_FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not ('youtube.com' in url or 'youtu.be' in url or 'spotify.com' in url):
+            return Response(
+                {'error': 'Unsupported URL. Only YouTube and Spotify URLs are supported.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Check if user can download, counting jobs that haven't finished yet
+        if not request.user.can_download(pending=DownloadJob.pending_count(request.user)):
+            return Response(
+                {
+                    'error': 'Daily download limit reached',
+                    'remaining': 0,
+                    'reset_time': request.user.last_download_reset + timedelta(days=1)
+                },
+                status=status.HTTP_429_TOO_MANY_REQUESTS
+            )
+
+        try:
+            job = submit_download_job(request.user, url, format)
+            return job_accepted_response(request, job)
+        except SourceUnavailableError as e:
+            return source_unavailable_response(e)
+        except Exception as e:
+            logger.error(f"Error queueing download job: {e}", exc_info=True)
+            return Response(
+                {'error': f'Could not queue download: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+    def _get_job(self, request, job_id):
+        """
+        Look up a job by id. Jobs of the public download account are reachable by
+        anyone holding the (unguessable) job id; other jobs only by their owner.
+        """
+        job = DownloadJob.objects.select_related('user').filter(id=job_id).first()
+        if not job:
+            return None
+        if job.user.username == PUBLIC_DOWNLOAD_USERNAME:
+            return job
+        if request.user.is_authenticated and job.user_id == request.user.id:
+            return job
+        return None
+
+    @action(detail=False, methods=['get'], permission_classes=[AllowAny],
+            url_path=r'jobs/(?P<job_id>[0-9a-f-]{36})', url_name='job-status')
+    def job_status(self, request, job_id=None):
+        """
+        Return the current state of a download job. This is the way to follow a
+        job: each poll is one quick query, so no request worker waits on the
+        download. Unfinished jobs carry a Retry-After saying when to poll next.
+        """
+        job = self._get_job(request, job_id)
+        if not job:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        response = Response(job.to_dict())
+        if not job.is_finished:
+            response['Retry-After'] = str(settings.DOWNLOAD_JOB_POLL_SECONDS)
+        return response
+
+    @action(detail=False, methods=['get'], permission_classes=[AllowAny],
+            url_path=r'jobs/(?P<job_id>[0-9a-f-]{36})/events', url_name='job-events')
+    def job_events(self, request, job_id=None):
+        """
+        Job progress as server-sent events, for clients that prefer EventSource
+        to polling the status URL. Each event carries the same payload as the
+        status endpoint. The stream is a short long-poll: it closes after
+        DOWNLOAD_JOB_EVENT_TIMEOUT seconds with a retry hint and EventSource
+        reconnects, so a sync worker is never held for the whole download.
+        """
+        job = self._get_job(request, job_id)
+        if not job:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        poll_interval = settings.DOWNLOAD_JOB_EVENT_INTERVAL
+        max_duration = settings.DOWNLOAD_JOB_EVENT_TIMEOUT
+        retry_seconds = settings.DOWNLOAD_JOB_POLL_SECONDS
+
+        def event_stream():
+            last_payload = None
+            started = time.monotonic()
+            while True:
+                current = DownloadJob.objects.filter(id=job.id).first()
+                if not current:
+                    yield "event: error\ndata: {\"error\": \"Job not found\"}\n\n"
+                    return
+                payload = json.dumps(current.to_dict())
+                if payload != last_payload:
+                    last_payload = payload
+                    yield f"data: {payload}\n\n"
+                if current.is_finished:
+                    yield f"event: {current.status}\ndata: {payload}\n\n"
+                    return
+                if time.monotonic() - started + poll_interval > max_duration:
+                    # Hand the worker back; EventSource reconnects after the retry delay
+                    yield f"retry: {retry_seconds * 1000}\nevent: timeout\ndata: {{}}\n\n"
+                    return
+                time.sleep(poll_interval)
+
+        response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['Retry-After'] = str(retry_seconds)
+        # Stop nginx from buffering the event stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @action(detail=False, methods=['get'], permission_classes=[AllowAny],
+            url_path=r'jobs/(?P<job_id>[0-9a-f-]{36})/file', url_name='job-file')
+    def job_file(self, request, job_id=None):
+        """Serve the file produced by a completed download job"""
+        job = self._get_job(request, job_id)
+        if not job:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        if job.status != 'completed':
+            return Response(
+                {'error': 'Job is not complete', 'status': job.status, 'progress': job.progress},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        file_path = os.path.join(settings.MEDIA_ROOT, job.file_path)
+        response = serve_media_file(request, file_path, job.filename, job.content_type or 'audio/mpeg')
+        if response is None:
+            return Response(
+                {'error': 'File not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        if response.status_code in (200, 206):
+            response['Content-Disposition'] = f'attachment; filename="{job.filename}"'
+        return response
+
 class PlaylistViewSet(viewsets.ModelViewSet):
     serializer_class = PlaylistSerializer
     permission_classes = [IsAuthenticated]
@@ -569,6 +767,7 @@ class PlaylistViewSet(viewsets.ModelViewSet):
         
         song = get_object_or_404(Song, id=song_id, user=request.user)
         playlist.songs.add(song)
+        schedule_playlist_archive(playlist.id)
         
         return Response({
             'status': 'success',
@@ -588,6 +787,7 @@ class PlaylistViewSet(viewsets.ModelViewSet):
         
         song = get_object_or_404(Song, id=song_id, user=request.user)
         playlist.songs.remove(song)
+        schedule_playlist_archive(playlist.id)
         
         return Response({
             'status': 'success',
@@ -607,133 +807,39 @@ class PlaylistViewSet(viewsets.ModelViewSet):
             )
 
         try:
-            # Create a ZIP file
-            import zipfile
-            import tempfile
+            logger.info(f"Creating ZIP stream for playlist '{playlist.name}' with {playlist.songs.count()} songs")
             
-            # Create a temporary directory instead of a temporary file
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Create zip file with a fixed name inside the temp directory
-                zip_path = os.path.join(temp_dir, f"{playlist.name}_{int(time.time())}.zip")
-                
-                # Log some info about the playlist and zip
-                logger.info(f"Creating ZIP file for playlist '{playlist.name}' with {playlist.songs.count()} songs at {zip_path}")
-                
-                # Track files added to the ZIP
-                files_added = 0
-                missing_files = 0
-                
-                with zipfile.ZipFile(zip_path, 'w') as zip_file:
-                    for song in playlist.songs.all():
-                        if not song.file:
-                            logger.warning(f"Song {song.id} '{song.title}' has no file attribute")
-                            missing_files += 1
-                            continue
-                            
-                        # Flag to track if we found the file
-                        file_found = False
-                        
-                        # Generate a list of potential file paths to try
-                        potential_paths = []
-                        
-                        # 1. First try standard path from the database
-                        if isinstance(song.file.name, str):
-                            standard_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, song.file.name))
-                            potential_paths.append(standard_path)
-                        elif hasattr(song.file, 'path'):
-                            standard_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, song.file.path))
-                            potential_paths.append(standard_path)
-                        
-                        # 2. Try direct path in songs directory (most common location)
-                        clean_filename = f"{song.title} - {song.artist}.mp3"
-                        clean_filename = sanitize_filename(clean_filename)
-                        songs_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, 'songs', clean_filename))
-                        potential_paths.append(songs_path)
-                        
-                        # 3. Try reconstructing the path if it contains 'songs' but might be malformed
-                        if isinstance(song.file.name, str) and 'songs' in song.file.name:
-                            parts = song.file.name.split('songs')
-                            if len(parts) > 1:
-                                reconstructed_path = os.path.join(settings.MEDIA_ROOT, 'songs', parts[1].lstrip('\\/'))
-                                reconstructed_path = os.path.normpath(reconstructed_path)
-                                potential_paths.append(reconstructed_path)
-                        
-                        # 4. Try the cache directory
-                        cache_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, 'cache', clean_filename))
-                        potential_paths.append(cache_path)
-                        
-                        # 5. Try with 'Official Music Video' suffix in filename (common in YouTube downloads)
-                        video_filename = f"{song.title} - {song.artist} Official Music Video.mp3"
-                        video_filename = sanitize_filename(video_filename)
-                        video_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, 'cache', video_filename))
-                        potential_paths.append(video_path)
-                        
-                        # 6. Try with 'Official Lyric Video' suffix in filename
-                        lyric_filename = f"{song.title} - {song.artist} Official Lyric Video.mp3"
-                        lyric_filename = sanitize_filename(lyric_filename)
-                        lyric_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, 'cache', lyric_filename))
-                        potential_paths.append(lyric_path)
-                        
-                        # Deduplicate paths (in case there are duplicates)
-                        potential_paths = list(dict.fromkeys(potential_paths))
-                        
-                        # Log the potential paths we'll try
-                        logger.debug(f"Looking for song {song.id} '{song.title}' in {len(potential_paths)} potential locations")
-                        
-                        # Try each potential path
-                        for path in potential_paths:
-                            if os.path.exists(path):
-                                # Log the file being added
-                                logger.info(f"Found and adding file to ZIP: {path} as {clean_filename}")
-                                zip_file.write(path, clean_filename)
-                                files_added += 1
-                                file_found = True
-                                break
-                        
-                        # If all paths failed, try fallback search by title and artist across all media directories
-                        if not file_found:
-                            import glob
-                            # Search in all media subdirectories for files matching song title and artist
-                            search_pattern = os.path.join(settings.MEDIA_ROOT, '**', f"*{song.title}*{song.artist}*.mp3")
-                            search_pattern = search_pattern.replace(" ", "*")  # Make the search more flexible
-                            try:
-                                potential_matches = glob.glob(search_pattern, recursive=True)
-                                if potential_matches:
-                                    # Use the first match found
-                                    match_path = potential_matches[0]
-                                    logger.info(f"Found file via fuzzy search: {match_path} as {clean_filename}")
-                                    zip_file.write(match_path, clean_filename)
-                                    files_added += 1
-                                    file_found = True
-                            except Exception as glob_error:
-                                logger.warning(f"Error during glob search: {glob_error}")
-                        
-                        # Still couldn't find the file
-                        if not file_found:
-                            logger.warning(f"File not found for song {song.id} '{song.title}' after trying {len(potential_paths)} paths")
-                            missing_files += 1
-                
-                # Check if any files were added
-                if files_added == 0:
-                    logger.error(f"No files were added to the ZIP for playlist {playlist.id} '{playlist.name}'. Missing files: {missing_files}")
-                    return Response(
-                        {'error': 'No valid files found in playlist. Please ensure the songs have been downloaded.'}, 
-                        status=status.HTTP_404_NOT_FOUND
-                    )
-                
-                # Log the size of the ZIP file before sending
-                zip_size = os.path.getsize(zip_path)
-                logger.info(f"ZIP file created successfully. Size: {zip_size} bytes, Files added: {files_added}, Missing files: {missing_files}")
-                
-                # Read file content into memory and return
-                with open(zip_path, 'rb') as f:
-                    content = f.read()
-                
-                # Create the response with appropriate headers
-                response = HttpResponse(content, content_type='application/zip')
-                response['Content-Disposition'] = f'attachment; filename="{sanitize_filename(playlist.name)}.zip"'
-                response['Content-Length'] = str(zip_size)
-                return response
+            files, missing = PlaylistArchive.collect_files(PlaylistArchive.playlist_songs(playlist))
+            for song in missing:
+                logger.warning(f"File not found for song {song.id} '{song.title}'")
+            
+            # Check if any files were added
+            if not files:
+                logger.error(f"No files were added to the ZIP for playlist {playlist.id} '{playlist.name}'. Missing files: {len(missing)}")
+                return Response(
+                    {'error': 'No valid files found in playlist. Please ensure the songs have been downloaded.'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            
+            filename = f"{sanitize_filename(playlist.name)}.zip"
+            key, manifest = PlaylistArchive.manifest_for(files)
+            prebuilt = PlaylistArchive.current(playlist, key)
+            if prebuilt:
+                logger.info(f"Serving prebuilt archive {key[:12]} for playlist {playlist.id}")
+                return serve_file(request, prebuilt.full_path, filename=filename,
+                                  content_type='application/zip', etag=prebuilt.etag)
+            
+            # Not built yet: stream a stored ZIP straight from the song files; its size is known
+            # before any byte is read and its bytes match the archive built in the background
+            archive = ZipStream(files)
+            logger.info(f"Streaming ZIP. Size: {archive.size} bytes, Files added: {len(archive)}, Missing files: {len(missing)}")
+            schedule_playlist_archive(playlist.id)
+            
+            response = StreamingHttpResponse(archive, content_type='application/zip')
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+            response['Content-Length'] = str(archive.size)
+            response['ETag'] = f'"{key}"'
+            return response
 
         except Exception as e:
             logger.error(f"Error in download_all: {e}", exc_info=True)
@@ -1353,4 +1459,33 @@ class TopCountriesView(APIView):
             return Response({
                 'success': False,
                 'error': str(e)
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class FFmpegQueueView(APIView):
+    """
+    Current load on the host-wide ffmpeg executor, for monitoring
+    """
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        from . import ffmpeg
+        return Response(ffmpeg.queue_stats())
+
+class SongCacheStatsView(APIView):
+    """
+    Song cache hit ratio, byte hit ratio, evictions and disk use, for monitoring,
+    plus how yesterday's prefetched entries have been used. POST resets the counters.
+    """
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        from . import cache_manager, cache_warmer
+        stats = cache_manager.stats()
+        stats['warming'] = cache_warmer.warm_report()
+        return Response(stats)
+    
+    def post(self, request):
+        from . import cache_manager
+        cache_manager.reset_stats()
+        return Response(cache_manager.stats())
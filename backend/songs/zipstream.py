@@ -0,0 +1,273 @@
+import os
+import time
+import zlib
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sizes and offsets at or above this need ZIP64 records
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+# Placeholder written where the real value lives in a ZIP64 field
+ZIP64_MARKER = 0xFFFFFFFF
+
+# General purpose flags: sizes/CRC follow the data (bit 3), names are UTF-8 (bit 11)
+FLAGS = 0x0008 | 0x0800
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+ZIP64_EXTRA = struct.Struct('<HHQQQ')
+ZIP64_LOCAL_EXTRA = struct.Struct('<HHQQ')
+END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    year = max(t.tm_year, 1980)
+    dos_date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dos_time, dos_date
+
+
+def _stat(source):
+    """Size and mtime of a path or of an openable source with size and mtime attributes"""
+    if hasattr(source, 'open'):
+        return source.size, source.mtime
+    stat = os.stat(source)
+    return stat.st_size, stat.st_mtime
+
+
+def _open(source):
+    return source.open() if hasattr(source, 'open') else open(source, 'rb')
+
+
+class ZipEntry:
+    def __init__(self, arcname, path, size, mtime, offset):
+        self.arcname = arcname
+        self.name_bytes = arcname.encode('utf-8')
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.offset = offset
+        self.zip64 = size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT
+        self.crc = 0
+
+    @property
+    def local_size(self):
+        extra = ZIP64_LOCAL_EXTRA.size if self.zip64 else 0
+        descriptor = DATA_DESCRIPTOR64.size if self.zip64 else DATA_DESCRIPTOR.size
+        return LOCAL_HEADER.size + len(self.name_bytes) + extra + self.size + descriptor
+
+    @property
+    def central_size(self):
+        extra = ZIP64_EXTRA.size if self.zip64 else 0
+        return CENTRAL_HEADER.size + len(self.name_bytes) + extra
+
+
+class ZipStream:
+    """
+    Stored-mode (uncompressed) ZIP archive built on the fly from files on disk.
+    Audio is already compressed, so storing costs nothing in size while letting
+    the archive's exact length be known before any byte is read: iterate the
+    object for the archive's chunks and use .size for Content-Length. Memory use
+    is one chunk regardless of archive size. ZIP64 records are added only when
+    an entry or the archive passes 4 GB.
+
+    Given base entries (see read_entries), the archive continues an existing one:
+    iteration starts at .base_size, skipping the base's local entries, and ends
+    with a central directory covering every entry.
+
+    Args:
+        files: Iterable of (arcname, source) pairs, where source is a path or an
+            object with size, mtime and open() (storage.ColdFile); duplicate
+            names get a " (n)" suffix
+        chunk_size: Bytes read from each file at a time
+        base: ZipEntry list of an existing archive these files are appended to
+    """
+
+    def __init__(self, files, chunk_size=64 * 1024, base=None):
+        self.chunk_size = chunk_size
+        self.base = list(base or [])
+        self.entries = list(self.base)
+        seen = {entry.arcname.lower() for entry in self.base}
+        offset = self.base_size = sum(entry.local_size for entry in self.base)
+        for arcname, path in files:
+            size, mtime = _stat(path)
+            arcname = self._unique_name(arcname, seen)
+            entry = ZipEntry(arcname, path, size, mtime, offset)
+            self.entries.append(entry)
+            offset += entry.local_size
+
+        self.central_offset = offset
+        self.central_size = sum(entry.central_size for entry in self.entries)
+        self.zip64 = (
+            any(entry.zip64 for entry in self.entries)
+            or len(self.entries) >= ZIP64_COUNT_LIMIT
+            or self.central_offset >= ZIP64_LIMIT
+            or self.central_size >= ZIP64_LIMIT
+        )
+        end_size = END_RECORD.size
+        if self.zip64:
+            end_size += ZIP64_END_RECORD.size + ZIP64_END_LOCATOR.size
+        self.size = self.central_offset + self.central_size + end_size
+
+    @staticmethod
+    def _unique_name(arcname, seen):
+        base, ext = os.path.splitext(arcname)
+        candidate = arcname
+        n = 2
+        while candidate.lower() in seen:
+            candidate = f"{base} ({n}){ext}"
+            n += 1
+        seen.add(candidate.lower())
+        return candidate
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for entry in self.entries[len(self.base):]:
+            yield self._local_header(entry)
+            yield from self._file_data(entry)
+            yield self._data_descriptor(entry)
+        for entry in self.entries:
+            yield self._central_header(entry)
+        yield self._end_records()
+
+    def _local_header(self, entry):
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        if entry.zip64:
+            # Real sizes go in the data descriptor; the extra field just marks ZIP64
+            extra = ZIP64_LOCAL_EXTRA.pack(0x0001, 16, 0, 0)
+            sizes = (ZIP64_MARKER, ZIP64_MARKER)
+            version = 45
+        else:
+            extra = b''
+            sizes = (0, 0)
+            version = 20
+        header = LOCAL_HEADER.pack(
+            0x04034b50, version, FLAGS, 0, dos_time, dos_date,
+            0, *sizes, len(entry.name_bytes), len(extra)
+        )
+        return header + entry.name_bytes + extra
+
+    def _file_data(self, entry):
+        crc = 0
+        remaining = entry.size
+        f = _open(entry.path)
+        try:
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    # The length was promised up front, so a shrunk file can't be papered over
+                    raise IOError(f"{entry.path} shrank while being archived")
+                crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+        entry.crc = crc
+
+    def _data_descriptor(self, entry):
+        if entry.zip64:
+            return DATA_DESCRIPTOR64.pack(0x08074b50, entry.crc, entry.size, entry.size)
+        return DATA_DESCRIPTOR.pack(0x08074b50, entry.crc, entry.size, entry.size)
+
+    def _central_header(self, entry):
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        if entry.zip64:
+            extra = ZIP64_EXTRA.pack(0x0001, 24, entry.size, entry.size, entry.offset)
+            size = offset = ZIP64_MARKER
+            version = 45
+        else:
+            extra = b''
+            size, offset = entry.size, entry.offset
+            version = 20
+        header = CENTRAL_HEADER.pack(
+            0x02014b50, 3 << 8 | version, version, FLAGS, 0, dos_time, dos_date,
+            entry.crc, size, size, len(entry.name_bytes), len(extra), 0, 0, 0,
+            0o100644 << 16, offset
+        )
+        return header + entry.name_bytes + extra
+
+    def _end_records(self):
+        count = len(self.entries)
+        records = b''
+        if self.zip64:
+            zip64_end_offset = self.central_offset + self.central_size
+            records += ZIP64_END_RECORD.pack(
+                0x06064b50, ZIP64_END_RECORD.size - 12, 3 << 8 | 45, 45, 0, 0,
+                count, count, self.central_size, self.central_offset
+            )
+            records += ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1)
+        records += END_RECORD.pack(
+            0x06054b50, 0, 0,
+            min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+            min(self.central_size, ZIP64_MARKER), min(self.central_offset, ZIP64_MARKER), 0
+        )
+        return records
+
+
+def read_entries(path):
+    """
+    Read the entries of an archive written by ZipStream, CRCs included, so
+    ZipStream(files, base=...) can append to it without reading the base's files
+    """
+    import zipfile
+
+    entries = []
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            entry = ZipEntry(info.filename, None, info.file_size, mtime, info.header_offset)
+            entry.crc = info.CRC
+            entries.append(entry)
+    return entries
+
+
+def _copy_prefix(src, dst, length, chunk_size):
+    """Copy the first length bytes of src to dst, in the kernel where possible"""
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                count = os.copy_file_range(src.fileno(), dst.fileno(), length - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            # Unsupported here; carry on from the current offsets in Python
+            pass
+    while copied < length:
+        chunk = src.read(min(chunk_size, length - copied))
+        if not chunk:
+            raise IOError(f"{src.name} is shorter than its own entries")
+        dst.write(chunk)
+        copied += len(chunk)
+    dst.seek(length)
+
+
+def write_archive(dest, files, base_path=None, chunk_size=64 * 1024):
+    """
+    Write a stored ZIP of files to dest. With base_path, the archive is base_path's
+    entries followed by files: the base's local entries are copied byte for byte
+    (no re-reading of their source files or CRCs) and only files are added.
+    The result is identical to writing every entry from scratch.
+
+    Returns:
+        Size of the archive in bytes
+    """
+    base = read_entries(base_path) if base_path else None
+    archive = ZipStream(files, chunk_size=chunk_size, base=base)
+    with open(dest, 'wb') as out:
+        if base:
+            with open(base_path, 'rb', buffering=0) as src:
+                _copy_prefix(src, out, archive.base_size, chunk_size)
+        for chunk in archive:
+            out.write(chunk)
+    return archive.size
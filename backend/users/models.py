@@ -82,19 +82,22 @@ class CustomUser(AbstractUser):
             
         return True
     
-    def can_download(self):
+    def can_download(self, pending=0):
         """
         Check if the user can download more songs today
+        
+        Args:
+            pending: Downloads already queued or running, which count once they finish
         """
         # Reset daily downloads if it's a new day
         self._reset_daily_downloads_if_needed()
         
         # Subscribed users have a limit of 50 downloads per day
         if self.is_subscription_active():
-            return self.daily_downloads < 50
+            return self.daily_downloads + pending < 50
             
         # Non-subscribed users are limited to 15 downloads per day
-        return self.daily_downloads < 15
+        return self.daily_downloads + pending < 15
     
     def increment_download_count(self):
         """